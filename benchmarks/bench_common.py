@@ -0,0 +1,23 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import configparser
+import os
+from typing import Optional
+
+
+def load_config(config_file: str, folder: Optional[str] = None):
+    """
+    The [settings], [build_geometry] and [protocol] sections of a config file as
+    the dicts of make_options(). With folder, the .mae file is taken from it."""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    settings = {"desmond_path": "$SCHRODINGER", **dict(config.items("settings"))}
+    settings["input"] = config_file
+    if folder is not None:
+        settings["file"] = os.path.join(folder, settings["file"])
+    return (
+        settings,
+        dict(config.items("build_geometry")),
+        dict(config.items("protocol")),
+    )
@@ -0,0 +1,57 @@
+"""
+Time the generation of the _preparation.msj, _md.msj and _md.cfg files.
+
+The input files of every system are assembled in memory, so this measures the
+text generation alone, without touching the disk or running Desmond.
+
+Execute as: python benchmarks/bench_generation.py [-i config.dat] [-n 1000]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+from bench_common import load_config  # noqa: E402
+
+
+def generate(settings, build_opts, protocol_opts):
+    _, builder_opts, file_path, p_opts = desmond_builder.make_options(
+        settings, build_opts, protocol_opts
+    )
+    builder = desmond_builder.Builder(builder_opts, 0)
+    protocol = desmond_builder.Protocol(file_path, builder_opts, p_opts)
+    size = len(builder.render_input()) + len(protocol.render_msj())
+    if desmond_builder.enabled(p_opts.production):
+        size += len(protocol.render_cfg())
+    return size
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-i",
+        "--input",
+        default=os.path.join(
+            ROOT, "examples", "config_NPT_ter_nose_bar_MTK_add_4stages.dat"
+        ),
+        help="Configuration file of the generated systems",
+    )
+    parser.add_argument("-n", type=int, default=1000, help="Number of systems")
+    args = parser.parse_args(argv)
+
+    settings, build_opts, protocol_opts = load_config(args.input)
+    start = time.perf_counter()
+    size = sum(generate(settings, build_opts, protocol_opts) for _ in range(args.n))
+    elapsed = time.perf_counter() - start
+    print(f"systems      {args.n}")
+    print(f"bytes        {size}")
+    print(f"elapsed      {elapsed:.3f} s")
+    print(f"systems/s    {args.n / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
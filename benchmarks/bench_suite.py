@@ -0,0 +1,313 @@
+"""
+Time the configuration parsing, the restraint expansion, the file generation and
+a whole campaign, and write the results as JSON to compare versions.
+
+Benchmarks:
+    parse_args             parse_args() of a config file, including ProtocolOptions
+    protocol_options       ProtocolOptions() of the [protocol] section
+    set_restraint          Protocol.set_restraint() of stage1, n restraints per type
+    partition_restraints   Protocol.partition_restraints() of the additional stages,
+                           n restraints per type split over --stages stages
+    merge_restraints       merge_restraints() of n positional and n distance
+                           restraints with 50 different forces
+    protocol_write         Protocol.write() (_md.msj and _md.cfg)
+    write_cfg_file         Protocol.write_cfg_file()
+    builder_write_input    Builder.write_input() (_preparation.msj)
+    campaign               campaign --no-run of --systems systems over the configs
+                           of examples/
+
+Execute as: python benchmarks/bench_suite.py [-o results.json] [--systems 1000]
+Compare two runs with: python benchmarks/bench_suite.py --compare old.json new.json
+"""
+import argparse
+import contextlib
+import copy
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+from bench_common import load_config  # noqa: E402
+
+EXAMPLES = os.path.join(ROOT, "examples")
+CONFIG = os.path.join(EXAMPLES, "config_NPT_ter_nose_bar_MTK_add_4stages.dat")
+RESTRAINTS = [10, 100, 1000, 10000]
+
+
+def measure(function, repeat: int) -> dict:
+    """Best and mean wall time of repeat calls of a function, with stdout silenced."""
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "best_s": min(times),
+        "mean_s": sum(times) / len(times),
+    }
+
+
+def restraint_values(kind: str, number: int) -> tuple:
+    """Comma-separated ASLs, forces and constants of number restraints of a kind."""
+    size = desmond_builder.RESTRAINT_TYPES[kind][1]
+    atoms = ",".join(f"res.num {i % 300 + 1}" for i in range(number * size))
+    forces = ",".join(f"{1.0 + i % 50}" for i in range(number))
+    constants = ",".join(f"{2.0 + i % 7}" for i in range(number))
+    return atoms, forces, constants
+
+
+def bench_parse(args, results: list) -> None:
+    settings, build_opts, protocol_opts = load_config(CONFIG, EXAMPLES)
+    argv = ["-i", CONFIG, "--file", settings["file"]]
+    results.append(
+        {
+            "name": "parse_args",
+            **measure(lambda: desmond_builder.parse_args(argv), args.repeat),
+        }
+    )
+    results.append(
+        {
+            "name": "protocol_options",
+            "n": len(protocol_opts),
+            **measure(
+                lambda: desmond_builder.ProtocolOptions(dict(protocol_opts)),
+                args.repeat,
+            ),
+        }
+    )
+
+
+def bench_restraints(args, results: list, protocol) -> None:
+    # The restraint options are set on a copy, which protocol_write does not see.
+    protocol = copy.copy(protocol)
+    protocol.p_opts = copy.copy(protocol.p_opts)
+    p_opts = protocol.p_opts
+    for number in args.restraints:
+        for kind, (_, _, constant) in desmond_builder.RESTRAINT_TYPES.items():
+            atoms, forces, constants = restraint_values(kind, number)
+            stages = min(args.stages, number)
+            counts = ",".join(
+                str(number // stages + (stage < number % stages))
+                for stage in range(stages)
+            )
+            for name in ["stage1", "additional_stage"]:
+                setattr(p_opts, f"{name}_restraints_atoms_{kind}", atoms)
+                setattr(p_opts, f"{name}_restraints_forces_{kind}", forces)
+                if constant is not None:
+                    setattr(p_opts, f"{name}_restraints_{constant}_{kind}", constants)
+            results.append(
+                {
+                    "name": "set_restraint",
+                    "kind": kind,
+                    "n": number,
+                    **measure(
+                        lambda: protocol.set_restraint("stage1", kind, number, True),
+                        args.repeat,
+                    ),
+                }
+            )
+            results.append(
+                {
+                    "name": "partition_restraints",
+                    "kind": kind,
+                    "n": number,
+                    "stages": stages,
+                    **measure(
+                        lambda: protocol.partition_restraints(
+                            "additional_stage", kind, counts
+                        ),
+                        args.repeat,
+                    ),
+                }
+            )
+
+
+def bench_merge(args, results: list) -> None:
+    for number in args.restraints:
+        restraints = [
+            desmond_builder.Restraint(
+                "pos", "posre_harm", [f"atom.num {i + 1}"], f"{1.0 + i % 50}"
+            )
+            for i in range(number)
+        ] + [
+            desmond_builder.Restraint(
+                "dist",
+                "stretch_harm",
+                [f"res.num {i % 300 + 1}", f"res.num {i % 300 + 2}"],
+                f"{1.0 + i % 50}",
+                "3.0",
+            )
+            for i in range(number)
+        ]
+        results.append(
+            {
+                "name": "merge_restraints",
+                "n": number,
+                **measure(
+                    lambda: desmond_builder.merge_restraints(restraints), args.repeat
+                ),
+            }
+        )
+
+
+def bench_write(args, results: list, builder, protocol) -> None:
+    results.append({"name": "protocol_write", **measure(protocol.write, args.repeat)})
+    results.append(
+        {"name": "write_cfg_file", **measure(protocol.write_cfg_file, args.repeat)}
+    )
+    results.append(
+        {"name": "builder_write_input", **measure(builder.write_input, args.repeat)}
+    )
+
+
+def bench_campaign(args, results: list) -> None:
+    """campaign --no-run of args.systems systems: one .mae copy per config and system."""
+    configs = sorted(glob.glob(os.path.join(EXAMPLES, "*.dat")))
+    files = -(-args.systems // len(configs))
+    os.makedirs("structures")
+    for i in range(files):
+        shutil.copyfile(
+            os.path.join(EXAMPLES, "5yok.mae"),
+            os.path.join("structures", f"system{i:05d}.mae"),
+        )
+    argv = ["-i"] + configs + ["--files", "structures/*.mae", "--no-run"]
+    if args.workers:
+        argv += ["-j", str(args.workers)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        campaign = desmond_builder.campaign(argv)
+        elapsed = time.perf_counter() - start
+    failed = sum(result.status != "ok" for result in campaign)
+    results.append(
+        {
+            "name": "campaign",
+            "n": len(campaign),
+            "failed": failed,
+            "workers": args.workers or os.cpu_count(),
+            "repeat": 1,
+            "best_s": elapsed,
+            "mean_s": elapsed,
+        }
+    )
+
+
+def run(args) -> dict:
+    results: list = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            bench_parse(args, results)
+            settings, build_opts, protocol_opts = load_config(CONFIG, EXAMPLES)
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, builder_opts, file_path, p_opts = desmond_builder.make_options(
+                    settings, build_opts, protocol_opts
+                )
+            builder = desmond_builder.Builder(builder_opts, 0)
+            protocol = desmond_builder.Protocol(file_path, builder_opts, p_opts)
+            bench_restraints(args, results, protocol)
+            bench_merge(args, results)
+            bench_write(args, results, builder, protocol)
+            if args.systems:
+                bench_campaign(args, results)
+        finally:
+            os.chdir(cwd)
+    return {
+        "version": desmond_builder.VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return tuple(
+        (key, value)
+        for key, value in result.items()
+        if key not in ["repeat", "best_s", "mean_s", "failed"]
+    )
+
+
+def compare(old_file: str, new_file: str) -> None:
+    """Print the ratio of the best times of two result files."""
+    with open(old_file, "r", encoding="utf8") as fd:
+        old = {result_key(result): result for result in json.load(fd)["results"]}
+    with open(new_file, "r", encoding="utf8") as fd:
+        new = json.load(fd)["results"]
+    print(f"{'Benchmark':<44} {'Old (s)':>10} {'New (s)':>10} {'Ratio':>7}")
+    for result in new:
+        key = result_key(result)
+        label = " ".join(f"{value}" for _, value in key)
+        if key not in old:
+            print(f"{label:<44} {'-':>10} {result['best_s']:>10.4f} {'-':>7}")
+            continue
+        before = old[key]["best_s"]
+        print(
+            f"{label:<44} {before:>10.4f} {result['best_s']:>10.4f} "
+            f"{result['best_s'] / before:>7.2f}"
+        )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-o", "--output", help="JSON file of the results (default stdout)"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Repetitions of each benchmark"
+    )
+    parser.add_argument(
+        "--restraints",
+        type=int,
+        nargs="+",
+        default=RESTRAINTS,
+        help="Numbers of restraints of the restraint benchmarks",
+    )
+    parser.add_argument(
+        "--stages",
+        type=int,
+        default=10,
+        help="Additional stages of the partition_restraints benchmark",
+    )
+    parser.add_argument(
+        "--systems",
+        type=int,
+        default=1000,
+        help="Systems of the campaign benchmark (0 to skip it)",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, help="Processes of the campaign benchmark"
+    )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files"
+    )
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as fd:
+            print(output, file=fd)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
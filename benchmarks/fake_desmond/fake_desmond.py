@@ -0,0 +1,299 @@
+"""
+Stand-ins for the Schrödinger executables called by desmond_builder.py.
+Point desmond_path at this folder to run the whole orchestration (preparation,
+MD, replicas, restarts, monitoring and metrics) without a Desmond license:
+
+    desmond_path = /path/to/desmond_builder/benchmarks/fake_desmond
+
+run           answers the structure queries of schrod_script.py with the
+              native .mae reader and ASL evaluator of desmond_builder.py.
+multisim      parses the arguments, the .msj and the .cfg files written by the
+              builder, waits (or burns CPU) as long as the cost model says and
+              writes -out.cms, .ene, .cpt, .log and _multisim.log files, and a
+              -multisim_checkpoint after every stage, which -RESTART resumes.
+desmond       restores a job from its .cpt (resume/extend).
+
+Cost model: a job of A atoms on C CPUs runs at
+NS_PER_DAY * C**0.9 * REFERENCE_ATOMS / A ns/day, and the preparation takes
+PREPARATION_TIME * A / REFERENCE_ATOMS seconds. The wall times are divided by
+$FAKE_DESMOND_SPEEDUP (default 10000). With $FAKE_DESMOND_BURN=1 the stubs
+consume CPU instead of sleeping. Without -WAIT multisim returns at once and
+runs in the background, like the real one; $FAKE_DESMOND_WAIT=1 makes it block.
+$FAKE_DESMOND_FAIL_STAGE=N makes multisim fail at stage N, unless it restarts.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+NS_PER_DAY = 20.0
+REFERENCE_ATOMS = 25000
+PREPARATION_TIME = 120.0
+# Rows of .ene and progress lines of .log written per job.
+SAMPLES = 20
+
+
+def enabled(variable: str) -> bool:
+    return os.environ.get(variable, "").lower() in ["1", "yes", "on", "true"]
+
+
+def speedup() -> float:
+    return float(os.environ.get("FAKE_DESMOND_SPEEDUP", "10000"))
+
+
+def wait(seconds: float) -> None:
+    if enabled("FAKE_DESMOND_BURN"):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+    else:
+        time.sleep(seconds)
+
+
+def count_atoms(file: str) -> int:
+    try:
+        return len(desmond_builder.MaeAtomTable(file)) or 1
+    except (OSError, ValueError, IndexError):
+        return 1
+
+
+def ns_per_day(atoms: int, cpu: int) -> float:
+    return NS_PER_DAY * max(1, cpu) ** 0.9 * REFERENCE_ATOMS / max(1, atoms)
+
+
+def write_cms(source: str, output: str) -> None:
+    """Copy a structure; a missing source gives a minimal but complete .cms."""
+    if os.path.isfile(source):
+        if not os.path.exists(output) or not os.path.samefile(source, output):
+            shutil.copyfile(source, output)
+        return
+    with open(output, "w", encoding="utf8") as fd:
+        fd.write("{\n  s_m_m2io_version\n  :::\n  2.0.0\n}\n\nf_m_ct {\n}\n")
+
+
+def simulate(
+    jobname: str,
+    input_cms: str,
+    start: float,
+    end: float,
+    cpu: int,
+    settings: dict,
+    log_mode: str = "w",
+) -> None:
+    """Run one fake Desmond job from start to end ps, writing its files."""
+    atoms = count_atoms(input_cms)
+    speed = ns_per_day(atoms, cpu)
+    wall = (end - start) / 1000 / speed * 86400 / speedup()
+    # Only the production writes checkpoints, the msj sets write_last_step = no.
+    checkpoints = "checkpt_interval" in settings
+    checkpoint_interval = float(settings.get("checkpt_interval", "inf"))
+    if log_mode == "w":
+        write_cms(input_cms, f"{jobname}-in.cms")
+    with open(f"{jobname}.ene", log_mode, encoding="utf8") as ene, open(
+        f"{jobname}.log", log_mode, encoding="utf8"
+    ) as log:
+        if log_mode == "w":
+            ene.write("# 0:time (ps)   1:E (kcal/mol)   2:E_p (kcal/mol)\n")
+            log.write(f"Number of atoms: {atoms}\nCPUs: {cpu}\n")
+        last_checkpoint = start
+        for sample in range(1, SAMPLES + 1):
+            wait(wall / SAMPLES)
+            now = start + (end - start) * sample / SAMPLES
+            ene.write(f"{now:.4f} {-1000.0 - now:.4f} {-2000.0 - now:.4f}\n")
+            log.write(f"Chemical time: {now:.4f} ps, ns/day: {speed:.3f}\n")
+            ene.flush()
+            log.flush()
+            if checkpoints and (
+                now - last_checkpoint >= checkpoint_interval or sample == SAMPLES
+            ):
+                with open(f"{jobname}.cpt", "w", encoding="utf8") as cpt:
+                    json.dump({"time": now, "end": end}, cpt)
+                last_checkpoint = now
+        log.write(f"Total wall time: {wall * speedup():.3f}\n")
+    write_cms(input_cms, f"{jobname}-out.cms")
+
+
+def cfg_values(cfg_file: str) -> dict:
+    settings = (
+        desmond_builder.cfg_settings(cfg_file) if os.path.isfile(cfg_file) else {}
+    )
+    values = {"time": float(settings.get("time", "0") or 0)}
+    if os.path.isfile(cfg_file):
+        with open(cfg_file, "r", encoding="utf8") as fd:
+            text = fd.read()
+        match = re.search(r"checkpt\s*=\s*\{[^}]*?interval\s*=\s*(\S+)", text)
+        if match:
+            values["checkpt_interval"] = match.group(1)
+    return values
+
+
+def stage_block(msj: str, number: int) -> str:
+    """The text of a stage of a .msj file, by stage number (task is 1)."""
+    blocks = re.split(r"^(?=task|simulate)", msj, flags=re.MULTILINE)
+    return [text for text in blocks if text.startswith(("task", "simulate"))][
+        number - 1
+    ]
+
+
+def production(jobname: str, structure: str, cfg_file: str, cpu: int) -> None:
+    settings = cfg_values(cfg_file)
+    simulate(jobname, structure, 0.0, settings["time"], cpu, settings)
+
+
+def run_multisim(args: argparse.Namespace) -> None:
+    cpu = int(args.cpu or 1)
+    maxjob = max(1, int(args.maxjob or 1))
+    input_cms = args.input[0] if args.input else ""
+    checkpoint_file = f"{args.JOBNAME}-multisim_checkpoint"
+    # The last stage completed by the job that is restarted.
+    completed = 1
+    if args.RESTART:
+        with open(args.RESTART, "r", encoding="utf8") as fd:
+            checkpoint = json.load(fd)
+        args.m, args.o = checkpoint["m"], args.o or checkpoint["o"]
+        input_cms, completed = checkpoint["structure"], checkpoint["stage"]
+    fail_stage = int(os.environ.get("FAKE_DESMOND_FAIL_STAGE", "0") or 0)
+    with open(args.m, "r", encoding="utf8") as fd:
+        msj = fd.read()
+    with open(
+        f"{args.JOBNAME}_multisim.log", "a" if args.RESTART else "w", encoding="utf8"
+    ) as log:
+        log.write(f"Multisim {args.JOBNAME}: {args.m} {input_cms}\n")
+        if "build_geometry" in msj:
+            log.write("Stage 2 - build_geometry launched\n")
+            log.flush()
+            atoms = count_atoms(input_cms)
+            wait(PREPARATION_TIME * atoms / REFERENCE_ATOMS / speedup())
+            write_cms(input_cms, args.o)
+            log.write("Stage 2 completed successfully\n")
+            return
+        structure = input_cms
+        for number, settings in sorted(desmond_builder.msj_stages(args.m).items()):
+            if number <= completed:
+                continue
+            log.write(f"Stage {number} - simulate launched\n")
+            log.flush()
+            if number == fail_stage and not args.RESTART:
+                log.write(f"Stage {number} failed\n")
+                sys.exit(1)
+            if "cfg_file" in settings:
+                production(
+                    args.JOBNAME, structure, settings["cfg_file"].strip('"'), cpu
+                )
+                structure = f"{args.JOBNAME}-out.cms"
+            elif "time" in settings:
+                jobname = f"{args.JOBNAME}_{number}"
+                simulate(jobname, structure, 0.0, float(settings["time"]), cpu, {})
+                structure = f"{jobname}-out.cms"
+            else:
+                # A list of simulate blocks: the production replicas, maxjob at once.
+                cfg_files = re.findall(
+                    r'cfg_file\s*=\s*"([^"]+)"', stage_block(msj, number)
+                )
+                threads = [
+                    threading.Thread(
+                        target=production,
+                        args=(f"{args.JOBNAME}-replica{i}", structure, cfg_file, cpu),
+                    )
+                    for i, cfg_file in enumerate(cfg_files, 1)
+                ]
+                for first in range(0, len(threads), maxjob):
+                    for thread in threads[first : first + maxjob]:
+                        thread.start()
+                    for thread in threads[first : first + maxjob]:
+                        thread.join()
+            log.write(f"Stage {number} completed successfully\n")
+            with open(checkpoint_file, "w", encoding="utf8") as fd:
+                json.dump(
+                    {"m": args.m, "o": args.o, "stage": number, "structure": structure},
+                    fd,
+                )
+        write_cms(structure, args.o or f"{args.JOBNAME}-out.cms")
+        log.write("Multisim completed\n")
+
+
+def multisim(argv) -> None:
+    parser = argparse.ArgumentParser(prog="multisim")
+    for option in "-HOST -JOBNAME -maxjob -cpu -m -c -o -RESTART".split():
+        parser.add_argument(option)
+    parser.add_argument("-mode")
+    parser.add_argument("-set")
+    parser.add_argument("-WAIT", action="store_true")
+    parser.add_argument("-LOCAL", action="store_true")
+    parser.add_argument("input", nargs="*")
+    args = parser.parse_args(argv)
+    if args.WAIT or enabled("FAKE_DESMOND_WAIT"):
+        run_multisim(args)
+        return
+    # Like the real multisim, return once the job is submitted.
+    if os.fork() == 0:
+        os.setsid()
+        with open(os.devnull, "w", encoding="utf8") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+        try:
+            run_multisim(args)
+        finally:
+            os._exit(0)
+    print(f"JobId: {args.JOBNAME}-{os.getpid()}")
+
+
+def desmond(argv) -> None:
+    parser = argparse.ArgumentParser(prog="desmond")
+    for option in ["-HOST", "-JOBNAME", "-cpu", "-restore", "-in", "-cfg"]:
+        parser.add_argument(option)
+    parser.add_argument("-WAIT", action="store_true")
+    args = parser.parse_args(argv)
+    with open(args.restore, "r", encoding="utf8") as fd:
+        checkpoint = json.load(fd)
+    cfg_file = desmond_builder.production_cfg(".", args.JOBNAME)
+    settings = cfg_values(cfg_file) if cfg_file else {"checkpt_interval": "inf"}
+    end = max(checkpoint["end"], settings.get("time", 0.0))
+    if args.cfg and "last_time=" in args.cfg:
+        end = float(args.cfg.split("last_time=")[1])
+    simulate(
+        args.JOBNAME,
+        getattr(args, "in"),
+        checkpoint["time"],
+        end,
+        int(args.cpu or 1),
+        settings,
+        log_mode="a",
+    )
+
+
+def run(argv) -> None:
+    """$SCHRODINGER/run schrod_script.py -i file -get charge|atoms_number|batch"""
+    parser = argparse.ArgumentParser(prog="run")
+    parser.add_argument("script")
+    parser.add_argument("-i", "--input")
+    parser.add_argument("-get")
+    parser.add_argument("-asl")
+    parser.add_argument("-queries")
+    args = parser.parse_args(argv)
+    table = desmond_builder.MaeAtomTable(args.input)
+    evaluator = desmond_builder.AslEvaluator(table)
+
+    def answer(query):
+        if query["get"] == "charge":
+            return sum(desmond_builder.read_mae_charges(args.input))
+        try:
+            return evaluator.atoms(query["asl"])
+        except Exception as e_rror:  # noqa: BLE001 - reported like schrod_script.py
+            return {"error": str(e_rror)}
+
+    if args.get == "batch":
+        with open(args.queries, "r", encoding="utf8") as fd:
+            queries = json.load(fd)
+        print(json.dumps({query["name"]: answer(query) for query in queries}))
+    else:
+        print(answer({"get": args.get, "asl": args.asl}))
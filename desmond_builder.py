@@ -8,18 +8,37 @@ maurobedoyat@gmail.com"
 from __future__ import print_function
 
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
+import ctypes
+import ctypes.util
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
 import os
+import re
+import select
+import shlex
 import subprocess
 import sys
+import time
+import traceback
 from typing_extensions import TypeAlias
 import numpy as np
 from os import path, PathLike, supports_fd, write
 
-from dataclasses import dataclass, fields
-from typing import Dict, List, Optional, Set, TextIO, Tuple
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple, Union
 import configparser
 import random
 
+VERSION = "1.0"
+
 
 @dataclass
 class Args:
@@ -30,6 +49,15 @@ class Args:
     desmond_path: str
     windows: str = "false"
     workdir: str = "md_run"
+    mae_reader: str = "native"
+    cache_dir: Optional[str] = None
+    cache_size: str = "64"
+    no_cache: bool = False
+    purge_cache: bool = False
+    no_run: bool = False
+    incremental: bool = False
+    cpu: Optional[str] = None
+    maxjob: Optional[str] = None
 
 
 @dataclass
@@ -77,560 +105,548 @@ class BuilderOptions:
         self.desmond_path = desmond_path
         self.windows = windows
         self.file_path = file_path
+        self._atom_table: Optional["MaeAtomTable"] = None
         for key in self.opts:
             setattr(self, key, self.opts[key])
 
+    @property
+    def atom_table(self) -> "MaeAtomTable":
+        """
+        Atom table of the input file, read on first access and shared by the
+        property queries, the CPU sizing and the contact and weighted restraints."""
+        if self._atom_table is None:
+            self._atom_table = MaeAtomTable(self.file_path)
+        return self._atom_table
+
+    def __getstate__(self) -> Dict:
+        # The memory-mapped table is read again by the process that needs it.
+        return {**self.__dict__, "_atom_table": None}
+
     def __getattr__(self, item):
+        # "opts" is missing while unpickling (e.g. in a worker process).
+        if item == "opts":
+            raise AttributeError(item)
         if item not in self.opts:
             return None
         return self.opts[item]
 
 
-@dataclass
-class ProtocolOptions:
-    """Variables for Protocol settings."""
-
-    stage1: Optional[bool] = True
-    stage2: Optional[bool] = True
-    stage3: Optional[bool] = True
-    stage4: Optional[bool] = True
-    stage5: Optional[bool] = True
-    production: Optional[bool] = True
-
-    stage1_time: Optional[int] = 100
-    stage2_time: Optional[int] = 12
-    stage3_time: Optional[int] = 12
-    stage4_time: Optional[int] = 12
-    stage5_time: Optional[int] = 24
-    production_time: Optional[int] = 100000
-
-    stage1_timestep: Optional[str] = "0.001 0.001 0.003"
-    stage2_timestep: Optional[str] = "0.001 0.001 0.003"
-    production_timestep_bonded: Optional[float] = 0.002
-    production_timestep_near: Optional[float] = 0.002
-    production_timestep_far: Optional[float] = 0.006
-
-    stage1_temp: Optional[float] = 10.0
-    stage2_temp: Optional[float] = 10.0
-    stage3_temp: Optional[float] = 10.0
-    stage4_temp: Optional[float] = 300.0
-    stage5_temp: Optional[float] = 300.0
-    production_temp: Optional[float] = 300.0
-    production_temp_group: Optional[str] = "0"
-
-    stage1_ensemble: Optional[str] = "NVT"
-    stage2_ensemble: Optional[str] = "NVT"
-    stage3_ensemble: Optional[str] = "NPT"
-    stage4_ensemble: Optional[str] = "NPT"
-    stage5_ensemble: Optional[str] = "NPT"
-    production_ensemble: Optional[str] = "NPT"
-
-    stage1_method: Optional[str] = "Brownie"
-    stage2_method: Optional[str] = "Berendsen"
-    stage3_method: Optional[str] = "Berendsen"
-    stage4_method: Optional[str] = "Berendsen"
-    stage5_method: Optional[str] = "Berendsen"
-    production_method: Optional[str] = "MTK"
-
-    stage1_thermostat_tau: Optional[float] = None
-    stage2_thermostat_tau: Optional[float] = 0.1
-    stage3_thermostat_tau: Optional[float] = 0.1
-    stage4_thermostat_tau: Optional[float] = 0.1
-    stage5_thermostat_tau: Optional[float] = 0.1
-    production_thermostat_tau: Optional[float] = 1.0
-
-    stage1_barostat_tau: Optional[float] = None
-    stage2_barostat_tau: Optional[float] = None
-    stage3_barostat_tau: Optional[float] = 50.0
-    stage4_barostat_tau: Optional[float] = 50.0
-    stage5_barostat_tau: Optional[float] = 2.0
-    production_barostat_tau: Optional[float] = 2.0
-
-    stage1_traj_center: Optional[str] = "[]"
-    stage2_traj_center: Optional[str] = "[]"
-    stage3_traj_center: Optional[str] = "[]"
-    stage4_traj_center: Optional[str] = "[]"
-    stage5_traj_center: Optional[str] = "solute"
-
-    stage1_restraints_number_pos: Optional[int] = 1
-    stage1_restraints_atoms_pos: Optional[str] = "solute_heavy_atom"
-    stage1_restraints_forces_pos: Optional[float] = 50.0
-
-    stage1_restraints_number_dist: Optional[int] = 0
-    stage1_restraints_atoms_dist: Optional[str] = None
-    stage1_restraints_forces_dist: Optional[float] = None
-    stage1_restraints_r0_dist: Optional[float] = None
-
-    stage1_restraints_number_ang: Optional[int] = 0
-    stage1_restraints_atoms_ang: Optional[str] = None
-    stage1_restraints_forces_ang: Optional[float] = None
-    stage1_restraints_theta0_ang: Optional[float] = None
-
-    stage1_restraints_number_imp: Optional[int] = 0
-    stage1_restraints_atoms_imp: Optional[str] = None
-    stage1_restraints_forces_imp: Optional[float] = None
-    stage1_restraints_phi0_imp: Optional[float] = None
-
-    stage2_restraints_number_pos: Optional[int] = 1
-    stage2_restraints_atoms_pos: Optional[str] = "solute_heavy_atom"
-    stage2_restraints_forces_pos: Optional[float] = 50.0
-
-    stage2_restraints_number_dist: Optional[int] = 0
-    stage2_restraints_atoms_dist: Optional[str] = None
-    stage2_restraints_forces_dist: Optional[float] = None
-    stage2_restraints_r0_dist: Optional[float] = None
-
-    stage2_restraints_number_ang: Optional[int] = 0
-    stage2_restraints_atoms_ang: Optional[str] = None
-    stage2_restraints_forces_ang: Optional[float] = None
-    stage2_restraints_theta0_ang: Optional[float] = None
-
-    stage2_restraints_number_imp: Optional[int] = 0
-    stage2_restraints_atoms_imp: Optional[str] = None
-    stage2_restraints_forces_imp: Optional[float] = None
-    stage2_restraints_phi0_imp: Optional[float] = None
-
-    stage3_restraints_number_pos: Optional[int] = 1
-    stage3_restraints_atoms_pos: Optional[str] = "solute_heavy_atom"
-    stage3_restraints_forces_pos: Optional[float] = 50.0
-
-    stage3_restraints_number_dist: Optional[int] = 0
-    stage3_restraints_atoms_dist: Optional[str] = None
-    stage3_restraints_forces_dist: Optional[float] = None
-    stage3_restraints_r0_dist: Optional[float] = None
-
-    stage3_restraints_number_ang: Optional[int] = 0
-    stage3_restraints_atoms_ang: Optional[str] = None
-    stage3_restraints_forces_ang: Optional[float] = None
-    stage3_restraints_theta0_ang: Optional[float] = None
-
-    stage3_restraints_number_imp: Optional[int] = 0
-    stage3_restraints_atoms_imp: Optional[str] = None
-    stage3_restraints_forces_imp: Optional[float] = None
-    stage3_restraints_phi0_imp: Optional[float] = None
-
-    stage4_restraints_number_pos: Optional[int] = 1
-    stage4_restraints_atoms_pos: Optional[str] = "solute_heavy_atom"
-    stage4_restraints_forces_pos: Optional[float] = 50.0
-
-    stage4_restraints_number_dist: Optional[int] = 0
-    stage4_restraints_atoms_dist: Optional[str] = None
-    stage4_restraints_forces_dist: Optional[float] = None
-    stage4_restraints_r0_dist: Optional[float] = None
-
-    stage4_restraints_number_ang: Optional[int] = 0
-    stage4_restraints_atoms_ang: Optional[str] = None
-    stage4_restraints_forces_ang: Optional[float] = None
-    stage4_restraints_theta0_ang: Optional[float] = None
-
-    stage4_restraints_number_imp: Optional[int] = 0
-    stage4_restraints_atoms_imp: Optional[str] = None
-    stage4_restraints_forces_imp: Optional[float] = None
-    stage4_restraints_phi0_imp: Optional[float] = None
-
-    stage5_restraints_number_pos: Optional[int] = 0
-    stage5_restraints_atoms_pos: Optional[str] = "solute_heavy_atom"
-    stage5_restraints_forces_pos: Optional[float] = None
-
-    stage5_restraints_number_dist: Optional[int] = 0
-    stage5_restraints_atoms_dist: Optional[str] = None
-    stage5_restraints_forces_dist: Optional[float] = None
-    stage5_restraints_r0_dist: Optional[float] = None
-
-    stage5_restraints_number_ang: Optional[int] = 0
-    stage5_restraints_atoms_ang: Optional[str] = None
-    stage5_restraints_forces_ang: Optional[float] = None
-    stage5_restraints_theta0_ang: Optional[float] = None
-
-    stage5_restraints_number_imp: Optional[int] = 0
-    stage5_restraints_atoms_imp: Optional[str] = None
-    stage5_restraints_forces_imp: Optional[float] = None
-    stage5_restraints_phi0_imp: Optional[float] = None
-
-    production_bigger_rclone: Optional[str] = "false"
-    production_checkpt_first: Optional[float] = 0.0
-    production_checkpt_interval: Optional[float] = 240.06
-    production_write_last_step: Optional[str] = "true"
-    production_cutoff: Optional[float] = 9.0
-    production_elapsed_time: Optional[float] = 0.0
-    production_energy_group: Optional[str] = "false"
-    production_eneseq_first: Optional[float] = 0.0
-    production_eneseq_interval: Optional[float] = 1.2
-    production_glue: Optional[str] = "solute"
-    production_maeff_first: Optional[float] = 0.0
-    production_maeff_interval: Optional[float] = 120.0
-    production_maeff_periodicfix: Optional[str] = "true"
-    production_meta: Optional[str] = "false"
-    production_pressure: Optional[float] = 1.01325
-    production_pressure_type: Optional[str] = "isotropic"
-    production_randomize_vel_first: Optional[float] = 0.0
-    production_randomize_vel_interval: Optional[str] = "inf"
-    production_randomize_vel_seed: Optional[int] = random.randint(0000, 9999)
-    production_simbox_first: Optional[float] = 0.0
-    production_simbox_interval: Optional[float] = 1.2
-    production_surface_tension: Optional[float] = 0.0
-    production_taper: Optional[str] = "false"
-    production_traj_center: Optional[str] = ""
-    production_traj_first: Optional[float] = 0.0
-    production_traj_format: Optional[str] = "dtr"
-    production_traj_frames_per_file: Optional[int] = 250
-    production_traj_interval: Optional[float] = 50.0
-    production_traj_periodicfix: Optional[str] = "true"
-    production_traj_write_velocity: Optional[str] = "false"
-
-    production_restraints_number_pos: Optional[int] = 0
-    production_restraints_atoms_pos: Optional[str] = None
-    production_restraints_forces_pos: Optional[float] = None
-
-    production_restraints_number_dist: Optional[int] = 0
-    production_restraints_atoms_dist: Optional[str] = None
-    production_restraints_forces_dist: Optional[float] = None
-    production_restraints_r0_dist: Optional[float] = None
-
-    production_restraints_number_ang: Optional[int] = 0
-    production_restraints_atoms_ang: Optional[str] = None
-    production_restraints_forces_ang: Optional[float] = None
-    production_restraints_theta0_ang: Optional[float] = None
-
-    production_restraints_number_imp: Optional[int] = 0
-    production_restraints_atoms_imp: Optional[str] = None
-    production_restraints_forces_imp: Optional[float] = None
-    production_restraints_phi0_imp: Optional[float] = None
-
-    name_pos: Optional[str] = "posre_harm"
-    name_dist: Optional[str] = "stretch_harm"
-    name_ang: Optional[str] = "angle_harm"
-    name_imp: Optional[str] = "improper_harm"
-
+# Type and geometry of each restraint option suffix: restraint type, number of
+# ASL selections per restraint and name of the equilibrium value option.
+RESTRAINT_TYPES: Dict[str, Tuple[str, int, Optional[str]]] = {
+    "pos": ("positional", 1, None),
+    "dist": ("distance", 2, "r0"),
+    "ang": ("angle", 3, "theta0"),
+    "imp": ("improper", 4, "phi0"),
+}
+
+# The number of values of a restraint option per restraint, in words.
+RESTRAINT_TIMES = {1: "equal to", 2: "twice", 3: "three times", 4: "four times"}
+
+
+def restraint_defaults(prefix: str, **values) -> Dict[str, object]:
+    """Restraint options of a stage, without restraints unless given."""
+    options: Dict[str, object] = {}
+    for suffix, (_, _, constant) in RESTRAINT_TYPES.items():
+        options[f"{prefix}_restraints_number_{suffix}"] = 0
+        options[f"{prefix}_restraints_atoms_{suffix}"] = None
+        options[f"{prefix}_restraints_forces_{suffix}"] = None
+        if constant is not None:
+            options[f"{prefix}_restraints_{constant}_{suffix}"] = None
+        # .csv or .npy file with one restraint per row
+        options[f"{prefix}_restraints_file_{suffix}"] = None
+    # Distance restraints on the contacts of the input structure (hbond or heavy)
+    options[f"{prefix}_restraints_contacts"] = None
+    options[f"{prefix}_restraints_contacts_force"] = 1.0
+    # Positional restraints weighted by B-factor or pLDDT, one force per class
+    options[f"{prefix}_restraints_weighted"] = None
+    options[f"{prefix}_restraints_weighted_forces"] = "50.0 10.0 1.0"
+    options.update(
+        {f"{prefix}_restraints_{key}": value for key, value in values.items()}
+    )
+    return options
+
+
+# Defaults of the relaxation stages:
+#          time, temp,  ensemble, method,      thermostat_tau, barostat_tau, traj_center
+RELAXATION_DEFAULTS: Dict[str, Tuple] = {
+    "stage1": (100, 10.0, "NVT", "Brownie", None, None, "[]"),
+    "stage2": (12, 10.0, "NVT", "Berendsen", 0.1, None, "[]"),
+    "stage3": (12, 10.0, "NPT", "Berendsen", 0.1, 50.0, "[]"),
+    "stage4": (12, 300.0, "NPT", "Berendsen", 0.1, 50.0, "[]"),
+    "stage5": (24, 300.0, "NPT", "Berendsen", 0.1, 2.0, "solute"),
+}
+RELAXATION_KEYS = (
+    "time",
+    "temp",
+    "ensemble",
+    "method",
+    "thermostat_tau",
+    "barostat_tau",
+    "traj_center",
+)
+
+# Every option of the [protocol] section with its default value.
+PROTOCOL_DEFAULTS: Dict[str, object] = {
+    **{stage: True for stage in RELAXATION_DEFAULTS},
+    "production": True,
+    **{
+        f"{stage}_{key}": value
+        for stage, values in RELAXATION_DEFAULTS.items()
+        for key, value in zip(RELAXATION_KEYS, values)
+    },
+    "stage1_timestep": "0.001 0.001 0.003",
+    "stage2_timestep": "0.001 0.001 0.003",
+    **restraint_defaults(
+        "stage1", number_pos=1, atoms_pos="solute_heavy_atom", forces_pos=50.0
+    ),
+    **restraint_defaults(
+        "stage2", number_pos=1, atoms_pos="solute_heavy_atom", forces_pos=50.0
+    ),
+    **restraint_defaults(
+        "stage3", number_pos=1, atoms_pos="solute_heavy_atom", forces_pos=50.0
+    ),
+    **restraint_defaults(
+        "stage4", number_pos=1, atoms_pos="solute_heavy_atom", forces_pos=50.0
+    ),
+    **restraint_defaults("stage5", atoms_pos="solute_heavy_atom"),
+    "production_time": 100000,
+    "production_timestep_bonded": 0.002,
+    "production_timestep_near": 0.002,
+    "production_timestep_far": 0.006,
+    "production_temp": 300.0,
+    "production_temp_group": "0",
+    "production_ensemble": "NPT",
+    "production_method": "MTK",
+    "production_thermostat_tau": 1.0,
+    "production_barostat_tau": 2.0,
+    "production_bigger_rclone": "false",
+    "production_checkpt_first": 0.0,
+    "production_checkpt_interval": 240.06,
+    "production_write_last_step": "true",
+    "production_cutoff": 9.0,
+    "production_elapsed_time": 0.0,
+    "production_energy_group": "false",
+    "production_eneseq_first": 0.0,
+    "production_eneseq_interval": 1.2,
+    "production_glue": "solute",
+    "production_maeff_first": 0.0,
+    "production_maeff_interval": 120.0,
+    "production_maeff_periodicfix": "true",
+    "production_meta": "false",
+    "production_pressure": 1.01325,
+    "production_pressure_type": "isotropic",
+    "production_randomize_vel_first": 0.0,
+    "production_randomize_vel_interval": "inf",
+    # Master seed of the velocities, drawn for every system when it is not given
+    "production_randomize_vel_seed": None,
+    "production_simbox_first": 0.0,
+    "production_simbox_interval": 1.2,
+    "production_surface_tension": 0.0,
+    "production_taper": "false",
+    "production_traj_center": "",
+    "production_traj_first": 0.0,
+    "production_traj_format": "dtr",
+    "production_traj_frames_per_file": 250,
+    "production_traj_interval": 50.0,
+    "production_traj_periodicfix": "true",
+    "production_traj_write_velocity": "false",
+    **restraint_defaults("production"),
+    "name_pos": "posre_harm",
+    "name_dist": "stretch_harm",
+    "name_ang": "angle_harm",
+    "name_imp": "improper_harm",
+    # Contact map of the *_restraints_contacts restraints
+    "contacts_cutoff": 3.5,
+    "contacts_atoms": "protein",
+    "contacts_partner": None,
+    "contacts_separation": 3,
+    # Classes of the *_restraints_weighted restraints
+    "weighted_column": "r_m_pdb_tfactor",
+    "weighted_atoms": "protein and heavy_atom",
+    "weighted_edges": None,
+    # Merge the restraints of a stage with the same type, force and constant
+    "restraints_compact": "no",
     # Additional stages
-    additional_stages: Optional[int] = 0
-    additional_stage_times: Optional[str] = 0
-    additional_stage_temps: Optional[str] = 0
-    additional_stage_ensembles: Optional[str] = 0
-    additional_stage_methods: Optional[str] = 0
-    additional_stage_thermostat_tau: Optional[float] = 0.1
-    additional_stage_barostat_tau: Optional[float] = 2.0
-
-    additional_stage_restraints_number_pos: Optional[int] = 0
-    additional_stage_restraints_atoms_pos: Optional[str] = None
-    additional_stage_restraints_forces_pos: Optional[float] = None
-
-    additional_stage_restraints_number_dist: Optional[int] = 0
-    additional_stage_restraints_atoms_dist: Optional[str] = None
-    additional_stage_restraints_forces_dist: Optional[float] = None
-    additional_stage_restraints_r0_dist: Optional[float] = None
-
-    additional_stage_restraints_number_ang: Optional[int] = 0
-    additional_stage_restraints_atoms_ang: Optional[str] = None
-    additional_stage_restraints_forces_ang: Optional[float] = None
-    additional_stage_restraints_theta0_ang: Optional[float] = None
-
-    additional_stage_restraints_number_imp: Optional[int] = 0
-    additional_stage_restraints_atoms_imp: Optional[str] = None
-    additional_stage_restraints_forces_imp: Optional[float] = None
-    additional_stage_restraints_phi0_imp: Optional[float] = None
-
-    additional_stage_traj_center: Optional[str] = "solute"
+    "additional_stages": 0,
+    "additional_stage_times": 0,
+    "additional_stage_temps": 0,
+    "additional_stage_ensembles": 0,
+    "additional_stage_methods": 0,
+    "additional_stage_thermostat_tau": 0.1,
+    "additional_stage_barostat_tau": 2.0,
+    **restraint_defaults("additional_stage"),
+    "additional_stage_traj_center": "solute",
+    # Restraint-decay schedule that generates the additional stages
+    "additional_stage_schedule": None,
+    "additional_stage_schedule_stages": 0,
+    "additional_stage_schedule_time": 100,
+    "additional_stage_schedule_atoms": "protein",
     # Run protocols
-    run_preparation: Optional[str] = "false"
-    run_protocols: Optional[str] = "false"
+    "run_preparation": "false",
+    "run_protocols": "false",
+    # CPUs of the MD job and concurrent subjobs of multisim, or "auto"
+    "cpu": "1",
+    "maxjob": "1",
+    # Independent production runs started from the relaxed system
+    "production_replicas": 1,
+}
+
+
+class ProtocolOptions:
+    """
+    Variables for Protocol settings.
+    Options missing from the [protocol] section take their value from PROTOCOL_DEFAULTS."""
 
     def __init__(self, opts: Dict) -> None:
         self.opts = opts
-        for key in self.opts:
-            setattr(self, key, self.opts[key])
-
-        input_names = [opt.name for opt in fields(ProtocolOptions)]
         for key in self.opts:
             try:
-                if key not in input_names:
+                if key not in PROTOCOL_DEFAULTS:
                     raise InputError(key)
             except InputError as e_rror:
                 print(f"Error: {e_rror.args[0]}")
                 print("Please check the input file.")
                 sys.exit()
-        # Define title for stages
-        self.stage1_title: Optional[
-            str
-        ] = f"{getattr(self, 'stage1_method')} {getattr(self, 'stage1_ensemble')}, T = {getattr(self, 'stage1_temp')} K, {getattr(self, 'stage1_time')}ps"
-        self.stage2_title: Optional[
-            str
-        ] = f"{getattr(self, 'stage2_method')} {getattr(self, 'stage2_ensemble')}, T = {getattr(self, 'stage2_temp')} K, {getattr(self, 'stage2_time')}ps"
-        self.stage3_title: Optional[
-            str
-        ] = f"{getattr(self, 'stage3_method')} {getattr(self, 'stage3_ensemble')}, T = {getattr(self, 'stage3_temp')} K, {getattr(self, 'stage3_time')}ps"
-        self.stage4_title: Optional[
-            str
-        ] = f"{getattr(self, 'stage4_method')} {getattr(self, 'stage4_ensemble')}, T = {getattr(self, 'stage4_temp')} K, {getattr(self, 'stage4_time')}ps"
-        self.stage5_title: Optional[
-            str
-        ] = f"{getattr(self, 'stage5_method')} {getattr(self, 'stage5_ensemble')}, T = {getattr(self, 'stage5_temp')} K, {getattr(self, 'stage5_time')}ps"
-        self.production_title: Optional[
-            str
-        ] = f"{getattr(self, 'production_method')} {getattr(self, 'production_ensemble')}, T = {getattr(self, 'production_temp')} K, {getattr(self, 'production_time')}ps"
-
-        # TO:DO Check if all required options are set here.
-        # To check type of stages 1-5 restraints
-        for stage in range(1, 6):
-            for restraint in ["pos", "dist", "ang", "imp"]:
-                if getattr(self, f"stage{stage}_restraints_number_{restraint}") != 0:
-                    try:
-                        value = getattr(
-                            self, f"stage{stage}_restraints_number_{restraint}"
-                        )
-                        # print(value)
-                        value = int(value)
-                    except ValueError as e_rror:
-                        print(f"Error: {e_rror.args[0]}")
-                        print(
-                            f"stage{stage}_restraints_number_{restraint} must be an integer, not '{value}'"
-                        )
-                        print("Please check the input file.")
-                        sys.exit()
-        # To check length of stages 1-5 restraints atoms, forces and constants.
-        for stage in range(1, 6):
-            for restraint in ["pos", "dist", "ang", "imp"]:
-                if restraint == "pos":
-                    factor = 1
-                if restraint == "dist":
-                    constant = "r0"
-                    factor = 2
-                elif restraint == "ang":
-                    constant = "theta0"
-                    factor = 3
-                elif restraint == "imp":
-                    constant = "phi0"
-                    factor = 4
-                if (
-                    int(getattr(self, f"stage{stage}_restraints_number_{restraint}"))
-                    != 0
-                ):
-                    try:
-                        len1 = int(
-                            getattr(self, f"stage{stage}_restraints_number_{restraint}")
-                        )
-
-                        len2a = getattr(
-                            self, f"stage{stage}_restraints_atoms_{restraint}"
-                        )
-                        len2 = len(list(str(len2a).split(",")))
-                        len3a = getattr(
-                            self, f"stage{stage}_restraints_forces_{restraint}"
+        self.__dict__.update(PROTOCOL_DEFAULTS)
+        self.__dict__.update(self.opts)
+        if self.production_randomize_vel_seed is None:
+            self.production_randomize_vel_seed = random.randint(0, 9999)
+        self.expand_schedule()
+        self.check_stage_restraints()
+        self.check_additional_stages()
+        self.check_restraint_files()
+        self.check_contacts()
+        self.check_weighted()
+        self.check_replicas()
+
+    def check_stage_restraints(self) -> None:
+        """Check the type and length of the restraint options of stages 1-5."""
+        for stage in RELAXATION_DEFAULTS:
+            for restraint, (_, factor, constant) in RESTRAINT_TYPES.items():
+                value = getattr(self, f"{stage}_restraints_number_{restraint}")
+                try:
+                    len1 = int(value)
+                except ValueError as e_rror:
+                    print(f"Error: {e_rror.args[0]}")
+                    print(
+                        f"{stage}_restraints_number_{restraint} must be an integer, not '{value}'"
+                    )
+                    print("Please check the input file.")
+                    sys.exit()
+                if len1 == 0:
+                    continue
+                try:
+                    len2a = getattr(self, f"{stage}_restraints_atoms_{restraint}")
+                    len2 = len(str(len2a).split(","))
+                    len3a = getattr(self, f"{stage}_restraints_forces_{restraint}")
+                    len3 = len(str(len3a).split(","))
+                    if constant is not None:
+                        len4a = getattr(
+                            self, f"{stage}_restraints_{constant}_{restraint}"
                         )
-                        len3 = len(list(str(len3a).split(",")))
-                        if (
-                            restraint == "dist"
-                            or restraint == "ang"
-                            or restraint == "imp"
-                        ):
-                            len4a = getattr(
-                                self,
-                                f"stage{stage}_restraints_{constant}_{restraint}",
-                            )
-                            len4 = len(list(str(len4a).split(",")))
-                            if len1 != len4:  # or len1 != len3 or len1 != len4:
-                                raise LenError(
-                                    f"stage{stage}_restraints_number_{restraint}",
-                                    len1,
-                                    f"stage{stage}_restraints_{constant}_{restraint}",
-                                    len4,
-                                    len4a,
-                                )
-                        if len1 != len2 / factor:  # or len1 != len3 or len1 != len4:
-                            raise LenError2(
-                                f"stage{stage}_restraints_number_{restraint}",
-                                len1,
-                                f"stage{stage}_restraints_atoms_{restraint}",
-                                len2,
-                                len2a,
-                            )
-                        if len1 != len3:
+                        len4 = len(str(len4a).split(","))
+                        if len1 != len4:
                             raise LenError(
-                                f"stage{stage}_restraints_number_{restraint}",
+                                f"{stage}_restraints_number_{restraint}",
                                 len1,
-                                f"stage{stage}_restraints_forces_{restraint}",
-                                len3,
-                                len3a,
+                                f"{stage}_restraints_{constant}_{restraint}",
+                                len4,
+                                len4a,
                             )
-                    except LenError as e_rror:
-                        print(f"Error: {e_rror.args[0]}")
-                        # print(
-                        #    f"Length of stage{stage}_restraints_atoms_{restraint} and stage{stage}_restraints_forces_{restraint} and stage{stage}_restraints_constants_{restraint} must be equal to stage{stage}_restraints_number_{restraint}"
-                        # )
-                        print("Please check the input file.")
-                        sys.exit()
-                    except LenError2 as e_rror:
-                        print(f"Error: {e_rror.args[0]}")
-                        # print(
-                        #    f"Length of stage{stage}_restraints_atoms_{restraint} and stage{stage}_restraints_forces_{restraint} and stage{stage}_restraints_constants_{restraint} must be equal to stage{stage}_restraints_number_{restraint}"
-                        # )
-                        print("Please check the input file.")
-                        sys.exit()
-        # To check lenght of stage_times, temps, ensembles, methods, barostat_tau and thermostat_tau.
-        if self.additional_stages != 0:
-            add_stages = int(self.additional_stages)
-            try:
-                len1 = int(self.additional_stages)
-                len2 = len(list(str(self.additional_stage_times).split(",")))
-                len3 = len(list(str(self.additional_stage_temps).split(",")))
-                len4 = len(list(str(self.additional_stage_ensembles).split(",")))
-                len5 = len(list(str(self.additional_stage_methods).split(",")))
-                len6 = len(list(str(self.additional_stage_barostat_tau).split(",")))
-                len7 = len(list(str(self.additional_stage_thermostat_tau).split(",")))
+                    if len1 != len2 / factor:
+                        raise LenError2(
+                            f"{stage}_restraints_number_{restraint}",
+                            len1,
+                            f"{stage}_restraints_atoms_{restraint}",
+                            len2,
+                            len2a,
+                        )
+                    if len1 != len3:
+                        raise LenError(
+                            f"{stage}_restraints_number_{restraint}",
+                            len1,
+                            f"{stage}_restraints_forces_{restraint}",
+                            len3,
+                            len3a,
+                        )
+                except (LenError, LenError2) as e_rror:
+                    print(f"Error: {e_rror.args[0]}")
+                    print("Please check the input file.")
+                    sys.exit()
 
-                if len1 != len2 and len2 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_times",
-                        len2,
-                        self.additional_stage_times,
-                    )
-                if len1 != len3 and len3 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_temps",
-                        len3,
-                        self.additional_stage_temps,
-                    )
-                if len1 != len4 and len4 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_ensembles",
-                        len4,
-                        self.additional_stage_ensembles,
-                    )
-                if len1 != len5 and len5 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_methods",
-                        len5,
-                        self.additional_stage_methods,
-                    )
-                if len1 != len6 and len6 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_barostat_tau",
-                        len6,
-                        self.additional_stage_barostat_tau,
-                    )
-                if len1 != len7 and len7 != 1:
-                    raise LenError3(
-                        "additional_stages",
-                        len1,
-                        "additional_stage_thermostat_tau",
-                        len7,
-                        self.additional_stage_thermostat_tau,
+    def expand_schedule(self) -> None:
+        """
+        Generate the additional stages of a restraint-decay schedule: the stage
+        times and one positional restraint per stage, with forces from start to end
+        in a geometric or linear progression. Stages with a zero force are not
+        restrained."""
+        if self.additional_stage_schedule is None:
+            return
+        generated = [
+            "additional_stages",
+            "additional_stage_times",
+            "additional_stage_restraints_number_pos",
+            "additional_stage_restraints_atoms_pos",
+            "additional_stage_restraints_forces_pos",
+        ]
+        try:
+            for option in generated:
+                if option in self.opts:
+                    raise ValueError(
+                        f"{option} is generated by additional_stage_schedule."
                     )
+            values = str(self.additional_stage_schedule).split()
+            if len(values) != 3 or values[0].lower() not in SCHEDULES:
+                raise ValueError(
+                    "additional_stage_schedule must be 'geometric start end' or "
+                    "'linear start end'."
+                )
+            kind, start, end = values[0].lower(), float(values[1]), float(values[2])
+            stages = int(self.additional_stage_schedule_stages)
+            if stages < 1:
+                raise ValueError("additional_stage_schedule_stages must be positive.")
+            if kind == "geometric" and min(start, end) <= 0:
+                raise ValueError("A geometric schedule needs positive forces.")
+            time = float(self.additional_stage_schedule_time)
+            if "," in str(self.additional_stage_schedule_atoms):
+                raise ValueError(
+                    "additional_stage_schedule_atoms cannot contain commas, "
+                    "they separate the stages."
+                )
+        except ValueError as e_rror:
+            print(f"Error: {e_rror.args[0]}")
+            print("Please check the input file.")
+            sys.exit()
+        if kind == "geometric":
+            forces = np.geomspace(start, end, stages)
+        else:
+            forces = np.linspace(start, end, stages)
+        restrained = forces > 0
+        self.additional_stages = stages
+        self.additional_stage_times = ",".join(
+            f"{value:g}" for value in np.full(stages, time)
+        )
+        self.additional_stage_restraints_number_pos = ",".join(
+            map(str, restrained.astype(int))
+        )
+        self.additional_stage_restraints_atoms_pos = ",".join(
+            [self.additional_stage_schedule_atoms] * int(restrained.sum())
+        )
+        # Four significant digits, written as floats like the forces of a config.
+        self.additional_stage_restraints_forces_pos = ",".join(
+            repr(float(f"{force:.4g}")) for force in forces[restrained]
+        )
+
+    def check_additional_stages(self) -> None:
+        """Check that every additional stage option has one value or one per stage."""
+        len1 = int(self.additional_stages)
+        for option in [
+            "additional_stage_times",
+            "additional_stage_temps",
+            "additional_stage_ensembles",
+            "additional_stage_methods",
+            "additional_stage_barostat_tau",
+            "additional_stage_thermostat_tau",
+        ]:
+            if self.additional_stages == 0:
+                break
+            value = getattr(self, option)
+            len2 = len(str(value).split(","))
+            try:
+                if len1 != len2 and len2 != 1:
+                    raise LenError3("additional_stages", len1, option, len2, value)
             except LenError3 as e_rror:
                 print(f"Error: {e_rror.args[0]}")
                 print("Please check the input file.")
                 sys.exit()
-        # To check type and number of additional positional restraints
-        if self.additional_stage_restraints_number_pos != 0:
-            add_number = self.additional_stage_restraints_number_pos.split(",")
-            add_stages = int(self.additional_stages)
+        # To check type and number of additional restraints
+        for restraint in RESTRAINT_TYPES:
+            option = f"additional_stage_restraints_number_{restraint}"
+            if getattr(self, option) == 0:
+                continue
+            add_number = getattr(self, option).split(",")
             try:
-                if len(add_number) != add_stages:
+                if len(add_number) != len1:
                     raise LenError(
-                        "additional_stages",
-                        add_stages,
-                        "additional_stage_restraints_number_pos",
-                        len(add_number),
-                        add_number,
+                        "additional_stages", len1, option, len(add_number), add_number
                     )
             except LenError as e_rror:
                 print(f"Error: {e_rror.args[0]}")
                 sys.exit()
-            for value in self.additional_stage_restraints_number_pos.split(","):
+            for value in add_number:
                 try:
                     value = int(value)
                 except ValueError as e_rror:
                     print(f"Error: {e_rror.args[0]}")
-                    print(
-                        "Please check the values of 'additional_stage_restraints_number_pos'."
-                    )
+                    print(f"Please check the values of '{option}'.")
                     sys.exit()
-        # To check type and number of additional distance restraints
-        if self.additional_stage_restraints_number_dist != 0:
-            add_number = self.additional_stage_restraints_number_dist.split(",")
-            add_stages = int(self.additional_stages)
-            try:
-                if len(add_number) != add_stages:
-                    raise LenError(
-                        "additional_stages",
-                        add_stages,
-                        "additional_stage_restraints_number_dist",
-                        len(add_number),
-                        add_number,
-                    )
-            except LenError as e_rror:
-                print(f"Error: {e_rror.args[0]}")
+
+    def check_restraint_files(self) -> None:
+        """
+        Check that the restraint files exist, are .csv or .npy files and that every
+        row is valid, and make their paths absolute, as the files are read from
+        the workdir."""
+        for name in PROTOCOL_DEFAULTS:
+            value = getattr(self, name)
+            if "_restraints_file_" not in name or value is None:
+                continue
+            kind = name.rsplit("_", 1)[1]
+            files = str(value).split(",")
+            if name.startswith("additional_stage") and len(files) != int(
+                self.additional_stages
+            ):
+                print(f"Error: {value}")
+                print(f"{name} must have one file (or none) per additional stage.")
+                print("Please check the input file.")
                 sys.exit()
-            for value in self.additional_stage_restraints_number_dist.split(","):
-                try:
-                    value = int(value)
-                except ValueError as e_rror:
-                    print(f"Error: {e_rror.args[0]}")
-                    print(
-                        "Please check the values of 'additional_stage_restraints_number_dist'."
-                    )
+            for i, file in enumerate(files):
+                file = file.strip()
+                if file.lower() in ["", "none"]:
+                    continue
+                if not file.endswith((".csv", ".npy")) or not os.path.isfile(file):
+                    print(f"Error: {file}")
+                    print(f"{name} must be an existing .csv or .npy file.")
+                    print("Please check the input file.")
                     sys.exit()
-
-        # To check type and number of additional angle restraints
-        if self.additional_stage_restraints_number_ang != 0:
-            add_number = self.additional_stage_restraints_number_ang.split(",")
-            add_stages = int(self.additional_stages)
+                files[i] = os.path.abspath(file)
+                try:
+                    for _ in read_restraint_file(files[i], kind, kind):
+                        pass
+                except (ValueError, OSError) as e_rror:
+                    print(f"Error: {e_rror.args[-1]}")
+                    print(f"Please check the restraint file of {name}.")
+                    sys.exit(1)
+            setattr(self, name, ",".join(files))
+
+    def check_contacts(self) -> None:
+        """Check the contact restraints: one type (or none) and force per stage."""
+        for name in PROTOCOL_DEFAULTS:
+            if not name.endswith(
+                ("_restraints_contacts", "_restraints_contacts_force")
+            ):
+                continue
+            values = str(getattr(self, name)).split(",")
+            stages = int(self.additional_stages)
             try:
-                if len(add_number) != add_stages:
-                    raise LenError(
-                        "additional_stages",
-                        add_stages,
-                        "additional_stage_restraints_number_ang",
-                        len(add_number),
-                        add_number,
+                if name.startswith("additional_stage") and len(values) not in [
+                    1,
+                    stages,
+                ]:
+                    raise LenError3(
+                        "additional_stages", stages, name, len(values), values
                     )
-            except LenError as e_rror:
+                if not name.startswith("additional_stage") and len(values) != 1:
+                    raise ValueError(f"{name} must have one value.")
+                for value in values:
+                    if name.endswith("_force"):
+                        float(value)
+                    elif value.strip().lower() not in CONTACTS:
+                        raise ValueError(f"{name} must be hbond, heavy or none.")
+            except (LenError3, ValueError) as e_rror:
                 print(f"Error: {e_rror.args[0]}")
+                print("Please check the input file.")
                 sys.exit()
-            for value in self.additional_stage_restraints_number_ang.split(","):
-                try:
-                    value = int(value)
-                except ValueError as e_rror:
-                    print(f"Error: {e_rror.args[0]}")
-                    print(
-                        "Please check the values of 'additional_stage_restraints_number_ang'."
-                    )
-                    sys.exit()
-        # To check type and number of additional improper restraints
-        if self.additional_stage_restraints_number_imp != 0:
-            add_number = self.additional_stage_restraints_number_imp.split(",")
-            add_stages = int(self.additional_stages)
+        try:
+            if float(self.contacts_cutoff) <= 0:
+                raise ValueError("contacts_cutoff must be a positive number.")
+            int(self.contacts_separation)
+        except ValueError as e_rror:
+            print(f"Error: {e_rror.args[0]}")
+            print("Please check the input file.")
+            sys.exit()
+
+    def check_weighted(self) -> None:
+        """
+        Check the weighted restraints: one mode (or none) and one list of
+        space-separated class forces per stage, one more force than weighted_edges."""
+        try:
+            if not str(self.weighted_column).startswith("r_"):
+                raise ValueError("weighted_column must be a real (r_) atom property.")
+            edges = None
+            if self.weighted_edges is not None:
+                edges = [float(edge) for edge in str(self.weighted_edges).split(",")]
+        except ValueError as e_rror:
+            print(f"Error: {e_rror.args[0]}")
+            print("Please check the input file.")
+            sys.exit()
+        for name in PROTOCOL_DEFAULTS:
+            if not name.endswith(
+                ("_restraints_weighted", "_restraints_weighted_forces")
+            ):
+                continue
+            values = str(getattr(self, name)).split(",")
+            stages = int(self.additional_stages)
             try:
-                if len(add_number) != add_stages:
-                    raise LenError(
-                        "additional_stages",
-                        add_stages,
-                        "additional_stage_restraints_number_imp",
-                        len(add_number),
-                        add_number,
+                if name.startswith("additional_stage") and len(values) not in [
+                    1,
+                    stages,
+                ]:
+                    raise LenError3(
+                        "additional_stages", stages, name, len(values), values
                     )
-            except LenError as e_rror:
+                if not name.startswith("additional_stage") and len(values) != 1:
+                    raise ValueError(f"{name} must have one value.")
+                modes = str(getattr(self, name.replace("_forces", ""))).split(",")
+                for i, value in enumerate(values):
+                    if not name.endswith("_forces"):
+                        if value.strip().lower() not in WEIGHTED:
+                            raise ValueError(f"{name} must be bfactor, plddt or none.")
+                        continue
+                    forces = [float(force) for force in value.split()]
+                    # Forces of stages without weighted restraints are not used.
+                    stage_modes = modes
+                    if len(values) > 1:
+                        stage_modes = [modes[i if len(modes) > 1 else 0]]
+                    if all(mode.strip().lower() == "none" for mode in stage_modes):
+                        continue
+                    if not forces or edges and len(forces) != len(edges) + 1:
+                        raise ValueError(
+                            f"{name} must have one force per class, "
+                            "one more than the weighted_edges."
+                        )
+            except (LenError3, ValueError) as e_rror:
                 print(f"Error: {e_rror.args[0]}")
+                print("Please check the input file.")
                 sys.exit()
-            for value in self.additional_stage_restraints_number_imp.split(","):
-                try:
-                    value = int(value)
-                except ValueError as e_rror:
-                    print(f"Error: {e_rror.args[0]}")
-                    print(
-                        "Please check the values of 'additional_stage_restraints_number_imp'."
-                    )
-                    sys.exit()
+
+    def restraint_files(self) -> List[str]:
+        """Every restraint file of the protocol."""
+        return [
+            file
+            for name in PROTOCOL_DEFAULTS
+            if "_restraints_file_" in name and getattr(self, name) is not None
+            for file in str(getattr(self, name)).split(",")
+            if file.strip().lower() not in ["", "none"]
+        ]
+
+    def check_replicas(self) -> None:
+        """Check production_replicas; multisim runs every replica at once by default."""
+        try:
+            self.production_replicas = int(self.production_replicas)
+            if self.production_replicas < 1:
+                raise ValueError(self.production_replicas)
+        except ValueError:
+            print(f"Error: {self.production_replicas}")
+            print("production_replicas must be a positive integer.")
+            print("Please check the input file.")
+            sys.exit()
+        if "maxjob" not in self.opts and self.production_replicas > 1:
+            self.maxjob = self.production_replicas
+
+    def max_cpus(self) -> int:
+        """CPUs used at the same time by the MD job (its replicas run concurrently)."""
+        return int(self.cpu) * min(int(self.maxjob), self.production_replicas)
+
+
+def replica_seeds(seed, replicas: int) -> List[int]:
+    """
+    Reproducible velocity seeds of the production replicas, spawned from the
+    master seed. A single production keeps the master seed itself."""
+    if replicas == 1:
+        return [int(seed)]
+    streams = np.random.SeedSequence(int(seed)).spawn(replicas)
+    return [int(stream.generate_state(1)[0] % 2**31) for stream in streams]
 
 
 class Error(Exception):
@@ -697,20 +713,185 @@ class LenError3(Error):
         super().__init__(self.message)
 
 
+class ASLError(Error):
+    """
+    Custom error class for ASL selections that the in-process evaluator does not support."""
+
+    def __init__(self, asl, message="Unsupported ASL selection "):
+        self.asl = asl
+        self.message = f"{message}'{asl}'"
+        super().__init__(self.message)
+
+
+INDENTATION = {
+    0: ("", " " * 3),
+    1: (" " * 3, " " * 7),
+    2: (" " * 7, " " * 11),
+}
+
+
 def identation(indentvar: int = 0) -> Tuple[str, str]:
-    indent = indentvar
-    if indentvar == 0:
-        outer_space = " " * (indent - 1)
-        inner_space = " " * (indent + 4 - 1)
-    elif indentvar == 1:
-        outer_space = " " * (indent + 2)
-        inner_space = " " * (indent + 6)
-    elif indentvar == 2:
-        outer_space = " " * (indent + 5)
-        inner_space = " " * (indent + 9)
-    else:
+    if indentvar not in INDENTATION:
         print("Error: indentation is not 0 or 1")
-    return outer_space, inner_space
+    return INDENTATION[indentvar]
+
+
+class Document:
+    """Text of an .msj/.cfg file, assembled in memory and written with a single call."""
+
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+
+    def line(self, *values: object) -> None:
+        self.lines.append(" ".join(str(value) for value in values))
+
+    def render(self) -> str:
+        return "".join(line + "\n" for line in self.lines)
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf8") as fd:
+            fd.write(self.render())
+
+
+@dataclass
+class Restraint:
+    """A restraint of a stage: type suffix (pos, dist, ang, imp), ASLs, force and r0/theta0/phi0."""
+
+    kind: str
+    name: str
+    atoms: List[str]
+    force: str
+    constant: Optional[str] = None
+
+
+# A setting of a stage: one value, the lines of a value written on several lines
+# (effect_if), or the settings of a block of the ensemble (brownie).
+SettingValue: TypeAlias = Union[str, int, float, List[str], List[Tuple[str, str]]]
+Setting: TypeAlias = Tuple[str, SettingValue]
+
+
+@dataclass
+class Stage:
+    """A simulate block of the .msj file, with its lines in the order they are written."""
+
+    name: str
+    settings: List[Setting]
+    ensemble: List[Setting] = field(default_factory=list)
+    restraints: List[Restraint] = field(default_factory=list)
+    trailer: List[Setting] = field(default_factory=list)
+    # Settings of parallel subjobs, written as a list of blocks (simulate [...])
+    blocks: List[List[Setting]] = field(default_factory=list)
+    # Restraint files (type suffix, file), read while the stage is written
+    restraint_files: List[Tuple[str, str]] = field(default_factory=list)
+    # Additional stages align their ensemble and restraint settings differently
+    additional: bool = False
+
+
+# An atom of a restraint file given by its number instead of an ASL.
+ATOM_NUMBER = re.compile(r"\d+(\.0*)?")
+
+
+def restraint_atom(atom: str) -> str:
+    """The ASL of an atom of a restraint file, which may be given by its number."""
+    if ATOM_NUMBER.fullmatch(atom):
+        return f"atom.num {int(float(atom))}"
+    return atom
+
+
+def read_restraint_file(file: str, kind: str, name: str) -> Iterator[Restraint]:
+    """
+    Yield the restraints of a .csv or .npy file, one per row: the ASL (or atom
+    number) of every atom, the force constant and the r0/theta0/phi0 value of the
+    non-positional types. Lines of a .csv file starting with # are comments."""
+    _, size, constant = RESTRAINT_TYPES[kind]
+    columns = size + 1 + (constant is not None)
+    with contextlib.ExitStack() as stack:
+        if file.endswith(".npy"):
+            array = np.atleast_2d(np.load(file, mmap_mode="r"))
+            rows = (row.tolist() for row in array)
+        else:
+            fd = stack.enter_context(open(file, "r", encoding="utf8", newline=""))
+            rows = csv.reader(
+                line
+                for line in fd
+                if line.strip() and not line.lstrip().startswith("#")
+            )
+        for number, row in enumerate(rows, 1):
+            if len(row) != columns:
+                raise ValueError(
+                    f"Row {number} of the restraint file {file} has {len(row)} values, {columns} expected: {size} atoms, the force"
+                    + (f" and {constant}" if constant is not None else "")
+                )
+            values = [str(value).strip() for value in row]
+            for value in values[size:]:
+                try:
+                    float(value)
+                except ValueError:
+                    raise ValueError(
+                        f"Row {number} of the restraint file {file} has '{value}' as the force"
+                        + (f" or {constant}" if constant is not None else "")
+                        + ", a number expected"
+                    ) from None
+            yield Restraint(
+                kind,
+                name,
+                [restraint_atom(atom) for atom in values[:size]],
+                values[size],
+                values[size + 1] if constant is not None else None,
+            )
+
+
+EFFECT_GPU = ['[["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']']
+EFFECT_ANNEALING_GPU = [
+    '[["@*.*.annealing"] \'annealing = off temperature = "@*.*.temperature[0][0]"\'',
+    '["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']',
+]
+BROWNIE = [("delta_max", "0.1")]
+
+# Lines of the relaxation stages: effect_if, simulate settings, ensemble settings
+# and settings written after the restraints. stage3 has its own layout when NVT.
+RELAXATION_LAYOUTS: Dict[str, Tuple[Optional[List[str]], str, str, str]] = {
+    "stage1": (
+        None,
+        "title annealing time timestep temperature",
+        "class method brownie",
+        "",
+    ),
+    "stage2": (
+        EFFECT_GPU,
+        "title effect_if annealing time timestep temperature",
+        "class method thermostat.tau",
+        "randomize_velocity.interval eneseq.interval trajectory.center",
+    ),
+    "stage3": (
+        EFFECT_GPU,
+        "title effect_if annealing temperature time",
+        "class method thermostat.tau barostat.tau",
+        "randomize_velocity.interval eneseq.interval trajectory.center",
+    ),
+    "stage3_NVT": (
+        EFFECT_ANNEALING_GPU,
+        "title effect_if time",
+        "class method thermostat.tau",
+        "eneseq.interval trajectory.center",
+    ),
+    "stage4": (
+        EFFECT_ANNEALING_GPU,
+        "title effect_if time temperature",
+        "class method thermostat.tau barostat.tau",
+        "randomize_velocity.interval eneseq.interval trajectory.center",
+    ),
+    "stage5": (
+        EFFECT_ANNEALING_GPU,
+        "title effect_if time temperature",
+        "class method thermostat.tau barostat.tau",
+        "eneseq.interval trajectory.center",
+    ),
+}
+
+
+def enabled(value) -> bool:
+    return str(value).lower() in ["yes", "on", "true"]
 
 
 class Protocol:
@@ -719,6 +900,7 @@ class Protocol:
         file: str = None,
         builder_opts: BuilderOptions = None,
         protocol_opts: ProtocolOptions = None,
+        input_cms: Optional[str] = None,
     ) -> None:
         self.builder_opts = builder_opts
         self.p_opts = protocol_opts
@@ -730,2059 +912,654 @@ class Protocol:
         self.production = self.p_opts.production
         self.file = file
         self.basename = builder_opts.basename
+        if input_cms is None:
+            input_cms = self.basename + "_preparation" + "-out.cms"
+        self.input_cms = input_cms
+        # Restraints of the additional stages, by stage name and restraint type
+        self.restraint_partitions: Dict[Tuple[str, str], List[List[Restraint]]] = {}
+        # Contacts of the input structure, by contact type
+        self.contact_maps: Dict[str, List[Tuple[int, int, float]]] = {}
+        # Atoms of the weighted restraint classes, by mode and number of classes
+        self.weighted_maps: Dict[Tuple[str, int], List[np.ndarray]] = {}
+        # Compacted restraints, by stage name and additional stage index
+        self.compacted: Dict[Tuple[str, Optional[int]], List[Restraint]] = {}
         # self.outputname = self.builder_opts.outputname
 
     def write(self) -> None:
         path_preparation = str(self.basename + "_md.msj")
+        print("Preparing input files for MD protocol...")
+        self.msj_document().write(path_preparation)
+        if enabled(self.p_opts.production):
+            self.write_cfg_file()
+
+    def render_msj(self) -> str:
+        """Return the text of the _md.msj file."""
+        return self.msj_document().render()
+
+    def msj_document(self) -> Document:
         outer_space, inner_space = identation(0)
         eq = "= "
         q = '"'
-        with open(path_preparation, "w", encoding="utf8") as fd:
-            print("Preparing input files for MD protocol...")
-            print("# Desmond protocol", file=fd)
-            print("# Time units are in ps", file=fd)
-            print("# Energy units are in kcal/mol", file=fd)
-            print(file=fd)
-            print(f"{outer_space}task {'{'}", file=fd)
-            # outer_space, inner_space = identation(1)
-            print(f"{inner_space} {'task':<16}{eq}{q}{'desmond:auto'}{q}", file=fd)
-            print(f"{inner_space} {'set_family':<16}{eq}{'{'}", file=fd)
-
-            outer_space, inner_space = identation(2)
-            print(f"{outer_space} {'desmond':<12}{eq}{'{'}", file=fd)
-            print(f"{inner_space} {'checkpt.write_last_step':<16} {eq}{'no'}", file=fd)
-            print(f"{outer_space} {'}'}", file=fd)
+        stages = self.build_stages()
+        doc = Document()
+        doc.line("# Desmond protocol")
+        doc.line("# Time units are in ps")
+        doc.line("# Energy units are in kcal/mol")
+        doc.line()
+        doc.line(f"{outer_space}task {'{'}")
+        # outer_space, inner_space = identation(1)
+        doc.line(f"{inner_space} {'task':<16}{eq}{q}{'desmond:auto'}{q}")
+        doc.line(f"{inner_space} {'set_family':<16}{eq}{'{'}")
+
+        outer_space, inner_space = identation(2)
+        doc.line(f"{outer_space} {'desmond':<12}{eq}{'{'}")
+        doc.line(f"{inner_space} {'checkpt.write_last_step':<16} {eq}{'no'}")
+        doc.line(f"{outer_space} {'}'}")
+        outer_space, inner_space = identation(0)
+        doc.line(f"{inner_space} {'}'}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line()
+        for stage in stages:
+            self.write_stage(doc, stage)
+        return doc
+
+    def write_stage(self, doc: Document, stage: Stage) -> None:
+        """Add one simulate block of the .msj file to the document."""
+        eq = "= "
+        q = '"'
+        outer_space, inner_space = identation(0)
+        if stage.blocks:
+            doc.line(f"{outer_space}{'simulate':<20}{'['}")
+            outer_space, inner_space = identation(1)
+            for block in stage.blocks:
+                doc.line(f"{outer_space} {'{'}")
+                for key, value in block:
+                    doc.line(f"{inner_space} {key:<12} {eq}{value}")
+                doc.line(f"{outer_space} {'}'}")
             outer_space, inner_space = identation(0)
-            print(f"{inner_space} {'}'}", file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(file=fd)
-            # Stage 1 block
-            if str(self.p_opts.stage1).lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage1_title}{q}",
-                    file=fd,
-                )
-                print(f"{inner_space} {'annealing':<16}{eq}{'off'}", file=fd)
-                print(
-                    f"{inner_space} {'time':<16}{eq}{self.p_opts.stage1_time}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'timestep':<16}{eq}{'['}{self.p_opts.stage1_timestep}{']'}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'temperature':<16}{eq}{self.p_opts.stage1_temp}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'class':<11} {eq}{self.p_opts.stage1_ensemble}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'method':<11} {eq}{self.p_opts.stage1_method}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(2)
-                print(f"{outer_space} {'brownie':<17}{eq}{'{'}", file=fd)
-                print(f"{inner_space} {'delta_max':<12} {eq}{'0.1'}", file=fd)
-                print(f"{outer_space} {'}'}", file=fd)
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'}'}", file=fd)
-                # ==============================================================
-                # Restraints block
-                # ==============================================================
-                # Block for stage1 positional-restraints
-                if (
-                    int(self.p_opts.stage1_restraints_number_pos) != 0
-                    or int(self.p_opts.stage1_restraints_number_dist) != 0
-                    or int(self.p_opts.stage1_restraints_number_ang) != 0
-                    or int(self.p_opts.stage1_restraints_number_imp) != 0
-                ):
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'restraints.new':<16}{eq}{'['}", file=fd)
-                    if int(self.p_opts.stage1_restraints_number_pos) != 0:
-                        atoms, forces = self.set_restraint(
-                            "stage1",
-                            self.p_opts.stage1_restraints_number_pos,
-                            self.p_opts.stage1_restraints_atoms_pos,
-                            self.p_opts.stage1_restraints_forces_pos,
-                            "positional",
-                            None,
-                        )
-                        for i in range(int(self.p_opts.stage1_restraints_number_pos)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_pos}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-
-                    if int(self.p_opts.stage1_restraints_number_dist) != 0:
-                        # Block for stage1 distance-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage1",
-                            self.p_opts.stage1_restraints_number_dist,
-                            self.p_opts.stage1_restraints_atoms_dist,
-                            self.p_opts.stage1_restraints_forces_dist,
-                            "distance",
-                            self.p_opts.stage1_restraints_r0_dist,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage1_restraints_number_dist)):
-
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_dist}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'r0':<11} {eq}{constants[i]}", file=fd
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 2
-                    if int(self.p_opts.stage1_restraints_number_ang) != 0:
-                        # Block for stage1 angle-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage1",
-                            self.p_opts.stage1_restraints_number_ang,
-                            self.p_opts.stage1_restraints_atoms_ang,
-                            self.p_opts.stage1_restraints_forces_ang,
-                            "angle",
-                            self.p_opts.stage1_restraints_theta0_ang,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage1_restraints_number_ang)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_ang}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'theta0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 3
-                    if int(self.p_opts.stage1_restraints_number_imp) != 0:
-                        # Block for stage1 improper-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage1",
-                            self.p_opts.stage1_restraints_number_imp,
-                            self.p_opts.stage1_restraints_atoms_imp,
-                            self.p_opts.stage1_restraints_forces_imp,
-                            "improper",
-                            self.p_opts.stage1_restraints_phi0_imp,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage1_restraints_number_imp)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_imp}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'phi0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 4
+            doc.line(f"{outer_space}{']'}")
+            doc.line()
+            return
+        doc.line(f"{outer_space}{'simulate':<20}{'{'}")
+        for key, value in stage.settings:
+            lines = value if isinstance(value, list) else [value]
+            doc.line(f"{inner_space} {key:<16}{eq}{lines[0]}")
+            for line in lines[1:]:
+                doc.line(f"{inner_space} {' ':<19}{line}")
+        if stage.ensemble:
+            outer_space, inner_space = identation(1)
+            doc.line(f"{outer_space} {'ensemble':<16}{eq}{'{'}")
+            for key, value in stage.ensemble:
+                if isinstance(value, list):
+                    outer_space, inner_space = identation(2)
+                    doc.line(f"{outer_space} {key:<17}{eq}{'{'}")
+                    for sub_key, sub_value in value:
+                        doc.line(f"{inner_space} {sub_key:<12} {eq}{sub_value}")
+                    doc.line(f"{outer_space} {'}'}")
                     outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {']'}", file=fd)
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-            # ==============================================================
-            # Restraints block
-            # ==============================================================
-            # Stage 2 block
-            if self.p_opts.stage2.lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage2_title}{q}",
-                    file=fd,
+                elif stage.additional:
+                    width = 15 if key.endswith(".tau") else 11
+                    doc.line(f"{inner_space} {key:<{width}}{eq}{value}")
+                else:
+                    doc.line(f"{inner_space} {key:<11} {eq}{value}")
+            doc.line(f"{outer_space} {'}'}")
+        if stage.restraints or stage.restraint_files:
+            outer_space, inner_space = identation(1)
+            doc.line(f"{outer_space} {'restraints.new':<16}{eq}{'['}")
+            outer_space, inner_space = identation(2)
+            # Additional stages write the braces and settings of a restraint at the
+            # same level, with wider keys.
+            width, space = 11, " "
+            if stage.additional:
+                _, outer_space = identation(1)
+                inner_space, width, space = outer_space, 16, ""
+            for restraint in itertools.chain(
+                stage.restraints, self.file_restraints(stage.restraint_files)
+            ):
+                atoms = " ".join(f"{q}{atom}{q}" for atom in restraint.atoms)
+                doc.line(f"{outer_space} {'{'}")
+                doc.line(f"{inner_space} {'name':<{width}}{space}{eq}{restraint.name}")
+                doc.line(f"{inner_space} {'atoms':<{width}}{space}{eq}[{atoms}]")
+                doc.line(
+                    f"{inner_space} {'force_constants':<{width}}{space}{eq}[{self.force_constants(restraint)}]"
                 )
-                gpu_text = '[["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text}", file=fd)
-                print(f"{inner_space} {'annealing':<16}{eq}{'off'}", file=fd)
-                print(
-                    f"{inner_space} {'time':<16}{eq}{self.p_opts.stage2_time}",
-                    file=fd,
+                constant = RESTRAINT_TYPES[restraint.kind][2]
+                if constant is not None:
+                    doc.line(
+                        f"{inner_space} {constant:<{width}}{space}{eq}{restraint.constant}"
+                    )
+                doc.line(f"{outer_space} {'}'}")
+            outer_space, inner_space = identation(1)
+            doc.line(f"{outer_space} {']'}")
+        if stage.trailer:
+            outer_space, inner_space = identation(0)
+            doc.line()
+            for key, value in stage.trailer:
+                doc.line(f"{inner_space} {key:<29} {eq}{value}")
+        outer_space, inner_space = identation(0)
+        doc.line(f"{outer_space}{'}'}")
+        doc.line()
+
+    @staticmethod
+    def force_constants(restraint: Restraint) -> str:
+        # Positional restraints take one force constant per axis.
+        if restraint.kind == "pos":
+            return f"{restraint.force} {restraint.force} {restraint.force}"
+        return f"{restraint.force}"
+
+    def build_stages(self) -> List[Stage]:
+        """Return the simulate blocks of the protocol, in order, in one pass over the options."""
+        p_opts = self.p_opts
+        q = '"'
+        stages = []
+        for name in RELAXATION_DEFAULTS:
+            if not enabled(getattr(p_opts, name)):
+                continue
+            values = {
+                key: getattr(p_opts, f"{name}_{key}")
+                for key in RELAXATION_KEYS + ("timestep",)
+                if hasattr(p_opts, f"{name}_{key}")
+            }
+            layout = name
+            title = f"{values['method']} {values['ensemble']}, T = {values['temp']} K, {values['time']}ps"
+            if name == "stage3" and values["ensemble"] == "NVT":
+                layout = "stage3_NVT"
+                title = f"{values['method']} {values['ensemble']}, {values['time']}ps"
+            effect_if, settings, ensemble, trailer = RELAXATION_LAYOUTS[layout]
+            lines = {
+                "title": f"{q}{title}{q}",
+                "effect_if": effect_if,
+                "annealing": "off",
+                "time": values["time"],
+                "timestep": f"[{values.get('timestep')}]",
+                "temperature": values["temp"],
+                "class": values["ensemble"],
+                "method": values["method"],
+                "thermostat.tau": values["thermostat_tau"],
+                "barostat.tau": values["barostat_tau"],
+                "brownie": BROWNIE,
+                "randomize_velocity.interval": "1.0",
+                "eneseq.interval": "0.3",
+                "trajectory.center": values["traj_center"],
+            }
+            stages.append(
+                Stage(
+                    name,
+                    [(key, lines[key]) for key in settings.split()],
+                    [(key, lines[key]) for key in ensemble.split()],
+                    self.stage_restraints(name),
+                    [(key, lines[key]) for key in trailer.split()],
+                    restraint_files=self.restraint_files(name),
                 )
-                print(
-                    f"{inner_space} {'timestep':<16}{eq}{'['}{self.p_opts.stage2_timestep}{']'}",
-                    file=fd,
+            )
+        stages += self.additional_stages()
+        if enabled(p_opts.production) and p_opts.production_replicas > 1:
+            stages.append(
+                Stage(
+                    "production",
+                    [],
+                    blocks=[
+                        [
+                            ("cfg_file", f"{q}{cfg_file}{q}"),
+                            ("jobname", f"{q}$MASTERJOBNAME-replica{i}{q}"),
+                            ("dir", f"{q}.{q}"),
+                            ("compress", f"{q}{q}"),
+                        ]
+                        for i, cfg_file in enumerate(self.cfg_files(), 1)
+                    ],
                 )
-                print(
-                    f"{inner_space} {'temperature':<16}{eq}{self.p_opts.stage2_temp}",
-                    file=fd,
+            )
+        elif enabled(p_opts.production):
+            stages.append(
+                Stage(
+                    "production",
+                    [
+                        ("cfg_file", f"{q}{self.basename}_md.cfg{q}"),
+                        ("jobname", f"{q}$MASTERJOBNAME{q}"),
+                        ("dir", f"{q}.{q}"),
+                        ("compress", f"{q}{q}"),
+                    ],
                 )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'class':<11} {eq}{self.p_opts.stage2_ensemble}",
-                    file=fd,
+            )
+        return stages
+
+    def additional_stages(self) -> List[Stage]:
+        """Return the additional stages; each option has one value or one per stage."""
+        p_opts = self.p_opts
+        if p_opts.additional_stages is None:
+            return []
+        number = int(p_opts.additional_stages)
+        options = {
+            "time": p_opts.additional_stage_times,
+            "temperature": p_opts.additional_stage_temps,
+            "class": p_opts.additional_stage_ensembles,
+            "method": p_opts.additional_stage_methods,
+            "thermostat.tau": p_opts.additional_stage_thermostat_tau,
+            "barostat.tau": p_opts.additional_stage_barostat_tau,
+        }
+        values = {
+            key: str(value).split(",")
+            for key, value in options.items()
+            if value is not None
+        }
+        stages = []
+        for stage in range(number):
+
+            def lines(keys: List[str]) -> List[Setting]:
+                return [
+                    (
+                        key,
+                        values[key][0] if len(values[key]) == 1 else values[key][stage],
+                    )
+                    for key in keys
+                    if key in values and len(values[key]) in [1, number]
+                ]
+
+            stages.append(
+                Stage(
+                    f"additional_stage_{stage + 1}",
+                    [
+                        ("title", f'"Additional stage = {stage + 1}"'),
+                        ("effect_if", EFFECT_ANNEALING_GPU),
+                    ]
+                    + lines(["time", "temperature"]),
+                    lines(["class", "method", "thermostat.tau", "barostat.tau"]),
+                    self.stage_restraints("additional_stage", stage),
+                    [
+                        ("eneseq.interval", "0.3"),
+                        ("trajectory.center", p_opts.additional_stage_traj_center),
+                    ],
+                    restraint_files=self.restraint_files("additional_stage", stage),
+                    additional=True,
                 )
-                print(
-                    f"{inner_space} {'method':<11} {eq}{self.p_opts.stage2_method}",
-                    file=fd,
+            )
+        return stages
+
+    def stage_restraints(
+        self, name: str, stage: Optional[int] = None
+    ) -> List[Restraint]:
+        """
+        Return the restraints of a stage. Additional stages (stage is their index)
+        take their slice of the comma-separated additional_stage_restraints_* lists."""
+        p_opts = self.p_opts
+        restraints = []
+        for kind in RESTRAINT_TYPES:
+            number = getattr(p_opts, f"{name}_restraints_number_{kind}")
+            if stage is None:
+                if int(number) != 0:
+                    restraints += self.set_restraint(name, kind, int(number), True)
+            elif number != 0:
+                # The lists of the additional stages are partitioned once.
+                if (name, kind) not in self.restraint_partitions:
+                    self.restraint_partitions[(name, kind)] = self.partition_restraints(
+                        name, kind, number
+                    )
+                restraints += self.restraint_partitions[(name, kind)][stage]
+        restraints += self.contact_restraints(name, stage)
+        restraints += self.weighted_restraints(name, stage)
+        if enabled(p_opts.restraints_compact):
+            return self.compact_restraints(restraints, name, stage)
+        return restraints
+
+    def compact_restraints(
+        self, restraints: List[Restraint], name: str, stage: Optional[int] = None
+    ) -> List[Restraint]:
+        """
+        Return the restraints of a stage without duplicates, with the positional
+        restraints of the same force merged into one restraint of the union of their
+        atoms. The number of terms eliminated is printed once per stage."""
+        key = (name, stage)
+        if key in self.compacted:
+            return self.compacted[key]
+        compacted = merge_restraints(restraints)
+        self.compacted[key] = compacted
+        eliminated = len(restraints) - len(compacted)
+        if eliminated:
+            label = name if stage is None else f"{name}_{stage + 1}"
+            print(
+                f"Restraint compaction ({label}): "
+                f"{eliminated} of {len(restraints)} terms eliminated"
+            )
+        return compacted
+
+    def contact_restraints(
+        self, name: str, stage: Optional[int] = None
+    ) -> List[Restraint]:
+        """
+        Return the distance restraints of a stage on the contacts of the input
+        structure, with r0 at the observed distance. The contact map is computed
+        once per contact type."""
+        p_opts = self.p_opts
+        kinds = str(getattr(p_opts, f"{name}_restraints_contacts")).split(",")
+        forces = str(getattr(p_opts, f"{name}_restraints_contacts_force")).split(",")
+        kind = kinds[0 if stage is None or len(kinds) == 1 else stage].strip().lower()
+        force = forces[0 if stage is None or len(forces) == 1 else stage].strip()
+        if kind == "none":
+            return []
+        if kind not in self.contact_maps:
+            try:
+                self.contact_maps[kind] = contact_map(
+                    self.builder_opts.atom_table,
+                    kind,
+                    float(p_opts.contacts_cutoff),
+                    p_opts.contacts_atoms,
+                    p_opts.contacts_partner,
+                    int(p_opts.contacts_separation),
                 )
-                print(
-                    f"{inner_space} {'thermostat.tau':<11} {eq}{self.p_opts.stage2_thermostat_tau}",
-                    file=fd,
+            except ASLError as e_rror:
+                print(f"Error: {e_rror.args[0]}")
+                print("Please check contacts_atoms and contacts_partner.")
+                sys.exit()
+            print(f"Contact map ({kind}): {len(self.contact_maps[kind])} contacts")
+        return [
+            Restraint(
+                "dist",
+                p_opts.name_dist,
+                [f"atom.num {first}", f"atom.num {second}"],
+                force,
+                f"{distance:.3f}",
+            )
+            for first, second, distance in self.contact_maps[kind]
+        ]
+
+    def weighted_restraints(
+        self, name: str, stage: Optional[int] = None
+    ) -> List[Restraint]:
+        """
+        Return the positional restraints of a stage weighted by B-factor or pLDDT:
+        one restraint per class of residues, with the force of its class. The
+        classes are computed once per mode and number of classes."""
+        p_opts = self.p_opts
+        modes = str(getattr(p_opts, f"{name}_restraints_weighted")).split(",")
+        forces = str(getattr(p_opts, f"{name}_restraints_weighted_forces")).split(",")
+        mode = modes[0 if stage is None or len(modes) == 1 else stage].strip().lower()
+        forces = forces[0 if stage is None or len(forces) == 1 else stage].split()
+        if mode == "none":
+            return []
+        key = (mode, len(forces))
+        if key not in self.weighted_maps:
+            edges = None
+            if p_opts.weighted_edges is not None:
+                edges = [float(edge) for edge in str(p_opts.weighted_edges).split(",")]
+            try:
+                self.weighted_maps[key] = weighted_classes(
+                    self.builder_opts.atom_table,
+                    mode,
+                    len(forces),
+                    p_opts.weighted_column,
+                    p_opts.weighted_atoms,
+                    edges,
                 )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'}'}", file=fd)
-                # Restraints block
-                # ==============================================================
-                # Restraints block
-                # ==============================================================
-                # Block for stage2 positional-restraints
-                if (
-                    int(self.p_opts.stage2_restraints_number_pos) != 0
-                    or int(self.p_opts.stage2_restraints_number_dist) != 0
-                    or int(self.p_opts.stage2_restraints_number_ang) != 0
-                    or int(self.p_opts.stage2_restraints_number_imp) != 0
-                ):
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'restraints.new':<16}{eq}{'['}", file=fd)
-                    if int(self.p_opts.stage2_restraints_number_pos) != 0:
-                        atoms, forces = self.set_restraint(
-                            "stage2",
-                            self.p_opts.stage2_restraints_number_pos,
-                            self.p_opts.stage2_restraints_atoms_pos,
-                            self.p_opts.stage2_restraints_forces_pos,
-                            "positional",
-                            None,
-                        )
-                        for i in range(int(self.p_opts.stage2_restraints_number_pos)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_pos}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-
-                    if int(self.p_opts.stage2_restraints_number_dist) != 0:
-                        # Block for stage2 distance-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage2",
-                            self.p_opts.stage2_restraints_number_dist,
-                            self.p_opts.stage2_restraints_atoms_dist,
-                            self.p_opts.stage2_restraints_forces_dist,
-                            "distance",
-                            self.p_opts.stage2_restraints_r0_dist,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage2_restraints_number_dist)):
-
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_dist}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'r0':<11} {eq}{constants[i]}", file=fd
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 2
-                    if int(self.p_opts.stage2_restraints_number_ang) != 0:
-                        # Block for stage2 angle-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage2",
-                            self.p_opts.stage2_restraints_number_ang,
-                            self.p_opts.stage2_restraints_atoms_ang,
-                            self.p_opts.stage2_restraints_forces_ang,
-                            "angle",
-                            self.p_opts.stage2_restraints_theta0_ang,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage2_restraints_number_ang)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_ang}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'theta0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 3
-                    if int(self.p_opts.stage2_restraints_number_imp) != 0:
-                        # Block for stage2 improper-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage2",
-                            self.p_opts.stage2_restraints_number_imp,
-                            self.p_opts.stage2_restraints_atoms_imp,
-                            self.p_opts.stage2_restraints_forces_imp,
-                            "improper",
-                            self.p_opts.stage2_restraints_phi0_imp,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage2_restraints_number_imp)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_imp}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'phi0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 4
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {']'}", file=fd)
-                    # End of restrains block
-                print(file=fd)
-                # ==============================================================
-                # Restraints block END
-                # ==============================================================
-                outer_space, inner_space = identation(0)
-                print(
-                    f"{inner_space} {'randomize_velocity.interval':<29} {eq}{'1.0'}",
-                    file=fd,
-                )
-                print(f"{inner_space} {'eneseq.interval':<29} {eq}{'0.3'}", file=fd)
-
-                print(
-                    f"{inner_space} {'trajectory.center':<29} {eq}{self.p_opts.stage2_traj_center}",
-                    file=fd,
-                )
-
-                print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-            # Stage 3 block
-            if self.p_opts.stage3.lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                if self.p_opts.stage3_ensemble != "NVT":
-                    print(
-                        f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage3_title}{q}",
-                        file=fd,
-                    )
-                else:
-                    self.p_opts.stage3_title = f"{self.p_opts.stage3_method} {self.p_opts.stage3_ensemble}, {self.p_opts.stage3_time}ps"
-                    print(
-                        f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage3_title}{q}",
-                        file=fd,
-                    )
-
-                if self.p_opts.stage3_ensemble != "NVT":
-                    gpu_text = '[["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                    print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text}", file=fd)
-                    print(f"{inner_space} {'annealing':<16}{eq}{'off'}", file=fd)
-                    print(
-                        f"{inner_space} {'temperature':<16}{eq}{self.p_opts.stage3_temp}",
-                        file=fd,
-                    )
-                else:
-                    gpu_text1 = '[["@*.*.annealing"] \'annealing = off temperature = "@*.*.temperature[0][0]"\''
-                    gpu_text2 = '["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                    print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text1}", file=fd)
-                    print(f"{inner_space} {' ':<19}{gpu_text2}", file=fd)
-
-                print(
-                    f"{inner_space} {'time':<16}{eq}{self.p_opts.stage3_time}",
-                    file=fd,
-                )
-
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'class':<11} {eq}{self.p_opts.stage3_ensemble}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'method':<11} {eq}{self.p_opts.stage3_method}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'thermostat.tau':<11} {eq}{self.p_opts.stage3_thermostat_tau}",
-                    file=fd,
-                )
-                if self.p_opts.stage3_ensemble != "NVT":
-                    print(
-                        f"{inner_space} {'barostat.tau':<11} {eq}{self.p_opts.stage3_barostat_tau}",
-                        file=fd,
-                    )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'}'}", file=fd)
-                # ==============================================================
-                # Restraints block
-                # ==============================================================
-                # Block for stage3 positional-restraints
-                if (
-                    int(self.p_opts.stage3_restraints_number_pos) != 0
-                    or int(self.p_opts.stage3_restraints_number_dist) != 0
-                    or int(self.p_opts.stage3_restraints_number_ang) != 0
-                    or int(self.p_opts.stage3_restraints_number_imp) != 0
-                ):
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'restraints.new':<16}{eq}{'['}", file=fd)
-                    if int(self.p_opts.stage3_restraints_number_pos) != 0:
-                        atoms, forces = self.set_restraint(
-                            "stage3",
-                            self.p_opts.stage3_restraints_number_pos,
-                            self.p_opts.stage3_restraints_atoms_pos,
-                            self.p_opts.stage3_restraints_forces_pos,
-                            "positional",
-                            None,
-                        )
-                        for i in range(int(self.p_opts.stage3_restraints_number_pos)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_pos}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-
-                    if int(self.p_opts.stage3_restraints_number_dist) != 0:
-                        # Block for stage3 distance-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage3",
-                            self.p_opts.stage3_restraints_number_dist,
-                            self.p_opts.stage3_restraints_atoms_dist,
-                            self.p_opts.stage3_restraints_forces_dist,
-                            "distance",
-                            self.p_opts.stage3_restraints_r0_dist,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage3_restraints_number_dist)):
-
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_dist}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'r0':<11} {eq}{constants[i]}", file=fd
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 2
-                    if int(self.p_opts.stage3_restraints_number_ang) != 0:
-                        # Block for stage3 angle-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage3",
-                            self.p_opts.stage3_restraints_number_ang,
-                            self.p_opts.stage3_restraints_atoms_ang,
-                            self.p_opts.stage3_restraints_forces_ang,
-                            "angle",
-                            self.p_opts.stage3_restraints_theta0_ang,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage3_restraints_number_ang)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_ang}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'theta0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 3
-                    if int(self.p_opts.stage3_restraints_number_imp) != 0:
-                        # Block for stage3 improper-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage3",
-                            self.p_opts.stage3_restraints_number_imp,
-                            self.p_opts.stage3_restraints_atoms_imp,
-                            self.p_opts.stage3_restraints_forces_imp,
-                            "improper",
-                            self.p_opts.stage3_restraints_phi0_imp,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage3_restraints_number_imp)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_imp}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'phi0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 4
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {']'}", file=fd)
-                print(file=fd)
-                # ==============================================================
-                # Restraints block end
-                # ==============================================================
-                outer_space, inner_space = identation(0)
-
-                if self.p_opts.stage3_ensemble != "NVT":
-                    print(
-                        f"{inner_space} {'randomize_velocity.interval':<29} {eq}{'1.0'}",
-                        file=fd,
-                    )
-                print(f"{inner_space} {'eneseq.interval':<29} {eq}{'0.3'}", file=fd)
-                print(
-                    f"{inner_space} {'trajectory.center':<29} {eq}{self.p_opts.stage3_traj_center}",
-                    file=fd,
-                )
-                print(f"{outer_space}{'}'}", file=fd)
-                # solvate pocket block
-                ##outer_space, inner_space = identation(0)
-                # print(file=fd)
-                ##print(f"{outer_space}{'solvate_pocket':<16}{'{'}", file=fd)
-                # print(
-                ##    f"{inner_space} {'should_skip':<11} {eq}{'true'}",
-                # file=fd,
-                # )
-                # print(
-                ##    f"{inner_space} {'ligand_file':<11} {eq}{'?'}",
-                # file=fd,
-                # )
-                ##print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-            # Stage 4 block
-            if self.p_opts.stage4.lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage4_title}{q}",
-                    file=fd,
-                )
-                gpu_text1 = '[["@*.*.annealing"] \'annealing = off temperature = "@*.*.temperature[0][0]"\''
-                gpu_text2 = '["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text1}", file=fd)
-                print(f"{inner_space} {' ':<19}{gpu_text2}", file=fd)
-
-                print(
-                    f"{inner_space} {'time':<16}{eq}{self.p_opts.stage4_time}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'temperature':<16}{eq}{self.p_opts.stage4_temp}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'class':<11} {eq}{self.p_opts.stage4_ensemble}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'method':<11} {eq}{self.p_opts.stage4_method}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'thermostat.tau':<11} {eq}{self.p_opts.stage4_thermostat_tau}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'barostat.tau':<11} {eq}{self.p_opts.stage4_barostat_tau}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'}'}", file=fd)
-                # ==============================================================
-                # Restraints block
-                # ==============================================================
-                # Block for stage4 positional-restraints
-                if (
-                    int(self.p_opts.stage4_restraints_number_pos) != 0
-                    or int(self.p_opts.stage4_restraints_number_dist) != 0
-                    or int(self.p_opts.stage4_restraints_number_ang) != 0
-                    or int(self.p_opts.stage4_restraints_number_imp) != 0
-                ):
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'restraints.new':<16}{eq}{'['}", file=fd)
-                    if int(self.p_opts.stage4_restraints_number_pos) != 0:
-                        atoms, forces = self.set_restraint(
-                            "stage4",
-                            self.p_opts.stage4_restraints_number_pos,
-                            self.p_opts.stage4_restraints_atoms_pos,
-                            self.p_opts.stage4_restraints_forces_pos,
-                            "positional",
-                            None,
-                        )
-                        for i in range(int(self.p_opts.stage4_restraints_number_pos)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_pos}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-
-                    if int(self.p_opts.stage4_restraints_number_dist) != 0:
-                        # Block for stage4 distance-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage4",
-                            self.p_opts.stage4_restraints_number_dist,
-                            self.p_opts.stage4_restraints_atoms_dist,
-                            self.p_opts.stage4_restraints_forces_dist,
-                            "distance",
-                            self.p_opts.stage4_restraints_r0_dist,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage4_restraints_number_dist)):
-
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_dist}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'r0':<11} {eq}{constants[i]}", file=fd
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 2
-                    if int(self.p_opts.stage4_restraints_number_ang) != 0:
-                        # Block for stage4 angle-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage4",
-                            self.p_opts.stage4_restraints_number_ang,
-                            self.p_opts.stage4_restraints_atoms_ang,
-                            self.p_opts.stage4_restraints_forces_ang,
-                            "angle",
-                            self.p_opts.stage4_restraints_theta0_ang,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage4_restraints_number_ang)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_ang}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'theta0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 3
-                    if int(self.p_opts.stage4_restraints_number_imp) != 0:
-                        # Block for stage4 improper-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage4",
-                            self.p_opts.stage4_restraints_number_imp,
-                            self.p_opts.stage4_restraints_atoms_imp,
-                            self.p_opts.stage4_restraints_forces_imp,
-                            "improper",
-                            self.p_opts.stage4_restraints_phi0_imp,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage4_restraints_number_imp)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_imp}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'phi0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 4
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {']'}", file=fd)
-                print(file=fd)
-                # ==============================================================
-                # Restraints block end
-                # ==============================================================
-                outer_space, inner_space = identation(0)
-                print(
-                    f"{inner_space} {'randomize_velocity.interval':<29} {eq}{'1.0'}",
-                    file=fd,
-                )
-                print(f"{inner_space} {'eneseq.interval':<29} {eq}{'0.3'}", file=fd)
-                print(
-                    f"{inner_space} {'trajectory.center':<29} {eq}{self.p_opts.stage4_traj_center}",
-                    file=fd,
-                )
-                print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-            # Stage 5 block
-            if self.p_opts.stage5.lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'title':<16}{eq}{q}{self.p_opts.stage5_title}{q}",
-                    file=fd,
-                )
-                gpu_text1 = '[["@*.*.annealing"] \'annealing = off temperature = "@*.*.temperature[0][0]"\''
-                gpu_text2 = '["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text1}", file=fd)
-                print(f"{inner_space} {' ':<19}{gpu_text2}", file=fd)
-                print(
-                    f"{inner_space} {'time':<16}{eq}{self.p_opts.stage5_time}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'temperature':<16}{eq}{self.p_opts.stage5_temp}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'class':<11} {eq}{self.p_opts.stage5_ensemble}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'method':<11} {eq}{self.p_opts.stage5_method}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'thermostat.tau':<11} {eq}{self.p_opts.stage5_thermostat_tau}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'barostat.tau':<11} {eq}{self.p_opts.stage5_barostat_tau}",
-                    file=fd,
-                )
-                outer_space, inner_space = identation(1)
-                print(f"{outer_space} {'}'}", file=fd)
-                ### Restraints block START ###
-                # Block for stage5 positional-restraints
-                if (
-                    int(self.p_opts.stage5_restraints_number_pos) != 0
-                    or int(self.p_opts.stage5_restraints_number_dist) != 0
-                    or int(self.p_opts.stage5_restraints_number_ang) != 0
-                    or int(self.p_opts.stage5_restraints_number_imp) != 0
-                ):
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'restraints.new':<16}{eq}{'['}", file=fd)
-                    if int(self.p_opts.stage5_restraints_number_pos) != 0:
-                        atoms, forces = self.set_restraint(
-                            "stage5",
-                            self.p_opts.stage5_restraints_number_pos,
-                            self.p_opts.stage5_restraints_atoms_pos,
-                            self.p_opts.stage5_restraints_forces_pos,
-                            "positional",
-                            None,
-                        )
-                        for i in range(int(self.p_opts.stage5_restraints_number_pos)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_pos}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                    if int(self.p_opts.stage5_restraints_number_dist) != 0:
-                        # Block for stage5 distance-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage5",
-                            self.p_opts.stage5_restraints_number_dist,
-                            self.p_opts.stage5_restraints_atoms_dist,
-                            self.p_opts.stage5_restraints_forces_dist,
-                            "distance",
-                            self.p_opts.stage5_restraints_r0_dist,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage5_restraints_number_dist)):
-
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_dist}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'r0':<11} {eq}{constants[i]}", file=fd
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 2
-                    if int(self.p_opts.stage5_restraints_number_ang) != 0:
-                        # Block for stage5 angle-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage5",
-                            self.p_opts.stage5_restraints_number_ang,
-                            self.p_opts.stage5_restraints_atoms_ang,
-                            self.p_opts.stage5_restraints_forces_ang,
-                            "angle",
-                            self.p_opts.stage5_restraints_theta0_ang,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage5_restraints_number_ang)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_ang}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'theta0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 3
-                    if int(self.p_opts.stage5_restraints_number_imp) != 0:
-                        # Block for stage5 improper-restraints
-                        outer_space, inner_space = identation(1)
-                        atoms, forces, constants = self.set_restraint(
-                            "stage5",
-                            self.p_opts.stage5_restraints_number_imp,
-                            self.p_opts.stage5_restraints_atoms_imp,
-                            self.p_opts.stage5_restraints_forces_imp,
-                            "improper",
-                            self.p_opts.stage5_restraints_phi0_imp,
-                        )
-                        j = 0
-                        for i in range(int(self.p_opts.stage5_restraints_number_imp)):
-                            outer_space, inner_space = identation(2)
-                            print(f"{outer_space} {'{'}", file=fd)
-                            print(
-                                f"{inner_space} {'name':<11} {eq}{self.p_opts.name_imp}",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'force_constants':<11} {eq}[{forces[i]}]",
-                                file=fd,
-                            )
-                            print(
-                                f"{inner_space} {'phi0':<11} {eq}{constants[i]}",
-                                file=fd,
-                            )
-                            print(f"{outer_space} {'}'}", file=fd)
-                            j += 4
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {']'}", file=fd)
-                print(file=fd)
-                ### Restraints block END ###
-                outer_space, inner_space = identation(0)
-                print(f"{inner_space} {'eneseq.interval':<29} {eq}{'0.3'}", file=fd)
-                print(
-                    f"{inner_space} {'trajectory.center':<29} {eq}{self.p_opts.stage5_traj_center}",
-                    file=fd,
-                )
-                print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-            # Additional stages block
-            if self.p_opts.additional_stages != None:
-                stages = int(self.p_opts.additional_stages)
-                stages_time = list(str(self.p_opts.additional_stage_times).split(","))
-                stages_temp = list(str(self.p_opts.additional_stage_temps).split(","))
-                stages_ensemble = list(
-                    str(self.p_opts.additional_stage_ensembles).split(",")
-                )
-                stages_method = list(
-                    str(self.p_opts.additional_stage_methods).split(",")
-                )
-                stages_thermostat_tau = list(
-                    str(self.p_opts.additional_stage_thermostat_tau).split(",")
-                )
-                stages_barostat_tau = list(
-                    str(self.p_opts.additional_stage_barostat_tau).split(",")
-                )
-
-                for stage in range(1, stages + 1):
-                    outer_space, inner_space = identation(0)
-                    print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                    print(
-                        f"{inner_space} {'title':<16}{eq}{q}Additional stage = {stage}{q}",
-                        file=fd,
-                    )
-                    gpu_text1 = '[["@*.*.annealing"] \'annealing = off temperature = "@*.*.temperature[0][0]"\''
-                    gpu_text2 = '["==" "-gpu" "@*.*.jlaunch_opt[-1]"] \'ensemble.method = Langevin\']'
-                    print(f"{inner_space} {'effect_if':<16}{eq}{gpu_text1}", file=fd)
-                    print(f"{inner_space} {' ':<19}{gpu_text2}", file=fd)
-                    if (
-                        self.p_opts.additional_stage_times != None
-                        and len(stages_time) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'time':<16}{eq}{self.p_opts.additional_stage_times}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_times != None
-                        and len(stages_time) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'time':<16}{eq}{stages_time[stage-1]}",
-                            file=fd,
-                        )
-                    if (
-                        self.p_opts.additional_stage_temps != None
-                        and len(stages_time) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'temperature':<16}{eq}{self.p_opts.additional_stage_temps}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_temps != None
-                        and len(stages_temp) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'temperature':<16}{eq}{stages_temp[stage-1]}",
-                            file=fd,
-                        )
-                    outer_space, inner_space = identation(1)
-
-                    print(f"{outer_space} {'ensemble':<16}{eq}{'{'}", file=fd)
-                    # Ensemble block
-                    if (
-                        self.p_opts.additional_stage_ensembles != None
-                        and len(stages_ensemble) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'class':<11}{eq}{self.p_opts.additional_stage_ensembles}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_ensembles != None
-                        and len(stages_ensemble) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'class':<11}{eq}{stages_ensemble[stage-1]}",
-                            file=fd,
-                        )
-                    # Method block
-                    if (
-                        self.p_opts.additional_stage_methods != None
-                        and len(stages_method) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'method':<11}{eq}{self.p_opts.additional_stage_methods}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_methods != None
-                        and len(stages_method) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'method':<11}{eq}{stages_method[stage-1]}",
-                            file=fd,
-                        )
-                    # Thermostat block
-                    if (
-                        self.p_opts.additional_stage_thermostat_tau != None
-                        and len(stages_thermostat_tau) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'thermostat.tau':<15}{eq}{self.p_opts.additional_stage_thermostat_tau}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_thermostat_tau != None
-                        and len(stages_thermostat_tau) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'thermostat.tau':<15}{eq}{stages_thermostat_tau[stage-1]}",
-                            file=fd,
-                        )
-                    # Barostat block
-                    if (
-                        self.p_opts.additional_stage_barostat_tau != None
-                        and len(stages_barostat_tau) == 1
-                    ):
-                        print(
-                            f"{inner_space} {'barostat.tau':<15}{eq}{self.p_opts.additional_stage_barostat_tau}",
-                            file=fd,
-                        )
-                    elif (
-                        self.p_opts.additional_stage_barostat_tau != None
-                        and len(stages_barostat_tau) == stages
-                    ):
-                        print(
-                            f"{inner_space} {'barostat.tau':<15}{eq}{stages_barostat_tau[stage-1]}",
-                            file=fd,
-                        )
-
-                    outer_space, inner_space = identation(1)
-                    print(f"{outer_space} {'}'}", file=fd)
-                    ### Restraints block START ###
-                    if (
-                        self.p_opts.additional_stage_restraints_number_pos != 0
-                        or self.p_opts.additional_stage_restraints_number_dist != 0
-                        or self.p_opts.additional_stage_restraints_number_ang != 0
-                        or self.p_opts.additional_stage_restraints_number_imp != 0
-                    ):
-                        outer_space, inner_space = identation(1)
-                        stage = stage - 1
-                        header_rest = True
-                        if self.p_opts.additional_stage_restraints_number_pos != 0:
-                            pos_object = self.set_restraint_multi(
-                                stage=stage,
-                                stage_name="additional_stage",
-                                stage_restraints_number=self.p_opts.additional_stage_restraints_number_pos,
-                                stage_restraints_atoms=self.p_opts.additional_stage_restraints_atoms_pos,
-                                stage_restraints_forces=self.p_opts.additional_stage_restraints_forces_pos,
-                                rest_type="positional",
-                                stage_restraints_constants=None,
-                            )
-                            # Positional restraints variables
-                            long_pos = int(pos_object.number)
-                            atoms_slice_pos = pos_object.atoms
-                            forces_slice_pos = pos_object.forces
-                            if long_pos != 0:
-                                if header_rest:
-                                    print(
-                                        f"{outer_space} {'restraints.new':<16}{eq}{'['}",
-                                        file=fd,
-                                    )
-                                    header_rest = False
-                                for r in range(long_pos):
-                                    print(f"{inner_space} {'{'}", file=fd)
-                                    print(
-                                        f"{inner_space} {'name':<16}{eq}{self.p_opts.name_pos}",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'atoms':<16}{eq}[{q}{atoms_slice_pos[r]}{q}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'force_constants':<16}{eq}[{forces_slice_pos[r]} {forces_slice_pos[r]} {forces_slice_pos[r]}]",
-                                        file=fd,
-                                    )
-                                    print(f"{inner_space} {'}'}", file=fd)
-
-                        if self.p_opts.additional_stage_restraints_number_dist != 0:
-                            dist_object = self.set_restraint_multi(
-                                stage=stage,
-                                stage_name="additional_stage",
-                                stage_restraints_number=self.p_opts.additional_stage_restraints_number_dist,
-                                stage_restraints_atoms=self.p_opts.additional_stage_restraints_atoms_dist,
-                                stage_restraints_forces=self.p_opts.additional_stage_restraints_forces_dist,
-                                rest_type="distance",
-                                stage_restraints_constants=self.p_opts.additional_stage_restraints_r0_dist,
-                            )
-                            # Distance restraints variables
-                            long_dist = int(dist_object.number)
-                            atoms_slice_dist = dist_object.atoms
-                            forces_slice_dist = dist_object.forces
-                            constants_slice_dist = dist_object.constants
-                            if long_dist != 0:
-                                if header_rest:
-                                    print(
-                                        f"{outer_space} {'restraints.new':<16}{eq}{'['}",
-                                        file=fd,
-                                    )
-                                    header_rest = False
-                                for r in range(long_dist):
-                                    print(f"{inner_space} {'{'}", file=fd)
-                                    print(
-                                        f"{inner_space} {'name':<16}{eq}{self.p_opts.name_dist}",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'atoms':<16}{eq}[{q}{atoms_slice_dist[r][0]}{q} {q}{atoms_slice_dist[r][1]}{q}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'force_constants':<16}{eq}[{forces_slice_dist[r]}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'r0':<16}{eq}{constants_slice_dist[r]}",
-                                        file=fd,
-                                    )
-                                    print(f"{inner_space} {'}'}", file=fd)
-
-                        if self.p_opts.additional_stage_restraints_number_ang != 0:
-                            ang_object = self.set_restraint_multi(
-                                stage=stage,
-                                stage_name="additional_stage",
-                                stage_restraints_number=self.p_opts.additional_stage_restraints_number_ang,
-                                stage_restraints_atoms=self.p_opts.additional_stage_restraints_atoms_ang,
-                                stage_restraints_forces=self.p_opts.additional_stage_restraints_forces_ang,
-                                rest_type="angle",
-                                stage_restraints_constants=self.p_opts.additional_stage_restraints_theta0_ang,
-                            )
-                            # Distance restraints variables
-                            long_ang = int(ang_object.number)
-                            atoms_slice_ang = ang_object.atoms
-                            forces_slice_ang = ang_object.forces
-                            constants_slice_ang = ang_object.constants
-                            if long_ang != 0:
-                                if header_rest:
-                                    print(
-                                        f"{outer_space} {'restraints.new':<16}{eq}{'['}",
-                                        file=fd,
-                                    )
-                                    header_rest = False
-                                for r in range(long_ang):
-                                    print(f"{inner_space} {'{'}", file=fd)
-                                    print(
-                                        f"{inner_space} {'name':<16}{eq}{self.p_opts.name_ang}",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'atoms':<16}{eq}[{q}{atoms_slice_ang[r][0]}{q} {q}{atoms_slice_ang[r][1]}{q} {q}{atoms_slice_ang[r][2]}{q}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'force_constants':<16}{eq}[{forces_slice_ang[r]}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'theta0':<16}{eq}{constants_slice_ang[r]}",
-                                        file=fd,
-                                    )
-                                    print(f"{inner_space} {'}'}", file=fd)
-
-                        if self.p_opts.additional_stage_restraints_number_imp != 0:
-                            imp_object = self.set_restraint_multi(
-                                stage=stage,
-                                stage_name="additional_stage",
-                                stage_restraints_number=self.p_opts.additional_stage_restraints_number_imp,
-                                stage_restraints_atoms=self.p_opts.additional_stage_restraints_atoms_imp,
-                                stage_restraints_forces=self.p_opts.additional_stage_restraints_forces_imp,
-                                rest_type="improper",
-                                stage_restraints_constants=self.p_opts.additional_stage_restraints_phi0_imp,
-                            )
-                            # Distance restraints variables
-                            long_imp = int(imp_object.number)
-                            atoms_slice_imp = imp_object.atoms
-                            forces_slice_imp = imp_object.forces
-                            constants_slice_imp = imp_object.constants
-                            if long_imp != 0:
-                                if header_rest:
-                                    print(
-                                        f"{outer_space} {'restraints.new':<16}{eq}{'['}",
-                                        file=fd,
-                                    )
-                                    header_rest = False
-                                for r in range(long_imp):
-                                    print(f"{inner_space} {'{'}", file=fd)
-                                    print(
-                                        f"{inner_space} {'name':<16}{eq}{self.p_opts.name_imp}",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'atoms':<16}{eq}[{q}{atoms_slice_imp[r][0]}{q} {q}{atoms_slice_imp[r][1]}{q} {q}{atoms_slice_imp[r][2]}{q} {q}{atoms_slice_imp[r][3]}{q}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'force_constants':<16}{eq}[{forces_slice_imp[r]}]",
-                                        file=fd,
-                                    )
-                                    print(
-                                        f"{inner_space} {'theta0':<16}{eq}{constants_slice_imp[r]}",
-                                        file=fd,
-                                    )
-                                    print(f"{inner_space} {'}'}", file=fd)
-
-                        if header_rest == False:
-                            print(f"{outer_space} {']'}", file=fd)
-                        #### Restraints block end ####
-                    outer_space, inner_space = identation(0)
-                    print(file=fd)
-                    print(f"{inner_space} {'eneseq.interval':<29} {eq}{'0.3'}", file=fd)
-                    print(
-                        f"{inner_space} {'trajectory.center':<29} {eq}{self.p_opts.additional_stage_traj_center}",
-                        file=fd,
-                    )
-                    print(f"{outer_space}{'}'}", file=fd)
-                    print(file=fd)
-            # Stage 6 (Production) block
-            if self.p_opts.production.lower() in ["yes", "on", "true"]:
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'simulate':<20}{'{'}", file=fd)
-                print(
-                    f"{inner_space} {'cfg_file':<16}{eq}{q}{self.basename}_md.cfg{q}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'jobname':<16}{eq}{q}{'$MASTERJOBNAME'}{q}",
-                    file=fd,
-                )
-                print(f"{inner_space} {'dir':<16}{eq}{q}{'.'}{q}", file=fd)
-                print(f"{inner_space} {'compress':<16}{eq}{q}{''}{q}", file=fd)
-                print(f"{outer_space}{'}'}", file=fd)
-                print(file=fd)
-                self.write_cfg_file()
-
-    class PositionalRest:
-        def __init__(self, number, atoms, forces):
-            self.number: int = number
-            self.atoms: List[str] = atoms
-            self.forces: List[float] = forces
-
-    class DistanceRest:
-        def __init__(self, number, atoms, forces, constants):
-            self.number: int = number
-            self.atoms: List[str] = atoms
-            self.forces: List[float] = forces
-            self.constants: List[float] = constants
-
-    def set_restraint_multi(
-        self,
-        stage: int,
-        stage_name: str,
-        stage_restraints_number: str,
-        stage_restraints_atoms: str,
-        stage_restraints_forces: str,
-        rest_type: str,
-        stage_restraints_constants: Optional[str],
-    ) -> None:
-        stage_name = stage_name
-        number = list(str(stage_restraints_number).split(","))
-        list_atoms = list(str(stage_restraints_atoms).split(","))
-        list_forces = list(str(stage_restraints_forces).split(","))
-        rest_type = rest_type
-        list_constants = (
-            list(str(stage_restraints_constants).split(","))
-            if stage_restraints_constants != None
-            else None
-        )
-        list_number_long = sum(map(int, number))
-        # Block to check the number of restraints for positional restraints
-        if rest_type == "positional":
-            if len(list_forces) != list_number_long:
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_pos) must be equal to the number of {stage_name}_restraints_number_pos"
-                )
-            elif len(list_atoms) != list_number_long:
-                raise ValueError(
-                    f"The number of ASL in the restraint ({stage_name}_restraints_atoms_pos) must be equal to the number of {stage_name}_restraints_number_pos"
-                )
-            # Initialize the objects list to store the PositionalRest objects for every restraint.
-            objects = []
-            for i in range(len(number)):
-                atoms = []
-                forces = []
-                for j in range(int(number[i])):
-                    atoms.append(list_atoms[0])
-                    forces.append(list_forces[0])
-                    del list_atoms[0]
-                    del list_forces[0]
-
-                object_pos = self.PositionalRest(
-                    number=number[i],
-                    atoms=atoms,
-                    forces=forces,
-                )
-                objects.append(object_pos)
-
-            return objects[stage]
-        # Block to check the number of restraints for distance restraints
-        if rest_type == "distance":
-            if len(list_forces) != list_number_long:
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_dist) must be equal to the number of {stage_name}_restraints_number_dist"
-                )
-            elif len(list_atoms) != list_number_long * 2:
-                raise ValueError(
-                    f"The number of ASL in the restraint ({stage_name}_restraints_atoms_dist) must be twice the number of {stage_name}_restraints_number_dist"
-                )
-            elif len(list_constants) != list_number_long:
-                raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_r0_dist) must be equal to the number of {stage_name}_restraints_number_dist"
-                )
-
-            objects = []
-            for i in range(len(number)):
-                atoms = []
-                forces = []
-                constants = []
-                for j in range(int(number[i])):
-                    atoms.append(list_atoms[0:2])
-                    forces.append(list_forces[0])
-                    constants.append(list_constants[0])
-                    del list_atoms[0:2]
-                    del list_forces[0]
-                    del list_constants[0]
-                object_dist = self.DistanceRest(
-                    number=number[i],
-                    atoms=atoms,
-                    forces=forces,
-                    constants=constants,
-                )
-                objects.append(object_dist)
-            return objects[stage]
-        # Block to check the number of restraints for angle restraints
-        if rest_type == "angle":
-            if len(list_forces) != list_number_long:
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_ang) must be equal to the number of {stage_name}_restraints_number_ang"
-                )
-            elif len(list_atoms) != list_number_long * 3:
-                raise ValueError(
-                    f"The number of ASL in the restraint ({stage_name}_restraints_atoms_ang) must be three times the number of {stage_name}_restraints_number_ang"
-                )
-            elif len(list_constants) != list_number_long:
-                raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_r0_ang) must be equal to the number of {stage_name}_restraints_number_ang"
-                )
-
-            objects = []
-            for i in range(len(number)):
-                atoms = []
-                forces = []
-                constants = []
-                for j in range(int(number[i])):
-                    atoms.append(list_atoms[0:3])
-                    forces.append(list_forces[0])
-                    constants.append(list_constants[0])
-                    del list_atoms[0:3]
-                    del list_forces[0]
-                    del list_constants[0]
-                object_dist = self.DistanceRest(
-                    number=number[i],
-                    atoms=atoms,
-                    forces=forces,
-                    constants=constants,
-                )
-                objects.append(object_dist)
-            return objects[stage]
-        # Block to check the number of restraints for improper restraints
-        if rest_type == "improper":
-            if len(list_forces) != list_number_long:
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_imp) must be equal to the number of {stage_name}_restraints_number_imp"
-                )
-            elif len(list_atoms) != list_number_long * 4:
-                raise ValueError(
-                    f"The number of ASL in the restraint ({stage_name}_restraints_atoms_imp) must be four times the number of {stage_name}_restraints_number_imp"
-                )
-            elif len(list_constants) != list_number_long:
-                raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_r0_imp) must be equal to the number of {stage_name}_restraints_number_imp"
-                )
-
-            objects = []
-            for i in range(len(number)):
-                atoms = []
-                forces = []
-                constants = []
-                for j in range(int(number[i])):
-                    atoms.append(list_atoms[0:4])
-                    forces.append(list_forces[0])
-                    constants.append(list_constants[0])
-                    del list_atoms[0:4]
-                    del list_forces[0]
-                    del list_constants[0]
-                object_dist = self.DistanceRest(
-                    number=number[i],
-                    atoms=atoms,
-                    forces=forces,
-                    constants=constants,
-                )
-                objects.append(object_dist)
-            return objects[stage]
+            except ASLError as e_rror:
+                print(f"Error: {e_rror.args[0]}")
+                print("Please check weighted_atoms.")
+                sys.exit()
+            sizes = ", ".join(f"{len(atoms)}" for atoms in self.weighted_maps[key])
+            print(f"Weighted classes ({mode}): {sizes} atoms")
+        return [
+            Restraint("pos", p_opts.name_pos, [f"atom.num {atom_ranges(atoms)}"], force)
+            for atoms, force in zip(self.weighted_maps[key], forces)
+            if atoms.size
+        ]
+
+    def restraint_files(
+        self, name: str, stage: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
+        """
+        Return the restraint files of a stage. Additional stages (stage is their
+        index) take their file of the comma-separated additional_stage lists."""
+        files = []
+        for kind in RESTRAINT_TYPES:
+            value = getattr(self.p_opts, f"{name}_restraints_file_{kind}")
+            if value is None:
+                continue
+            file = str(value).split(",")[0 if stage is None else stage].strip()
+            if file.lower() not in ["", "none"]:
+                files.append((kind, file))
+        return files
+
+    def file_restraints(self, files: List[Tuple[str, str]]) -> Iterator[Restraint]:
+        """Stream the restraints of the restraint files of a stage, row by row."""
+        for kind, file in files:
+            yield from read_restraint_file(
+                file, kind, getattr(self.p_opts, f"name_{kind}")
+            )
 
     def set_restraint(
-        self,
-        stage_name: str,
-        stage_restraints_number: str,
-        stage_restraints_atoms: str,
-        stage_restraints_forces: str,
-        rest_type: str,
-        constant: Optional[str],
-    ) -> None:
-        stage_name = stage_name
-        stage_rest_number = int(stage_restraints_number)
-        stage_rest_atoms = list(str(stage_restraints_atoms).split(","))
-        stage_rest_forces = list(str(stage_restraints_forces).split(","))
-        rest_type = rest_type
-        constant = list(str(constant).split(",")) if constant != None else None
-        eq = "= "
-        q = '"'
-
-        # Block to check the number of restraints for positional restraints
-        if rest_type == "positional":
-            if len(stage_rest_forces) >= 2 and stage_rest_number != len(
-                stage_rest_forces
-            ):
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_pos) must be one value or equal to the number of {stage_name}_restraints_number_pos"
-                )
-            elif len(stage_rest_atoms) >= 2 and stage_rest_number != len(
-                stage_rest_atoms
-            ):
-                raise ValueError(
-                    f"The number of ASL in the restraint ({stage_name}_restraints_atoms_pos) must be one value or equal to the number of {stage_name}_restraints_number_pos"
-                )
-            # Block to set the restraints
-            atoms = []
-            forces = []
-            if stage_rest_number != 0 and len(stage_rest_atoms) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    atoms.append(stage_rest_atoms[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_atoms) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    atoms.append(stage_rest_atoms[0])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[0])
-
-            return atoms, forces
-
-        # Block to check the number of restraints for distance restraints
-        if rest_type == "distance":
-            if len(stage_rest_atoms) / 2 != stage_rest_number:
-                raise ValueError(
-                    f"The number of selections ({stage_name}_restraints_atoms_dist) should be twice the number of restraints. Check {stage_name}_restraints_number_dist and {stage_name}_restraints_atoms_dist"
-                )
-            elif len(stage_rest_forces) >= 2 and stage_rest_number != len(
-                stage_rest_forces
-            ):
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_dist) must be one value or equal to the number of {stage_name}_restraints_number_dist"
-                )
-            elif len(constant) >= 2 and stage_rest_number != len(constant):
-                raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_r0_dist) must be one value or equal to the number of {stage_name}_restraints_number_dist"
-                )
-            # Block to set the restraints
-            atoms = []
-            forces = []
-            constants = []
-            if stage_rest_number != 0 and len(stage_rest_atoms) != 1:
-                for rest in range(1, stage_rest_number * 2 + 1):
-                    atoms.append(stage_rest_atoms[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[rest - 1])
-
-            if stage_rest_number != 0 and len(constant) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_atoms) == 1:
-                for rest in range(1, stage_rest_number * 2 + 1):
-                    atoms.append(stage_rest_atoms[0])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[0])
-
-            if stage_rest_number != 0 and len(constant) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[0])
-
-            return atoms, forces, constants
-        # Block to check the number of restraints for angle restraints
-        if rest_type == "angle":
-            if len(stage_rest_atoms) / 3 != stage_rest_number:
-                raise ValueError(
-                    f"The number of selections ({stage_name}_restraints_atoms_ang) should be three times the number of restraints. Check {stage_name}_restraints_number_ang and {stage_name}_restraints_atoms_ang"
-                )
-            elif len(stage_rest_forces) >= 2 and stage_rest_number != len(
-                stage_rest_forces
-            ):
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_ang) must be one value or equal to the number of {stage_name}_restraints_number_ang"
-                )
-            elif len(constant) >= 2 and stage_rest_number != len(constant):
-                raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_theta0_ang) must be one value or equal to the number of {stage_name}_restraints_number_ang"
-                )
-            # Block to set the restraints
-            atoms = []
-            forces = []
-            constants = []
-            if stage_rest_number != 0 and len(stage_rest_atoms) != 1:
-                for rest in range(1, stage_rest_number * 3 + 1):
-                    atoms.append(stage_rest_atoms[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[rest - 1])
-
-            if stage_rest_number != 0 and len(constant) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_atoms) == 1:
-                for rest in range(1, stage_rest_number * 3 + 1):
-                    atoms.append(stage_rest_atoms[0])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[0])
-
-            if stage_rest_number != 0 and len(constant) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[0])
-
-            return atoms, forces, constants
-        # Block to check the number of restraints for improper restraints
-        if rest_type == "improper":
-            if len(stage_rest_atoms) / 4 != stage_rest_number:
-                raise ValueError(
-                    f"The number of selections ({stage_name}_restraints_atoms_imp) should be three times the number of restraints. Check {stage_name}_restraints_number_imp and {stage_name}_restraints_atoms_imp"
-                )
-            elif len(stage_rest_forces) >= 2 and stage_rest_number != len(
-                stage_rest_forces
-            ):
-                raise ValueError(
-                    f"The number of forces in the restraint ({stage_name}_restraints_forces_imp) must be one value or equal to the number of {stage_name}_restraints_number_imp"
-                )
-            elif len(constant) >= 2 and stage_rest_number != len(constant):
+        self, name: str, kind: str, number: int, single: bool
+    ) -> List[Restraint]:
+        """
+        Return number restraints of a type from the comma-separated options of a
+        stage, one Restraint field at a time: size atoms per restraint, then one
+        force and one r0/theta0/phi0 per restraint. With single, a field of one
+        value applies to every restraint."""
+        _, size, constant = RESTRAINT_TYPES[kind]
+        fields = [("atoms", "ASL", size), ("forces", "forces", 1)]
+        if constant is not None:
+            fields.append((constant, "constants", 1))
+        values: List[List[Optional[str]]] = []
+        for option, label, factor in fields:
+            key = f"{name}_restraints_{option}_{kind}"
+            items: List[Optional[str]] = list(str(getattr(self.p_opts, key)).split(","))
+            if single and factor == 1 and len(items) == 1:
+                items = items * number
+            elif len(items) != number * factor:
                 raise ValueError(
-                    f"The number of constants in the restraint ({stage_name}_restraints_theta0_imp) must be one value or equal to the number of {stage_name}_restraints_number_imp"
+                    f"The number of {label} in the restraint ({key}) must be "
+                    + ("one value or " if single and factor == 1 else "")
+                    + f"{RESTRAINT_TIMES[factor]} the number of {name}_restraints_number_{kind}"
                 )
-            # Block to set the restraints
-            atoms = []
-            forces = []
-            constants = []
-            if stage_rest_number != 0 and len(stage_rest_atoms) != 1:
-                for rest in range(1, stage_rest_number * 4 + 1):
-                    atoms.append(stage_rest_atoms[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_forces) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[rest - 1])
-
-            if stage_rest_number != 0 and len(constant) != 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[rest - 1])
-
-            if stage_rest_number != 0 and len(stage_rest_atoms) == 1:
-                for rest in range(1, stage_rest_number * 4 + 1):
-                    atoms.append(stage_rest_atoms[0])
+            values.append(items)
+        if constant is None:
+            values.append([None] * number)
+        atoms, forces, constants = values
+        label = getattr(self.p_opts, f"name_{kind}")
+        return [
+            Restraint(
+                kind, label, atoms[i * size : (i + 1) * size], forces[i], constants[i]
+            )
+            for i in range(number)
+        ]
 
-            if stage_rest_number != 0 and len(stage_rest_forces) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    forces.append(stage_rest_forces[0])
+    def partition_restraints(
+        self, name: str, kind: str, number: str
+    ) -> List[List[Restraint]]:
+        """
+        Split the restraints of a type of the additional stages into the restraints
+        of every stage: number is the comma-separated count of every stage, and the
+        other lists hold the values of all of their restraints in order."""
+        counts = [int(count) for count in str(number).split(",")]
+        restraints = self.set_restraint(name, kind, sum(counts), False)
+        offsets = list(itertools.accumulate(counts, initial=0))
+        return [restraints[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def cfg_files(self) -> List[str]:
+        """The _md.cfg file, or one _md_replica<i>.cfg per production replica."""
+        replicas = self.p_opts.production_replicas
+        if replicas == 1:
+            return [self.basename + "_md.cfg"]
+        return [f"{self.basename}_md_replica{i}.cfg" for i in range(1, replicas + 1)]
 
-            if stage_rest_number != 0 and len(constant) == 1:
-                for rest in range(1, stage_rest_number + 1):
-                    constants.append(constant[0])
+    def write_cfg_file(self) -> None:
+        seeds = replica_seeds(
+            self.p_opts.production_randomize_vel_seed, self.p_opts.production_replicas
+        )
+        for path_preparation, seed in zip(self.cfg_files(), seeds):
+            self.cfg_document(seed).write(path_preparation)
 
-            return atoms, forces, constants
+    def render_cfg(self, seed=None) -> str:
+        """Return the text of the _md.cfg file."""
+        return self.cfg_document(seed).render()
 
-    def write_cfg_file(self) -> None:
+    def cfg_document(self, seed=None) -> Document:
+        """The production settings; seed overrides the velocity seed of a replica."""
+        if seed is None:
+            seed = self.p_opts.production_randomize_vel_seed
         eq = "= "
         q = '"'
-        path_preparation = str(self.basename + "_md.cfg")
-        with open(path_preparation, "w", encoding="utf8") as fd:
-            outer_space, inner_space = identation(0)
-            print(f"{outer_space}{'annealing':<20}{eq}{'false'}", file=fd)
-            print(f"{outer_space}{'backend':<20}{eq}{'{'}", file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(
-                f"{outer_space}{'bigger_rclone':<20}{eq}{self.p_opts.production_bigger_rclone}",
-                file=fd,
-            )
-            print(f"{outer_space}{'checkpt':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_checkpt_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_checkpt_interval}",
-                file=fd,
-            )
-            print(f"{inner_space} {'name':<16}{eq}{q}{'$JOBNAME.cpt'}{q}", file=fd)
-            print(
-                f"{inner_space} {'write_last_step':<16}{eq}{self.p_opts.production_write_last_step}",
-                file=fd,
-            )
-            print(f"{outer_space}{'}'}", file=fd)
-            print(f"{outer_space}{'cpu':<20}{eq}{'1'}", file=fd)
-            print(
-                f"{outer_space}{'cutoff_radius':<20}{eq}{self.p_opts.production_cutoff}",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'elapsed_time':<20}{eq}{self.p_opts.production_elapsed_time}",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'energy_group':<20}{eq}{self.p_opts.production_energy_group}",
-                file=fd,
-            )
-            print(f"{outer_space}{'eneseq':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_eneseq_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_eneseq_interval}",
-                file=fd,
+        doc = Document()
+        outer_space, inner_space = identation(0)
+        doc.line(f"{outer_space}{'annealing':<20}{eq}{'false'}")
+        doc.line(f"{outer_space}{'backend':<20}{eq}{'{'}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(
+            f"{outer_space}{'bigger_rclone':<20}{eq}{self.p_opts.production_bigger_rclone}"
+        )
+        doc.line(f"{outer_space}{'checkpt':<20}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'first':<16}{eq}{self.p_opts.production_checkpt_first}"
+        )
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_checkpt_interval}"
+        )
+        doc.line(f"{inner_space} {'name':<16}{eq}{q}{'$JOBNAME.cpt'}{q}")
+        doc.line(
+            f"{inner_space} {'write_last_step':<16}{eq}{self.p_opts.production_write_last_step}"
+        )
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(f"{outer_space}{'cpu':<20}{eq}{self.p_opts.cpu}")
+        doc.line(
+            f"{outer_space}{'cutoff_radius':<20}{eq}{self.p_opts.production_cutoff}"
+        )
+        doc.line(
+            f"{outer_space}{'elapsed_time':<20}{eq}{self.p_opts.production_elapsed_time}"
+        )
+        doc.line(
+            f"{outer_space}{'energy_group':<20}{eq}{self.p_opts.production_energy_group}"
+        )
+        doc.line(f"{outer_space}{'eneseq':<20}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'first':<16}{eq}{self.p_opts.production_eneseq_first}"
+        )
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_eneseq_interval}"
+        )
+        name_eneseq = "JOBNAME$[_replica$REPLICA$].ene"
+        doc.line(f"{inner_space} {'name':<16}{eq}{q}{name_eneseq}{q}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(f"{outer_space}{'ensemble':<20}{eq}{'{'}")
+        outer_space, inner_space = identation(1)
+        doc.line(f"{outer_space} {'class':<16}{eq}{self.p_opts.production_ensemble}")
+        doc.line(f"{outer_space} {'method':<16}{eq}{self.p_opts.production_method}")
+
+        doc.line(f"{outer_space} {'barostat':<16}{eq}{'{'}")
+        doc.line(f"{inner_space} {'tau':<12}{eq}{self.p_opts.production_barostat_tau}")
+        doc.line(f"{outer_space} {'}'}")
+        doc.line(f"{outer_space} {'thermostat':<16}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'tau':<12}{eq}{self.p_opts.production_thermostat_tau}"
+        )
+        doc.line(f"{outer_space} {'}'}")
+        outer_space, inner_space = identation(0)
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(f"{outer_space}{'glue':<20}{eq}{self.p_opts.production_glue}")
+        doc.line(f"{outer_space}{'maeff_output':<20}{eq}{'{'}")
+        doc.line(f"{inner_space} {'first':<16}{eq}{self.p_opts.production_maeff_first}")
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_maeff_interval}"
+        )
+        name_maeff = '"$JOBNAME$[_replica$REPLICA$]-out.cms"'
+        name_trjdir = '"$JOBNAME$[_replica$REPLICA$]_trj"'
+        doc.line(f"{inner_space} {'name':<16}{eq}{name_maeff}")
+        doc.line(
+            f"{inner_space} {'periodicfix':<16}{eq}{self.p_opts.production_maeff_periodicfix}"
+        )
+        doc.line(f"{inner_space} {'trjdir':<16}{eq}{name_trjdir}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(f"{outer_space}{'meta':<20}{eq}{self.p_opts.production_meta}")
+        doc.line(f"{outer_space}{'meta_file':<20}{eq}{'?'}")
+        if self.p_opts.production_ensemble != "NVT":
+            doc.line(
+                f"{outer_space}{'pressure':<20}{eq}[{self.p_opts.production_pressure} {self.p_opts.production_pressure_type}]"
             )
-            name_eneseq = "JOBNAME$[_replica$REPLICA$].ene"
-            print(
-                f"{inner_space} {'name':<16}{eq}{q}{name_eneseq}{q}",
-                file=fd,
+        else:
+            doc.line(
+                f"{outer_space}{'pressure':<20}{eq}{self.p_opts.production_pressure}"
             )
-            print(f"{outer_space}{'}'}", file=fd)
-            print(f"{outer_space}{'ensemble':<20}{eq}{'{'}", file=fd)
+        doc.line(f"{outer_space}{'randomize_velocity':<20}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'first':<16}{eq}{self.p_opts.production_randomize_vel_first}"
+        )
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_randomize_vel_interval}"
+        )
+        doc.line(f"{inner_space} {'seed':<16}{eq}{seed}")
+        doc.line(f"{inner_space} {'temperature':<16}{eq}{q}{'@*.temperature'}{q}")
+        doc.line(f"{outer_space}{'}'}")
+        ### Restraints block START ###
+        restraints = self.stage_restraints("production")
+        restraint_files = self.restraint_files("production")
+        if not restraints and not restraint_files:
+            doc.line(f"{outer_space}{'restrain':<20}{eq}{'none'}")
+        else:
+            doc.line(f"{outer_space}{'restraints.new':<16}{eq}{'['}")
             outer_space, inner_space = identation(1)
-            print(
-                f"{outer_space} {'class':<16}{eq}{self.p_opts.production_ensemble}",
-                file=fd,
-            )
-            print(
-                f"{outer_space} {'method':<16}{eq}{self.p_opts.production_method}",
-                file=fd,
-            )
-
-            print(f"{outer_space} {'barostat':<16}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'tau':<12}{eq}{self.p_opts.production_barostat_tau}",
-                file=fd,
-            )
-            print(f"{outer_space} {'}'}", file=fd)
-            print(f"{outer_space} {'thermostat':<16}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'tau':<12}{eq}{self.p_opts.production_thermostat_tau}",
-                file=fd,
-            )
-            print(f"{outer_space} {'}'}", file=fd)
-            outer_space, inner_space = identation(0)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(
-                f"{outer_space}{'glue':<20}{eq}{self.p_opts.production_glue}", file=fd
-            )
-            print(f"{outer_space}{'maeff_output':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_maeff_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_maeff_interval}",
-                file=fd,
-            )
-            name_maeff = '"$JOBNAME$[_replica$REPLICA$]-out.cms"'
-            name_trjdir = '"$JOBNAME$[_replica$REPLICA$]_trj"'
-            print(f"{inner_space} {'name':<16}{eq}{name_maeff}", file=fd)
-            print(
-                f"{inner_space} {'periodicfix':<16}{eq}{self.p_opts.production_maeff_periodicfix}",
-                file=fd,
-            )
-            print(f"{inner_space} {'trjdir':<16}{eq}{name_trjdir}", file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(
-                f"{outer_space}{'meta':<20}{eq}{self.p_opts.production_meta}", file=fd
-            )
-            print(f"{outer_space}{'meta_file':<20}{eq}{'?'}", file=fd)
-            if self.p_opts.production_ensemble != "NVT":
-                print(
-                    f"{outer_space}{'pressure':<20}{eq}[{self.p_opts.production_pressure} {self.p_opts.production_pressure_type}]",
-                    file=fd,
-                )
-            else:
-                print(
-                    f"{outer_space}{'pressure':<20}{eq}{self.p_opts.production_pressure}",
-                    file=fd,
-                )
-            print(f"{outer_space}{'randomize_velocity':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_randomize_vel_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_randomize_vel_interval}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'seed':<16}{eq}{self.p_opts.production_randomize_vel_seed}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'temperature':<16}{eq}{q}{'@*.temperature'}{q}",
-                file=fd,
-            )
-            print(f"{outer_space}{'}'}", file=fd)
-            ### Restraints block START ###
-            if (
-                int(self.p_opts.production_restraints_number_pos) == 0
-                and int(self.p_opts.production_restraints_number_dist) == 0
-                and int(self.p_opts.production_restraints_number_ang) == 0
-                and int(self.p_opts.production_restraints_number_imp) == 0
+            for restraint in itertools.chain(
+                restraints, self.file_restraints(restraint_files)
             ):
-                print(
-                    f"{outer_space}{'restrain':<20}{eq}{'none'}",
-                    file=fd,
+                atoms = " ".join(f"{q}{atom}{q}" for atom in restraint.atoms)
+                doc.line(f"{outer_space}{'{'}")
+                doc.line(f"{inner_space}{'name':<11} {eq}{restraint.name}")
+                doc.line(f"{inner_space}{'atoms':<11} {eq}[{atoms}]")
+                doc.line(
+                    f"{inner_space}{'force_constants':<11} {eq}[{self.force_constants(restraint)}]"
                 )
-            # Block for production positional-restraints
-            if (
-                int(self.p_opts.production_restraints_number_pos) != 0
-                or int(self.p_opts.production_restraints_number_dist) != 0
-                or int(self.p_opts.production_restraints_number_ang) != 0
-                or int(self.p_opts.production_restraints_number_imp) != 0
-            ):
-                outer_space, inner_space = identation(0)
-                print(f"{outer_space}{'restraints.new':<16}{eq}{'['}", file=fd)
-                if int(self.p_opts.production_restraints_number_pos) != 0:
-                    atoms, forces = self.set_restraint(
-                        "production",
-                        self.p_opts.production_restraints_number_pos,
-                        self.p_opts.production_restraints_atoms_pos,
-                        self.p_opts.production_restraints_forces_pos,
-                        "positional",
-                        None,
-                    )
-                    for i in range(int(self.p_opts.production_restraints_number_pos)):
-                        outer_space, inner_space = identation(1)
-                        print(f"{outer_space}{'{'}", file=fd)
-                        print(
-                            f"{inner_space}{'name':<11} {eq}{self.p_opts.name_pos}",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'atoms':<11} {eq}[{q}{atoms[i]}{q}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'force_constants':<11} {eq}[{forces[i]} {forces[i]} {forces[i]}]",
-                            file=fd,
-                        )
-                        print(f"{outer_space} {'}'}", file=fd)
-                if int(self.p_opts.production_restraints_number_dist) != 0:
-                    # Block for production distance-restraints
-                    outer_space, inner_space = identation(0)
-                    atoms, forces, constants = self.set_restraint(
-                        "production",
-                        self.p_opts.production_restraints_number_dist,
-                        self.p_opts.production_restraints_atoms_dist,
-                        self.p_opts.production_restraints_forces_dist,
-                        "distance",
-                        self.p_opts.production_restraints_r0_dist,
-                    )
-                    j = 0
-                    for i in range(int(self.p_opts.production_restraints_number_dist)):
-                        outer_space, inner_space = identation(1)
-                        print(f"{outer_space}{'{'}", file=fd)
-                        print(
-                            f"{inner_space}{'name':<11} {eq}{self.p_opts.name_dist}",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'force_constants':<11} {eq}[{forces[i]}]",
-                            file=fd,
-                        )
-                        print(f"{inner_space}{'r0':<11} {eq}{constants[i]}", file=fd)
-                        print(f"{outer_space}{'}'}", file=fd)
-                        j += 2
-                if int(self.p_opts.production_restraints_number_ang) != 0:
-                    # Block for production angle-restraints
-                    outer_space, inner_space = identation(0)
-                    atoms, forces, constants = self.set_restraint(
-                        "production",
-                        self.p_opts.production_restraints_number_ang,
-                        self.p_opts.production_restraints_atoms_ang,
-                        self.p_opts.production_restraints_forces_ang,
-                        "angle",
-                        self.p_opts.production_restraints_theta0_ang,
-                    )
-                    j = 0
-                    for i in range(int(self.p_opts.production_restraints_number_ang)):
-                        outer_space, inner_space = identation(1)
-                        print(f"{outer_space}{'{'}", file=fd)
-                        print(
-                            f"{inner_space}{'name':<11} {eq}{self.p_opts.name_ang}",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'force_constants':<11} {eq}[{forces[i]}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'theta0':<11} {eq}{constants[i]}",
-                            file=fd,
-                        )
-                        print(f"{outer_space}{'}'}", file=fd)
-                        j += 3
-                if int(self.p_opts.production_restraints_number_imp) != 0:
-                    # Block for production improper-restraints
-                    outer_space, inner_space = identation(0)
-                    atoms, forces, constants = self.set_restraint(
-                        "production",
-                        self.p_opts.production_restraints_number_imp,
-                        self.p_opts.production_restraints_atoms_imp,
-                        self.p_opts.production_restraints_forces_imp,
-                        "improper",
-                        self.p_opts.production_restraints_phi0_imp,
-                    )
-                    j = 0
-                    for i in range(int(self.p_opts.production_restraints_number_imp)):
-                        outer_space, inner_space = identation(1)
-                        print(f"{outer_space}{'{'}", file=fd)
-                        print(
-                            f"{inner_space}{'name':<11} {eq}{self.p_opts.name_imp}",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'atoms':<11} {eq}[{q}{atoms[j]}{q} {q}{atoms[j+1]}{q} {q}{atoms[j+2]}{q} {q}{atoms[j+3]}{q}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'force_constants':<11} {eq}[{forces[i]}]",
-                            file=fd,
-                        )
-                        print(
-                            f"{inner_space}{'phi0':<11} {eq}{constants[i]}",
-                            file=fd,
-                        )
-                        print(f"{outer_space}{'}'}", file=fd)
-                        j += 4
-                print(f"{outer_space}{']'}", file=fd)
-            print(file=fd)
-            ### Restraints block END ###
-            outer_space, inner_space = identation(0)
-            print(f"{outer_space}{'simbox':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_simbox_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_simbox_interval}",
-                file=fd,
-            )
-            name_simbox = '"$JOBNAME$[_replica$REPLICA$]_simbox.dat"'
-            print(f"{inner_space} {'name':<16}{eq}{name_simbox}", file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(
-                f"{outer_space}{'surface_tension':<20}{eq}{self.p_opts.production_surface_tension}",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'taper':<20}{eq}{self.p_opts.production_taper}",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'temperature':<20}{eq}[ [{self.p_opts.production_temp} {self.p_opts.production_temp_group}] ]",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'time':<20}{eq}{self.p_opts.production_time}",
-                file=fd,
-            )
-            print(
-                f"{outer_space}{'timestep':<20}{eq}[{self.p_opts.production_timestep_bonded} {self.p_opts.production_timestep_near} {self.p_opts.production_timestep_far}]",
-                file=fd,
-            )
-            print(f"{outer_space}{'trajectory':<20}{eq}{'{'}", file=fd)
-            print(
-                f"{inner_space} {'center':<16}{eq}[{self.p_opts.production_traj_center}]",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'first':<16}{eq}{self.p_opts.production_traj_first}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'format':<16}{eq}{self.p_opts.production_traj_format}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'frames_per_file':<16}{eq}{self.p_opts.production_traj_frames_per_file}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_traj_interval}",
-                file=fd,
-            )
-            name_traj = '"$JOBNAME$[_replica$REPLICA$]_trj"'
-            print(f"{inner_space} {'name':<16}{eq}{name_traj}", file=fd)
-            print(
-                f"{inner_space} {'periodicfix':<16}{eq}{self.p_opts.production_traj_periodicfix}",
-                file=fd,
-            )
-            print(
-                f"{inner_space} {'write_velocity':<16}{eq}{self.p_opts.production_traj_write_velocity}",
-                file=fd,
-            )
-            print(f"{outer_space}{'}'}", file=fd)
+                constant = RESTRAINT_TYPES[restraint.kind][2]
+                if constant is not None:
+                    doc.line(f"{inner_space}{constant:<11} {eq}{restraint.constant}")
+                    doc.line(f"{outer_space}{'}'}")
+                else:
+                    # Positional blocks close one column deeper, as they always did.
+                    doc.line(f"{outer_space} {'}'}")
+            doc.line(f"{outer_space}{']'}")
+        doc.line()
+        ### Restraints block END ###
+        outer_space, inner_space = identation(0)
+        doc.line(f"{outer_space}{'simbox':<20}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'first':<16}{eq}{self.p_opts.production_simbox_first}"
+        )
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_simbox_interval}"
+        )
+        name_simbox = '"$JOBNAME$[_replica$REPLICA$]_simbox.dat"'
+        doc.line(f"{inner_space} {'name':<16}{eq}{name_simbox}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line(
+            f"{outer_space}{'surface_tension':<20}{eq}{self.p_opts.production_surface_tension}"
+        )
+        doc.line(f"{outer_space}{'taper':<20}{eq}{self.p_opts.production_taper}")
+        doc.line(
+            f"{outer_space}{'temperature':<20}{eq}[ [{self.p_opts.production_temp} {self.p_opts.production_temp_group}] ]"
+        )
+        doc.line(f"{outer_space}{'time':<20}{eq}{self.p_opts.production_time}")
+        doc.line(
+            f"{outer_space}{'timestep':<20}{eq}[{self.p_opts.production_timestep_bonded} {self.p_opts.production_timestep_near} {self.p_opts.production_timestep_far}]"
+        )
+        doc.line(f"{outer_space}{'trajectory':<20}{eq}{'{'}")
+        doc.line(
+            f"{inner_space} {'center':<16}{eq}[{self.p_opts.production_traj_center}]"
+        )
+        doc.line(f"{inner_space} {'first':<16}{eq}{self.p_opts.production_traj_first}")
+        doc.line(
+            f"{inner_space} {'format':<16}{eq}{self.p_opts.production_traj_format}"
+        )
+        doc.line(
+            f"{inner_space} {'frames_per_file':<16}{eq}{self.p_opts.production_traj_frames_per_file}"
+        )
+        doc.line(
+            f"{inner_space} {'interval':<16}{eq}{self.p_opts.production_traj_interval}"
+        )
+        name_traj = '"$JOBNAME$[_replica$REPLICA$]_trj"'
+        doc.line(f"{inner_space} {'name':<16}{eq}{name_traj}")
+        doc.line(
+            f"{inner_space} {'periodicfix':<16}{eq}{self.p_opts.production_traj_periodicfix}"
+        )
+        doc.line(
+            f"{inner_space} {'write_velocity':<16}{eq}{self.p_opts.production_traj_write_velocity}"
+        )
+        doc.line(f"{outer_space}{'}'}")
+        return doc
 
     def write_protocol_sh(self) -> None:
         if self.builder_opts.windows.lower() in [
@@ -2799,10 +1576,10 @@ class Protocol:
             )
         path_preparation_sh = str(self.basename + "_md.sh")
         input_msj = str(self.basename + "_md.msj")
-        input_cms = self.basename + "_preparation" + "-out.cms"
-        input_cfg = self.basename + "_md.cfg"
+        input_cms = self.input_cms
+        input_cfg = self.cfg_files()[0]
         gpu_opts = 'stage[1].set_family.md.jlaunch_opt=["-gpu"]'
-        args1 = f"-HOST localhost -JOBNAME {self.basename}_md -maxjob 1 -cpu 1 -m {input_msj} -c {input_cfg} {input_cms}"
+        args1 = f"-HOST localhost -JOBNAME {self.basename}_md -maxjob {self.p_opts.maxjob} -cpu {self.p_opts.cpu} -m {input_msj} -c {input_cfg} {input_cms}"
         args2 = f"-mode umbrella -set '{gpu_opts}' -o {self.basename}_md-out.cms -LOCAL"
         with open(path_preparation_sh, "w", encoding="utf8") as fd:
             print(executable, args1, args2, file=fd)
@@ -2813,6 +1590,14 @@ class Protocol:
 
 
 def parse_args(argv):
+    return make_options(*parse_settings(argv))
+
+
+def parse_settings(argv) -> Tuple[Dict, Dict[str, str], Dict[str, str]]:
+    """
+    Parse the command line and the configuration file into the settings and the
+    [build_geometry] and [protocol] sections, without checking the options, so
+    that swept values (a|b|c) are expanded before they are validated."""
     conf_parser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -2821,7 +1606,7 @@ def parse_args(argv):
     conf_parser.add_argument(
         "-i", "--input", help="Specify a configuration file", metavar="FILE"
     )
-    args, remaining_argv = conf_parser.parse_known_args()
+    args, remaining_argv = conf_parser.parse_known_args(argv)
 
     defaults = {"desmond_path": "$SCHRODINGER"}
 
@@ -2859,6 +1644,7 @@ def parse_args(argv):
         config = configparser.ConfigParser()
         config.read([args.input])
         defaults.update(dict(config.items("settings")))
+        defaults["input"] = args.input
 
     # Parse rest of arguments
     # Don't suppress add_help here so it will handle -h
@@ -2866,27 +1652,73 @@ def parse_args(argv):
         # Inherit options from config_parser
         parents=[conf_parser]
     )
+    parser.add_argument("--file", help="Override the input .mae file of [settings]")
+    parser.add_argument("--workdir", help="Override the workdir of [settings]")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the cache of structure properties",
+    )
+    parser.add_argument(
+        "--purge-cache",
+        action="store_true",
+        help="Remove every entry of the cache of structure properties",
+    )
+    parser.add_argument(
+        "--no-run",
+        action="store_true",
+        help="Only write the input files, ignoring run_preparation and run_protocols",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse an existing workdir and only rebuild the outdated files",
+    )
+    parser.add_argument("--cpu", help="Override the cpu of [protocol] (or 'auto')")
+    parser.add_argument(
+        "--maxjob", help="Override the maxjob of [protocol] (or 'auto')"
+    )
     parser.set_defaults(**defaults)
     args = parser.parse_args(remaining_argv)
-    build_opts = {}
-    build_opts.update(dict(config.items("build_geometry")))
-    filename = vars(args)["file"].split("/")[-1]
-    file = vars(args)["file"]
-    desmond_path = vars(args)["desmond_path"]
-    file_path = os.path.abspath(vars(args)["file"])
-    if "windows" in vars(args):
-        windows = vars(args)["windows"]
+    if args.purge_cache:
+        PropertyCache(getattr(args, "cache_dir", None)).purge()
+        print("The cache of structure properties was purged.")
+        if not args.input:
+            sys.exit(0)
+    return (
+        vars(args),
+        dict(config.items("build_geometry")),
+        dict(config.items("protocol")),
+    )
+
+
+def make_options(
+    settings: Dict, build_opts: Dict[str, str], protocol_opts: Dict[str, str]
+) -> Tuple[Args, BuilderOptions, str, ProtocolOptions]:
+    filename = settings["file"].split("/")[-1]
+    file = settings["file"]
+    desmond_path = settings["desmond_path"]
+    file_path = os.path.abspath(settings["file"])
+    if "windows" in settings:
+        windows = settings["windows"]
     else:
         windows = "false"
-
-    protocol_opts = {}
-    protocol_opts.update(dict(config.items("protocol")))
+    protocol_opts = dict(protocol_opts)
+    for key in ["cpu", "maxjob"]:
+        if settings.get(key):
+            protocol_opts[key] = settings[key]
+    p_opts = ProtocolOptions(protocol_opts)
+    builder_opts = BuilderOptions(
+        build_opts, file, filename, desmond_path, file_path, windows
+    )
+    if "auto" in [str(p_opts.cpu).lower(), str(p_opts.maxjob).lower()]:
+        LocalScheduler().size_protocol(p_opts, len(builder_opts.atom_table))
 
     return (
-        Args(**vars(args)),
-        BuilderOptions(build_opts, file, filename, desmond_path, file_path, windows),
+        Args(**settings),
+        builder_opts,
         file_path,
-        ProtocolOptions(protocol_opts),
+        p_opts,
     )
 
 
@@ -2897,14 +1729,845 @@ class maefile:
     desmond_path: str
 
 
+# A token of a .mae data row: a quoted string (with escapes) or a bare word.
+MAE_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+MAE_ATOM_BLOCK = re.compile(r"^m_atom\[(\d+)\]\s*\{")
+
+
+def open_mae(file: str) -> TextIO:
+    """Open a plain or gzip-compressed (.maegz, .mae.gz) structure file as text."""
+    if str(file).endswith((".gz", ".maegz", ".cmsgz")):
+        return gzip.open(file, "rt", encoding="utf8")
+    return open(file, "r", encoding="utf8")
+
+
+def read_mae_charges(file: str) -> List[int]:
+    """
+    Return the total formal charge of every CT in a .mae file.
+    The file is streamed line by line and only the m_atom blocks are tokenized."""
+    charges = []
+    with open_mae(file) as fd:
+        for line in fd:
+            block = MAE_ATOM_BLOCK.match(line.strip())
+            if not block:
+                continue
+            atoms_number = int(block.group(1))
+            columns = []
+            for line in fd:
+                line = line.strip()
+                if line == ":::":
+                    break
+                if line and not line.startswith("#"):
+                    columns.append(line)
+            # Every data row starts with the atom index, which is not a column.
+            row_length = len(columns) + 1
+            if "i_m_formal_charge" in columns:
+                charge_index = columns.index("i_m_formal_charge") + 1
+            else:
+                charge_index = None
+            charge = 0
+            tokens: List[str] = []
+            rows = 0
+            while rows < atoms_number:
+                tokens.extend(MAE_TOKEN.findall(next(fd)))
+                while len(tokens) >= row_length and rows < atoms_number:
+                    if charge_index is not None and tokens[charge_index] != "<>":
+                        charge += int(tokens[charge_index])
+                    del tokens[:row_length]
+                    rows += 1
+            charges.append(charge)
+    return charges
+
+
+ELEMENTS = np.array(
+    """X H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni
+    Cu Zn Ga Ge As Se Br Kr Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs
+    Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb
+    Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr""".split()
+)
+
+
+class MaeAtomTable:
+    """
+    Column arrays for the atoms of every CT in a .mae file.
+    The file is memory-mapped and the m_atom blocks are indexed once. Each column
+    is decoded with NumPy on first use, without building per-atom Python objects."""
+
+    def __init__(self, file: str) -> None:
+        self.file = file
+        if str(file).endswith((".gz", ".maegz", ".cmsgz")):
+            with gzip.open(file, "rb") as fd:
+                self.buffer = fd.read()
+        else:
+            with open(file, "rb") as fd:
+                if os.fstat(fd.fileno()).st_size == 0:
+                    self.buffer = b""
+                else:
+                    self.buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self.buffer, dtype=np.uint8)
+        # (atoms number, column names, first byte, last byte) of every m_atom block.
+        self.blocks: List[Tuple[int, List[str], int, int]] = self.index_blocks()
+        self.tokens: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self.columns: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return sum(block[0] for block in self.blocks)
+
+    def index_blocks(self) -> List[Tuple[int, List[str], int, int]]:
+        blocks = []
+        position = self.buffer.find(b"m_atom[")
+        while position != -1:
+            if position == 0 or self.buffer[position - 1 : position] in b" \t\r\n":
+                opening = self.buffer.find(b"{", position)
+                header_end = self.buffer.find(b":::", opening)
+                data_end = self.buffer.find(b":::", header_end + 3)
+                header = bytes(self.buffer[position:opening]).decode("utf8")
+                atoms_number = int(header[header.index("[") + 1 : header.index("]")])
+                columns = [
+                    line.strip()
+                    for line in bytes(self.buffer[opening + 1 : header_end])
+                    .decode("utf8")
+                    .splitlines()
+                    if line.strip() and not line.strip().startswith("#")
+                ]
+                blocks.append((atoms_number, columns, header_end + 3, data_end))
+                position = data_end
+            position = self.buffer.find(b"m_atom[", position + 1)
+        return blocks
+
+    def block_tokens(self, block: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the first and last+1 byte of every value of a block as (atoms, columns+1) arrays."""
+        if block in self.tokens:
+            return self.tokens[block]
+        atoms_number, columns, first, last = self.blocks[block]
+        data = self.data[first:last]
+        quote = data == ord('"')
+        escaped = np.zeros_like(quote)
+        escaped[1:] = data[:-1] == ord("\\")
+        quote &= ~escaped
+        inside = np.bitwise_xor.accumulate(quote.view(np.uint8))
+        value = ~((data <= ord(" ")) & (inside == 0))
+        edges = np.diff(np.concatenate(([0], value.view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1) + first
+        ends = np.flatnonzero(edges == -1) + first
+        # Every row starts with the atom index, which is not a column.
+        shape = (atoms_number, len(columns) + 1)
+        if starts.size != shape[0] * shape[1]:
+            raise ValueError(
+                f"Wrong number of values in the m_atom block {block + 1} of '{self.file}'."
+            )
+        self.tokens[block] = (starts.reshape(shape), ends.reshape(shape))
+        return self.tokens[block]
+
+    def raw_column(self, block: int, index: int) -> np.ndarray:
+        starts, ends = self.block_tokens(block)
+        starts = starts[:, index]
+        lengths = ends[:, index] - starts
+        width = max(int(lengths.max()) if lengths.size else 1, 1)
+        offsets = np.minimum(starts[:, None] + np.arange(width), self.data.size - 1)
+        chars = np.where(
+            np.arange(width) < lengths[:, None], self.data[offsets], np.uint8(0)
+        )
+        return np.ascontiguousarray(chars, dtype=np.uint8).view(f"S{width}").ravel()
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Return a m_atom property of every atom, typed by its prefix (r_, i_, b_, s_).
+        Missing (<>) values are nan for r_ columns, 0 for i_/b_ and '' for s_ columns."""
+        if name in self.columns:
+            return self.columns[name]
+        kind = name[0]
+        parts = []
+        for block, (atoms_number, columns, _, _) in enumerate(self.blocks):
+            if name not in columns:
+                raw = np.full(atoms_number, b"<>", dtype="S2")
+            else:
+                raw = self.raw_column(block, columns.index(name) + 1)
+            if kind == "s":
+                raw = np.char.strip(np.char.strip(raw), b'"')
+                raw = np.where(raw == b"<>", b"", raw)
+                parts.append(np.char.strip(np.char.decode(raw, "utf8")))
+            elif kind == "r":
+                parts.append(np.where(raw == b"<>", b"nan", raw).astype(np.float64))
+            else:
+                parts.append(np.where(raw == b"<>", b"0", raw).astype(np.int64))
+        if parts:
+            values = np.concatenate(parts)
+        else:
+            values = np.array([], dtype=str if kind == "s" else np.float64)
+        self.columns[name] = values
+        return values
+
+    @property
+    def ct(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.blocks)), [b[0] for b in self.blocks])
+
+    @property
+    def bonded(self) -> np.ndarray:
+        """
+        Whether every atom has a bond, from the m_bond block that follows the
+        m_atom block of its CT."""
+        if "bonded" in self.columns:
+            return self.columns["bonded"]
+        bonded = np.zeros(len(self), dtype=bool)
+        offset = 0
+        for block, (atoms_number, _, _, last) in enumerate(self.blocks):
+            end = len(self.buffer)
+            if block + 1 < len(self.blocks):
+                end = self.blocks[block + 1][2]
+            position = self.buffer.find(b"m_bond[", last, end)
+            if position != -1:
+                opening = self.buffer.find(b"{", position)
+                header_end = self.buffer.find(b":::", opening)
+                data_end = self.buffer.find(b":::", header_end + 3)
+                columns = [
+                    line.strip()
+                    for line in bytes(self.buffer[opening + 1 : header_end])
+                    .decode("utf8")
+                    .splitlines()
+                    if line.strip() and not line.strip().startswith("#")
+                ]
+                rows = np.array(
+                    bytes(self.buffer[header_end + 3 : data_end]).split(),
+                    dtype=np.int64,
+                ).reshape(-1, len(columns) + 1)
+                for name in ("i_m_from", "i_m_to"):
+                    bonded[offset + rows[:, columns.index(name) + 1] - 1] = True
+            offset += atoms_number
+        self.columns["bonded"] = bonded
+        return bonded
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        return np.column_stack(
+            [self.column(f"r_m_{axis}_coord") for axis in ("x", "y", "z")]
+        )
+
+    @property
+    def formal_charge(self) -> np.ndarray:
+        return self.column("i_m_formal_charge")
+
+    @property
+    def atomic_number(self) -> np.ndarray:
+        return self.column("i_m_atomic_number")
+
+    @property
+    def element(self) -> np.ndarray:
+        return ELEMENTS[np.clip(self.atomic_number, 0, ELEMENTS.size - 1)]
+
+    @property
+    def atom_name(self) -> np.ndarray:
+        return self.column("s_m_pdb_atom_name")
+
+    @property
+    def residue_name(self) -> np.ndarray:
+        return self.column("s_m_pdb_residue_name")
+
+    @property
+    def residue_number(self) -> np.ndarray:
+        return self.column("i_m_residue_number")
+
+    @property
+    def chain(self) -> np.ndarray:
+        return self.column("s_m_chain_name")
+
+
+PROTEIN_RESIDUES = set(
+    """ALA ARG ASN ASP CYS GLN GLU GLY HIS ILE LEU LYS MET PHE PRO SER THR TRP TYR
+    VAL HID HIE HIP HSD HSE HSP CYX CYM ASH GLH LYN ARN TYO SRO THO ACE NMA NME
+    MSE SEP TPO PTR""".split()
+)
+NUCLEIC_RESIDUES = set("A C G T U DA DC DG DT DU RA RC RG RU".split())
+WATER_RESIDUES = set("HOH WAT SPC T3P T4P T5P TIP TIP3 TIP4 TIP5 H2O SOL DOD".split())
+# Keywords that only Schrodinger defines; they are not reported as unchecked.
+SCHRODINGER_KEYWORDS = {"ligand", "ligands"}
+
+
+class AslEvaluator:
+    """
+    In-process evaluator for the common subset of ASL over a MaeAtomTable.
+    Selections are resolved as NumPy boolean masks. Supported keywords: all, protein,
+    nucleic_acids, water, ions, backbone, heavy_atom, solute, solute_heavy_atom,
+    solvent, solvent_heavy_atom, chain.name, res.ptype, res.num, atom.num,
+    atom.ptype, atom.ele, 'and', 'or', 'not' and parentheses. Any other syntax, and
+    the keywords whose definition belongs to Schrodinger (ligand...), raises
+    ASLError."""
+
+    TOKEN = re.compile(r'\(|\)|(?:"[^"]*"|\'[^\']*\'|[^\s()"\'])+')
+    # Comma-separated values of a token, quoted values may hold commas and spaces.
+    VALUE = re.compile(r'"[^"]*"|\'[^\']*\'|[^,]+')
+    PROPERTIES = {
+        "chain.name": "chain",
+        "chain.n": "chain",
+        "chain.": "chain",
+        "c.n": "chain",
+        "c.": "chain",
+        "res.ptype": "residue_name",
+        "res.pt": "residue_name",
+        "res.": "residue_name",
+        "r.pt": "residue_name",
+        "r.": "residue_name",
+        "residue.ptype": "residue_name",
+        "res.num": "residue_number",
+        "res.n": "residue_number",
+        "r.n": "residue_number",
+        "residue.num": "residue_number",
+        "atom.num": "atom_number",
+        "atom.n": "atom_number",
+        "a.n": "atom_number",
+        "atom.ptype": "atom_name",
+        "atom.pt": "atom_name",
+        "atom.": "atom_name",
+        "a.pt": "atom_name",
+        "a.": "atom_name",
+        "atom.ele": "element",
+        "atom.element": "element",
+        "atom.e": "element",
+        "a.e": "element",
+    }
+    OPERATORS = {"and", "or", "not", "(", ")"}
+
+    def __init__(self, table: MaeAtomTable) -> None:
+        self.table = table
+        self.size = len(table)
+        self.keywords: Dict[str, np.ndarray] = {}
+
+    def evaluate(self, asl: str) -> np.ndarray:
+        """Return the boolean mask of the atoms selected by an ASL expression."""
+        self.asl = asl
+        self.tokens = self.TOKEN.findall(asl)
+        self.position = 0
+        if not self.tokens:
+            raise ASLError(asl)
+        mask = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ASLError(asl)
+        return mask
+
+    def atoms(self, asl: str) -> List[int]:
+        """Return the 1-based indices of the atoms selected by an ASL expression."""
+        return (np.flatnonzero(self.evaluate(asl)) + 1).tolist()
+
+    def peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].lower()
+        return None
+
+    def parse_or(self) -> np.ndarray:
+        mask = self.parse_and()
+        while self.peek() == "or":
+            self.position += 1
+            mask = mask | self.parse_and()
+        return mask
+
+    def parse_and(self) -> np.ndarray:
+        mask = self.parse_not()
+        while self.peek() == "and":
+            self.position += 1
+            mask = mask & self.parse_not()
+        return mask
+
+    def parse_not(self) -> np.ndarray:
+        if self.peek() == "not":
+            self.position += 1
+            return ~self.parse_not()
+        return self.parse_primary()
+
+    def parse_primary(self) -> np.ndarray:
+        token = self.peek()
+        if token is None:
+            raise ASLError(self.asl)
+        self.position += 1
+        if token == "(":
+            mask = self.parse_or()
+            if self.peek() != ")":
+                raise ASLError(self.asl)
+            self.position += 1
+            return mask
+        if token in self.PROPERTIES:
+            values, quoted = [], []
+            while self.peek() is not None and self.peek() not in self.OPERATORS:
+                # Quoted names are padded like the PDB columns: "ALA ", " CA ".
+                for text in self.VALUE.findall(self.tokens[self.position]):
+                    value = text.strip("\"'").strip()
+                    if value:
+                        values.append(value)
+                        if text[0] in "\"'":
+                            quoted.append(value)
+                self.position += 1
+            if not values:
+                raise ASLError(self.asl)
+            return self.match(self.PROPERTIES[token], values, quoted)
+        return self.keyword(token)
+
+    def residues(self) -> np.ndarray:
+        """Return a residue id for every atom (atoms of a residue are contiguous)."""
+        if "residues" not in self.keywords:
+            table = self.table
+            if self.size == 0:
+                self.keywords["residues"] = np.zeros(0, dtype=np.int64)
+            else:
+                change = np.zeros(self.size, dtype=bool)
+                change[0] = True
+                for values in (
+                    table.ct,
+                    table.chain,
+                    table.residue_number,
+                    table.residue_name,
+                ):
+                    change[1:] |= values[1:] != values[:-1]
+                self.keywords["residues"] = np.cumsum(change) - 1
+        return self.keywords["residues"]
+
+    def keyword(self, token: str) -> np.ndarray:
+        if token in self.keywords:
+            return self.keywords[token]
+        table = self.table
+        residue_name = np.char.upper(table.residue_name)
+        if token == "all":
+            mask = np.ones(self.size, dtype=bool)
+        elif token == "protein":
+            mask = np.isin(residue_name, list(PROTEIN_RESIDUES))
+        elif token in ("nucleic_acids", "nucleic"):
+            mask = np.isin(residue_name, list(NUCLEIC_RESIDUES))
+        elif token in ("water", "waters"):
+            mask = np.isin(residue_name, list(WATER_RESIDUES))
+        elif token in ("heavy_atom", "heavy_atoms"):
+            mask = table.atomic_number > 1
+        elif token == "backbone":
+            mask = self.keyword("protein") & np.isin(
+                np.char.upper(table.atom_name), ["N", "CA", "C", "O"]
+            )
+        elif token == "ions":
+            # Charged atoms that are molecules of their own.
+            mask = (table.formal_charge != 0) & ~table.bonded
+        elif token == "solute":
+            # As the solute of Desmond: not (water or ions).
+            mask = ~(self.keyword("water") | self.keyword("ions"))
+        elif token == "solute_heavy_atom":
+            mask = self.keyword("solute") & self.keyword("heavy_atom")
+        elif token == "solvent":
+            mask = self.keyword("water")
+        elif token == "solvent_heavy_atom":
+            mask = self.keyword("solvent") & self.keyword("heavy_atom")
+        else:
+            raise ASLError(self.asl)
+        self.keywords[token] = mask
+        return mask
+
+    def match(
+        self, prop: str, values: List[str], quoted: Optional[List[str]] = None
+    ) -> np.ndarray:
+        """
+        Return the atoms whose property matches any value. A quoted name that
+        matches no atom raises ASLError, so that Schrodinger resolves it."""
+        table = self.table
+        if prop in ("residue_number", "atom_number"):
+            if prop == "atom_number":
+                numbers = np.arange(1, self.size + 1)
+            else:
+                numbers = table.residue_number
+            mask = np.zeros(self.size, dtype=bool)
+            for value in values:
+                bounds = value.split("-")
+                if len(bounds) > 2 or not all(b.isdigit() for b in bounds):
+                    raise ASLError(self.asl)
+                mask |= (numbers >= int(bounds[0])) & (numbers <= int(bounds[-1]))
+            return mask
+        column = getattr(table, prop)
+        quoted = quoted or []
+        if prop != "chain":
+            column = np.char.upper(column)
+            values = [value.upper() for value in values]
+            quoted = [value.upper() for value in quoted]
+        # Wildcards are matched against the unique values only.
+        unique, inverse = np.unique(column, return_inverse=True)
+        selected = np.zeros(unique.size, dtype=bool)
+        for value in values:
+            if "*" in value or "?" in value:
+                pattern = re.compile(
+                    re.escape(value).replace("\\*", ".*").replace("\\?", ".") + "$"
+                )
+                selected |= np.array(
+                    [bool(pattern.match(u)) for u in unique], dtype=bool
+                )
+            else:
+                found = unique == value
+                if value in quoted and not found.any():
+                    raise ASLError(self.asl)
+                selected |= found
+        return selected[inverse.ravel()]
+
+
+# Progressions of the forces of additional_stage_schedule.
+SCHEDULES = ["geometric", "linear"]
+# Types of contact restraints: donor-acceptor (N/O) pairs or any heavy-atom pairs.
+CONTACTS = ["hbond", "heavy", "none"]
+HBOND_ELEMENTS = ["N", "O"]
+# Offsets of a cell and its 26 neighbours in a cell list.
+NEIGHBOUR_CELLS = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+
+
+def close_pairs(
+    coordinates: np.ndarray, cutoff: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the pairs (i < j) of points closer than cutoff. The points are binned
+    into cubic cells of the cutoff size and every point is only compared with the
+    points of its cell and of the 26 neighbour cells, all with NumPy arrays."""
+    if len(coordinates) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cells = np.floor((coordinates - coordinates.min(axis=0)) / cutoff).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    cell_ids = np.ravel_multi_index(cells.T, shape)
+    order = np.argsort(cell_ids, kind="stable")
+    counts = np.bincount(cell_ids, minlength=int(np.prod(shape)))
+    starts = np.cumsum(counts) - counts
+    first, second = [], []
+    for offset in NEIGHBOUR_CELLS:
+        neighbours = cells + offset
+        inside = np.all((neighbours >= 0) & (neighbours < shape), axis=1)
+        points = np.flatnonzero(inside)
+        neighbour_ids = np.ravel_multi_index(neighbours[points].T, shape)
+        number = counts[neighbour_ids]
+        # Every point against every point of its neighbour cell.
+        i = np.repeat(points, number)
+        positions = np.arange(number.sum()) - np.repeat(
+            np.cumsum(number) - number, number
+        )
+        j = order[np.repeat(starts[neighbour_ids], number) + positions]
+        keep = i < j
+        first.append(i[keep])
+        second.append(j[keep])
+    i, j = np.concatenate(first), np.concatenate(second)
+    close = np.sum((coordinates[i] - coordinates[j]) ** 2, axis=1) < cutoff**2
+    return i[close], j[close]
+
+
+def contact_map(
+    table: MaeAtomTable,
+    kind: str,
+    cutoff: float,
+    atoms: str,
+    partner: Optional[str] = None,
+    separation: int = 3,
+) -> List[Tuple[int, int, float]]:
+    """
+    Return the contacts (atom numbers and distance) of a structure between the atoms
+    of an ASL, or between them and a partner ASL (e.g. protein and ligand). hbond
+    contacts are N/O donor-acceptor pairs, heavy contacts any heavy-atom pairs.
+    Atoms of the same residue, or of residues of a chain less than separation
+    apart, are not in contact."""
+    evaluator = AslEvaluator(table)
+    selected = evaluator.evaluate(atoms)
+    other = evaluator.evaluate(partner) if partner else selected
+    if kind == "hbond":
+        eligible = np.isin(table.element, HBOND_ELEMENTS)
+    else:
+        eligible = table.atomic_number > 1
+    candidates = np.flatnonzero((selected | other) & eligible)
+    i, j = close_pairs(table.coordinates[candidates], cutoff)
+    i, j = candidates[i], candidates[j]
+    keep = (selected[i] & other[j]) | (other[i] & selected[j])
+    residues = evaluator.residues()
+    same_chain = (table.ct[i] == table.ct[j]) & (table.chain[i] == table.chain[j])
+    near = np.abs(table.residue_number[i] - table.residue_number[j]) < separation
+    keep &= (residues[i] != residues[j]) & ~(same_chain & near)
+    i, j = i[keep], j[keep]
+    order = np.lexsort((j, i))
+    i, j = i[order], j[order]
+    distances = np.linalg.norm(table.coordinates[i] - table.coordinates[j], axis=1)
+    return list(zip((i + 1).tolist(), (j + 1).tolist(), distances.tolist()))
+
+
+# Scores of the weighted restraints: high B-factors or low pLDDTs are flexible.
+WEIGHTED = ["bfactor", "plddt", "none"]
+# ASL of atom numbers and atom number ranges, as written by atom_ranges().
+ATOM_RANGE = r"\d+(?:-\d+)?"
+ATOM_NUMBERS = re.compile(
+    rf"(?:atom\.num|atom\.n|a\.n)\s+({ATOM_RANGE}(?:,{ATOM_RANGE})*)"
+)
+
+
+def atom_ranges(numbers: np.ndarray) -> str:
+    """Return sorted atom numbers as comma-separated ranges: 1-4,7,9-12."""
+    if numbers.size == 0:
+        return ""
+    breaks = np.flatnonzero(np.diff(numbers) != 1) + 1
+    firsts = numbers[np.concatenate(([0], breaks))].tolist()
+    lasts = numbers[np.concatenate((breaks - 1, [numbers.size - 1]))].tolist()
+    return ",".join(
+        f"{first}" if first == last else f"{first}-{last}"
+        for first, last in zip(firsts, lasts)
+    )
+
+
+def merge_restraints(restraints: List[Restraint]) -> List[Restraint]:
+    """
+    Merge a list of restraints, in order. Positional restraints with the same name
+    and force become one restraint: the union of their atom.num ranges, or the
+    'or' of their ASLs. Other restraints are only dropped when they repeat one
+    with the same force and constant on the same atoms, in either direction for
+    distances and angles."""
+    merged: Dict[Tuple, List] = {}
+    for restraint in restraints:
+        atoms = tuple(restraint.atoms)
+        if restraint.kind == "pos":
+            key = ("pos", restraint.name, restraint.force, restraint.constant)
+            merged.setdefault(key, [restraint, []])[1].append(atoms[0])
+            continue
+        if restraint.kind in ("dist", "ang"):
+            atoms = min(atoms, atoms[::-1])
+        key = (restraint.kind, restraint.name, atoms, restraint.force)
+        merged.setdefault(key + (restraint.constant,), [restraint, None])
+    compacted = []
+    for restraint, asls in merged.values():
+        if asls is None:
+            compacted.append(restraint)
+            continue
+        # Atom numbers are merged into one range list, other ASLs are joined.
+        ranges, others = [], []
+        for asl in dict.fromkeys(asls):
+            match = ATOM_NUMBERS.fullmatch(asl.strip())
+            if match:
+                ranges += match.group(1).split(",")
+            else:
+                others.append(asl)
+        asls = others
+        if ranges:
+            asls.append(f"atom.num {atom_ranges(atom_numbers(ranges))}")
+        if len(asls) > 1:
+            asls = [" or ".join(f"({asl})" for asl in asls)]
+        compacted.append(replace(restraint, atoms=asls))
+    return compacted
+
+
+def atom_numbers(ranges: List[str]) -> np.ndarray:
+    """Return the sorted unique atom numbers of ranges like 1-4 or 7."""
+    bounds = [[int(bound) for bound in value.split("-")] for value in ranges]
+    return np.unique(
+        np.concatenate([np.arange(bound[0], bound[-1] + 1) for bound in bounds])
+    )
+
+
+def weighted_classes(
+    table: MaeAtomTable,
+    mode: str,
+    classes: int,
+    column: str,
+    atoms: str,
+    edges: Optional[List[float]] = None,
+) -> List[np.ndarray]:
+    """
+    Return the atom numbers of every restraint class, from the most ordered to the
+    most flexible residues. Residues are scored by the mean of a column over their
+    selected atoms (B-factor, or pLDDT for predicted structures) and split at the
+    edges (column units), or in classes of equal size without edges. Residues
+    without values go to the first class."""
+    evaluator = AslEvaluator(table)
+    selected = evaluator.evaluate(atoms)
+    residues = evaluator.residues()
+    values = table.column(column)
+    known = selected & np.isfinite(values)
+    size = int(residues.max()) + 1 if residues.size else 0
+    totals = np.bincount(residues[known], weights=values[known], minlength=size)
+    counts = np.bincount(residues[known], minlength=size)
+    scores = totals / np.maximum(counts, 1)
+    if mode == "plddt":
+        scores = -scores
+    if edges is None:
+        ranked = scores[counts > 0]
+        bounds = np.zeros(0)
+        if ranked.size:
+            bounds = np.quantile(ranked, np.arange(1, classes) / classes)
+    else:
+        bounds = np.sort(-np.array(edges) if mode == "plddt" else np.array(edges))
+    residue_classes = np.where(counts > 0, np.digitize(scores, bounds), 0)
+    atom_classes = residue_classes[residues]
+    return [
+        np.flatnonzero(selected & (atom_classes == number)) + 1
+        for number in range(classes)
+    ]
+
+
+def file_sha256(file: str) -> str:
+    """Return the SHA-256 hex digest of a file, read in 1 MiB chunks."""
+    digest = hashlib.sha256()
+    with open(file, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PropertyCache:
+    """
+    On-disk cache of structure-derived properties.
+    Entries are keyed by the SHA-256 of the input file plus the query string and
+    the least recently used entries are evicted when the cache exceeds max_size MB."""
+
+    def __init__(self, directory: Optional[str] = None, max_size: float = 64) -> None:
+        if not directory:
+            directory = os.environ.get(
+                "DESMOND_BUILDER_CACHE",
+                os.path.join(
+                    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                    "desmond_builder",
+                ),
+            )
+        self.directory = directory
+        self.max_bytes = int(float(max_size) * 1024 * 1024)
+
+    def path(self, file_hash: str, query: str) -> str:
+        key = hashlib.sha256(f"{file_hash}:{query}".encode("utf8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, file_hash: str, query: str):
+        entry = self.path(file_hash, query)
+        try:
+            with open(entry, "r", encoding="utf8") as fd:
+                value = json.load(fd)
+            # The modification time records the last use for the LRU eviction.
+            os.utime(entry)
+        except (OSError, ValueError):
+            # Missing, unreadable or evicted by another process meanwhile.
+            return None
+        return value
+
+    def set(self, file_hash: str, query: str, value) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        entry = self.path(file_hash, query)
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        with open(tmp_entry, "w", encoding="utf8") as fd:
+            json.dump(value, fd)
+        os.replace(tmp_entry, entry)
+        self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        if not path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def evict(self) -> None:
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+    def purge(self) -> None:
+        for _, _, entry in self.entries():
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+
 class ReadMaefile:
-    def __init__(self, file: str, desmond_path, windows: str) -> None:
+    def __init__(
+        self,
+        file: str,
+        desmond_path,
+        windows: str,
+        mae_reader: str = "native",
+        cache: Optional[PropertyCache] = None,
+        atom_table: Optional[MaeAtomTable] = None,
+    ) -> None:
         self.file = os.path.relpath(file)
         self.charge: int = 0
+        self.ct_charges: List[int] = []
         self.desmond_path = desmond_path
         self.windows = windows
+        self.mae_reader = mae_reader
+        self.cache = cache
+        self.file_hash: Optional[str] = None
+        self._atom_table: Optional[MaeAtomTable] = atom_table
+
+        self._asl_evaluator: Optional[AslEvaluator] = None
+
+    @property
+    def atom_table(self) -> MaeAtomTable:
+        """Atom table of the input file, read on first access and reused afterwards."""
+        if self._atom_table is None:
+            self._atom_table = MaeAtomTable(self.file)
+        return self._atom_table
+
+    def evaluate_asl(self, asl: str) -> List[int]:
+        """Return the atoms selected by an ASL expression, evaluated in-process."""
+        if self._asl_evaluator is None:
+            self._asl_evaluator = AslEvaluator(self.atom_table)
+        return self._asl_evaluator.atoms(asl)
+
+    def get_properties(
+        self, ion_awayfrom: Optional[str], selections: List[str]
+    ) -> Tuple[int, Optional[str]]:
+        """
+        Return the total charge and the ion_awayfrom atoms of the input file and
+        check that the restraint selections select atoms. Selections are evaluated
+        in-process with the native reader; the charge with mae_reader = schrodinger
+        and any unsupported selection are sent to schrod_script.py in one launch."""
+        native = self.mae_reader.lower() != "schrodinger"
+        selected: Dict[str, object] = {}
+        required = []
+        optional = []
+        if not native:
+            required.append({"name": "charge", "get": "charge"})
+        asls = ([ion_awayfrom] if ion_awayfrom else []) + selections
+        for asl in asls:
+            if asl in selected or any(q.get("asl") == asl for q in required + optional):
+                continue
+            if native:
+                try:
+                    selected[asl] = self.evaluate_asl(asl)
+                    continue
+                except ASLError:
+                    pass
+            query = {"name": asl, "get": "atoms_number", "asl": asl}
+            if asl == ion_awayfrom:
+                required.append(query)
+            else:
+                optional.append(query)
+        # Restraint selections alone do not justify starting the interpreter.
+        if required:
+            selected.update(self.run_queries(required + optional))
+        for asl in asls:
+            if asl not in selected:
+                if asl.strip().lower() not in SCHRODINGER_KEYWORDS:
+                    print(f"Warning: the selection '{asl}' could not be checked.")
+            elif not isinstance(selected[asl], list):
+                print(f"Warning: the selection '{asl}' could not be evaluated.")
+            elif not selected[asl]:
+                print(f"Warning: the selection '{asl}' does not select any atom.")
+        charge = self.get_charge() if native else selected["charge"]
+        if ion_awayfrom:
+            return charge, format_atoms_number(selected[ion_awayfrom])
+        return charge, None
 
     def get_charge(self):
+        if self.mae_reader.lower() == "schrodinger":
+            return self.get_charge_schrodinger()
+        self.ct_charges = read_mae_charges(self.file)
+        self.charge = sum(self.ct_charges)
+        if len(self.ct_charges) > 1:
+            print(f"Formal charge per CT: {self.ct_charges}")
+        print(f"Total formal charge: {self.charge}")
+        return self.charge
+
+    def get_charge_schrodinger(self):
         if self.windows.lower() in [
             "yes",
             "on",
@@ -2944,6 +2607,89 @@ class ReadMaefile:
         )[:-1]
         return atoms.replace(",", "")
 
+    def run_queries(self, queries: List[Dict[str, str]]) -> Dict:
+        """
+        Answer a list of queries with a single launch of schrod_script.py.
+        Each query is a dict with a 'name', a 'get' option ('charge' or
+        'atoms_number') and, for 'atoms_number', an 'asl' selection.
+        The cache, when given, is consulted before launching the interpreter."""
+        results = {}
+        missing = []
+        if self.cache is not None:
+            if self.file_hash is None:
+                self.file_hash = file_sha256(self.file)
+            for query in queries:
+                value = self.cache.get(self.file_hash, cache_query(query))
+                if value is None:
+                    missing.append(query)
+                else:
+                    results[query["name"]] = value
+        else:
+            missing = queries
+        if not missing:
+            return results
+        write_schrod_script()
+        if self.windows.lower() in [
+            "yes",
+            "on",
+            "true",
+        ]:
+            executable = os.path.join(self.desmond_path, "run.exe")
+        else:
+            executable = os.path.join(self.desmond_path, "run")
+        path_queries = "schrod_queries.json"
+        with open(path_queries, "w", encoding="utf8") as fd:
+            json.dump(missing, fd)
+        output = subprocess.check_output(
+            [
+                executable,
+                "schrod_script.py",
+                "-i",
+                self.file,
+                "-get",
+                "batch",
+                "-queries",
+                path_queries,
+            ],
+            universal_newlines=True,
+        )
+        # The answers are the last line, the interpreter may print banners before.
+        answers = json.loads(output.strip().splitlines()[-1])
+        for query in missing:
+            value = answers.get(query["name"])
+            # Failed queries are not cached, so they are retried on the next run.
+            if self.cache is not None and not isinstance(value, dict):
+                self.cache.set(self.file_hash, cache_query(query), value)
+            results[query["name"]] = value
+        return results
+
+
+def cache_query(query: Dict[str, str]) -> str:
+    """Return the cache key of a schrod_script.py query, without its name."""
+    return f"{query['get']}:{query.get('asl', '')}"
+
+
+def format_atoms_number(atoms: List[int]) -> str:
+    """Format a list of atom indices as a Desmond list: [1 2 3]."""
+    return "[" + " ".join(str(atom) for atom in atoms) + "]"
+
+
+def restraint_selections(protocol_opts: ProtocolOptions) -> List[str]:
+    """Return the unique ASL selections used by the active restraints."""
+    selections = []
+    for name in PROTOCOL_DEFAULTS:
+        if "_restraints_atoms_" not in name:
+            continue
+        atoms = getattr(protocol_opts, name)
+        number = getattr(protocol_opts, name.replace("_atoms_", "_number_"))
+        if atoms is None or sum(int(n) for n in str(number).split(",")) == 0:
+            continue
+        for asl in str(atoms).split(","):
+            asl = asl.strip()
+            if asl and asl not in selections:
+                selections.append(asl)
+    return selections
+
 
 def check_folder_analysis(folder_name: str):
     if path.isdir(folder_name):
@@ -2971,88 +2717,77 @@ class Builder:
 
     def write_input(self) -> None:
         path_preparation = str(self.basename + "_preparation.msj")
+        print("Preparing input files for system building...")
+        self.input_document().write(path_preparation)
+
+    def render_input(self) -> str:
+        """Return the text of the _preparation.msj file."""
+        return self.input_document().render()
+
+    def input_document(self) -> Document:
         outer_space, inner_space = identation(0)
         eq = "= "
-        with open(path_preparation, "w", encoding="utf8") as fd:
-            print("Preparing input files for system building...")
-            print(f"{outer_space}task {'{'}", file=fd)
-            print(f"{inner_space} task {eq}", '"desmond:auto"', file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(file=fd)
-            print(f"{outer_space}build_geometry {'{'}", file=fd)
-            # add_counterions block
-            outer_space, inner_space = identation(1)
-            if (
-                self.counterions.lower() in ["yes", "on", "true"]
-                and int(self.charge) != 0
-            ):
-                print(f"{outer_space} {'add_counterion = {'}", file=fd)
-                if int(self.charge) < 0:
-                    self.options.ion = self.options.counterions_positive_ion
-                elif int(self.charge) > 0:
-                    self.options.ion = self.options.counterions_negative_ion
-                print(f"{inner_space} {'ion':<16}{eq}{self.options.ion}", file=fd)
-                print(f"{inner_space} {'number':<16}{eq}{self.options.number}", file=fd)
-                print(f"{outer_space} {'}'}", file=fd)
-            # box block (mandatory)
-            print(f"{outer_space} {'box = {'}", file=fd)
-            print(f"{inner_space} {'shape':<16}{eq}{self.options.shape}", file=fd)
-            print(f"{inner_space} {'size':<16}{eq}[{self.options.size}]", file=fd)
-            print(
-                f"{inner_space} {'size_type':<16}{eq}{self.options.size_type}", file=fd
+        doc = Document()
+        doc.line(f"{outer_space}task {'{'}")
+        doc.line(f"{inner_space} task {eq}", '"desmond:auto"')
+        doc.line(f"{outer_space}{'}'}")
+        doc.line()
+        doc.line(f"{outer_space}build_geometry {'{'}")
+        # add_counterions block
+        outer_space, inner_space = identation(1)
+        if self.counterions.lower() in ["yes", "on", "true"] and int(self.charge) != 0:
+            doc.line(f"{outer_space} {'add_counterion = {'}")
+            if int(self.charge) < 0:
+                self.options.ion = self.options.counterions_positive_ion
+            elif int(self.charge) > 0:
+                self.options.ion = self.options.counterions_negative_ion
+            doc.line(f"{inner_space} {'ion':<16}{eq}{self.options.ion}")
+            doc.line(f"{inner_space} {'number':<16}{eq}{self.options.number}")
+            doc.line(f"{outer_space} {'}'}")
+        # box block (mandatory)
+        doc.line(f"{outer_space} {'box = {'}")
+        doc.line(f"{inner_space} {'shape':<16}{eq}{self.options.shape}")
+        doc.line(f"{inner_space} {'size':<16}{eq}[{self.options.size}]")
+        doc.line(f"{inner_space} {'size_type':<16}{eq}{self.options.size_type}")
+        doc.line(f"{outer_space} {'}'}")
+        outer_space, inner_space = identation(0)
+        # ions_away block
+        if self.ions_away.lower() in ["yes", "on", "true"]:
+            doc.line(
+                f"{inner_space} {'ion_awaydistance':<20}{eq}{self.options.ion_awaydistance}"
             )
-            print(f"{outer_space} {'}'}", file=fd)
-            outer_space, inner_space = identation(0)
-            # ions_away block
-            if self.ions_away.lower() in ["yes", "on", "true"]:
-                print(
-                    f"{inner_space} {'ion_awaydistance':<20}{eq}{self.options.ion_awaydistance}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'ion_awayfrom':<20}{eq}{self.atoms_number}",
-                    file=fd,
-                )
-            # override_forcefield block
-            print(
-                f"{inner_space} {'override_forcefield':<20}{eq}{self.options.override_forcefield}",
-                file=fd,
+            doc.line(f"{inner_space} {'ion_awayfrom':<20}{eq}{self.atoms_number}")
+        # override_forcefield block
+        doc.line(
+            f"{inner_space} {'override_forcefield':<20}{eq}{self.options.override_forcefield}"
+        )
+        # rezero_system block
+        doc.line(f"{inner_space} {'rezero_system':<20}{eq}{self.options.rezero_system}")
+        # salt block
+        outer_space, inner_space = identation(1)
+        if self.counterions.lower() in ["yes", "on", "true"]:
+            doc.line(f"{outer_space} {'salt = {'}")
+            doc.line(
+                f"{inner_space} {'concentration':<16}{eq}{self.options.concentration}"
             )
-            # rezero_system block
-            print(
-                f"{inner_space} {'rezero_system':<20}{eq}{self.options.rezero_system}",
-                file=fd,
+            doc.line(
+                f"{inner_space} {'negative_ion':<16}{eq}{self.options.negative_ion}"
             )
-            # salt block
-            outer_space, inner_space = identation(1)
-            if self.counterions.lower() in ["yes", "on", "true"]:
-                print(f"{outer_space} {'salt = {'}", file=fd)
-                print(
-                    f"{inner_space} {'concentration':<16}{eq}{self.options.concentration}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'negative_ion':<16}{eq}{self.options.negative_ion}",
-                    file=fd,
-                )
-                print(
-                    f"{inner_space} {'positive_ion':<16}{eq}{self.options.positive_ion}",
-                    file=fd,
-                )
-                print(f"{outer_space} {'}'}", file=fd)
-            # solvent block
-            outer_space, inner_space = identation(0)
-            print(f"{inner_space} {'solvent':<20}{eq}{self.options.solvent}", file=fd)
-            print(f"{outer_space}{'}'}", file=fd)
-            print(file=fd)
-            # assign_forcefield block
-            outer_space, inner_space = identation(0)
-            print(f"{outer_space}{'assign_forcefield {'}", file=fd)
-            print(
-                f"{inner_space} {'forcefield':<20}{eq}{self.options.forcefield}",
-                file=fd,
+            doc.line(
+                f"{inner_space} {'positive_ion':<16}{eq}{self.options.positive_ion}"
             )
-            print(f"{outer_space}{'}'}", file=fd)
+            doc.line(f"{outer_space} {'}'}")
+        # solvent block
+        outer_space, inner_space = identation(0)
+        doc.line(f"{inner_space} {'solvent':<20}{eq}{self.options.solvent}")
+        doc.line(f"{outer_space}{'}'}")
+        doc.line()
+        # assign_forcefield block
+        outer_space, inner_space = identation(0)
+        doc.line(f"{outer_space}{'assign_forcefield {'}")
+        doc.line(f"{inner_space} {'forcefield':<20}{eq}{self.options.forcefield}")
+        doc.line(f"{outer_space}{'}'}")
+        return doc
 
     def write_preparation_sh(self) -> None:
         q = '"'
@@ -3076,7 +2811,7 @@ class Builder:
             print(executable, args, file=fd)
 
     def run_preparation(self) -> None:
-        path_preparation_sh = str(self.basename + f"{self.suffix_prep}.sh")
+        path_preparation_sh = str(self.basename + "_preparation.sh")
         print("Preparing system...")
         subprocess.run(["bash", path_preparation_sh])
 
@@ -3087,22 +2822,54 @@ def write_schrod_script() -> None:
     script = """
 
 import argparse
+import json
 import sys
 
 from schrodinger.structure import StructureReader
 from schrodinger.application.jaguar.utils import get_total_charge
 from schrodinger.structutils.analyze import evaluate_asl
 
+# Desmond selections that are not part of the Maestro ASL language.
+DESMOND_ASL = {
+    "solute": "not (water or ions)",
+    "solute_heavy_atom": "(not (water or ions)) and (not atom.ele H)",
+    "solvent": "water",
+    "solvent_heavy_atom": "water and (not atom.ele H)",
+}
+
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("-i", "--input", help="Input file.")
     parser.add_argument("-get", help="Option.")
     parser.add_argument("-asl", help="ASL.")
+    parser.add_argument("-queries", help="JSON file with a list of queries.")
     opts = parser.parse_args(argv)
     return vars(opts)
 
 
+def read_structure(maefile):
+    structure = None
+    for st in StructureReader(maefile):
+        structure = st if structure is None else structure.merge(st)
+    return structure
+
+
+def run_queries(maefile, queries):
+    st = read_structure(maefile)
+    results = {}
+    for query in queries:
+        try:
+            if query["get"] == "charge":
+                results[query["name"]] = get_total_charge(st)
+            elif query["get"] == "atoms_number":
+                asl = DESMOND_ASL.get(query["asl"].strip(), query["asl"])
+                results[query["name"]] = evaluate_asl(st, asl)
+        except Exception as e_rror:
+            results[query["name"]] = {"error": str(e_rror)}
+    return results
+
+
 def get_total_charge_function(reader):
     for st in reader:
         charge = get_total_charge(st)
@@ -3125,6 +2892,10 @@ def main(argv):
     elif opts["get"] == "atoms_number":
         atoms = get_atoms_number_function(reader, opts["asl"])
         print(atoms)
+    elif opts["get"] == "batch":
+        with open(opts["queries"]) as fd:
+            queries = json.load(fd)
+        print(json.dumps(run_queries(maefile, queries)))
 
 
 if __name__ == "__main__":
@@ -3134,17 +2905,30 @@ if __name__ == "__main__":
         print(script, file=fd)
 
 
-def main(argv):
-    opts, build_opts, file_path, protocol_opts = parse_args(argv)
-    # Prepare the system
-    check_folder_analysis(opts.workdir)
-    file = file_path
-    basename = os.path.basename(file).split(".")[0]
-    system = ReadMaefile(file, opts.desmond_path, opts.windows)
-    write_schrod_script()
-    charge = system.get_charge()
-    if build_opts.ions_away.lower() in ["yes", "on", "true"]:
-        atoms_number = system.get_atoms_number(file, build_opts.ion_awayfrom)
+def prepare_system(
+    opts: Args, build_opts: BuilderOptions, protocol_opts: ProtocolOptions
+) -> "Builder":
+    """Write the preparation inputs of a system in the current folder."""
+    file = build_opts.file_path
+    if opts.mae_reader.lower() not in ["native", "schrodinger"]:
+        print(f"Error: Unknown mae_reader '{opts.mae_reader}'.")
+        print("Acceptable values are 'native' or 'schrodinger'.")
+        sys.exit()
+    cache = None if opts.no_cache else PropertyCache(opts.cache_dir, opts.cache_size)
+    system = ReadMaefile(
+        file,
+        opts.desmond_path,
+        opts.windows,
+        opts.mae_reader,
+        cache,
+        build_opts.atom_table,
+    )
+    ions_away = build_opts.ions_away.lower() in ["yes", "on", "true"]
+    charge, atoms_number = system.get_properties(
+        build_opts.ion_awayfrom if ions_away else None,
+        restraint_selections(protocol_opts),
+    )
+    if ions_away:
         builder = Builder(build_opts, charge, atoms_number)
         builder.write_input()
         builder.write_preparation_sh()
@@ -3152,17 +2936,1532 @@ def main(argv):
         builder = Builder(build_opts, charge)
         builder.write_input()
         builder.write_preparation_sh()
+    return builder
+
+
+# The job scripts of a system: (_preparation.sh, its -out.cms, [_md.sh, ...],
+# CPUs of each MD job), with absolute paths.
+SystemJobs: TypeAlias = Tuple[str, str, List[str], int]
+
+
+def system_jobs(
+    folder: str, basename: str, cpu: int, md_folders: Optional[List[str]] = None
+) -> SystemJobs:
+    folder = os.path.abspath(folder)
+    return (
+        os.path.join(folder, basename + "_preparation.sh"),
+        os.path.join(folder, basename + "_preparation-out.cms"),
+        [
+            os.path.join(os.path.abspath(md_folder), basename + "_md.sh")
+            for md_folder in (md_folders or [folder])
+        ],
+        cpu,
+    )
+
+
+MANIFEST = "desmond_builder.manifest.json"
+
+
+def fingerprint(*inputs) -> str:
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+class Manifest:
+    """
+    Fingerprints of the inputs of the artifacts of a workdir and the files they
+    produced. An artifact is up to date while its fingerprint is unchanged and
+    its files exist."""
+
+    def __init__(self, folder: str = ".") -> None:
+        self.path = os.path.join(folder, MANIFEST)
+        self.artifacts: Dict[str, Dict] = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r", encoding="utf8") as fd:
+                self.artifacts = json.load(fd).get("artifacts", {})
+
+    def up_to_date(self, name: str, key: str) -> bool:
+        artifact = self.artifacts.get(name)
+        return (
+            artifact is not None
+            and artifact["fingerprint"] == key
+            and all(os.path.isfile(file) for file in artifact["files"])
+        )
+
+    def record(self, name: str, key: str, files: List[str]) -> None:
+        self.artifacts[name] = {"fingerprint": key, "files": files}
+        with open(self.path, "w", encoding="utf8") as fd:
+            json.dump({"version": VERSION, "artifacts": self.artifacts}, fd, indent=2)
+
+
+def run_system(argv) -> List[SystemJobs]:
+    """Build a single system: parse_args -> ReadMaefile -> Builder -> Protocol."""
+    settings, build_geometry, protocol = parse_settings(argv)
+    variants = sweep_variants(settings["input"]) if settings.get("input") else []
+    if variants:
+        return run_sweep(Args(**settings), variants)
+    opts, build_opts, file_path, protocol_opts = make_options(
+        settings, build_geometry, protocol
+    )
+    if enabled(opts.incremental) and path.isdir(opts.workdir):
+        os.chdir(opts.workdir)
+    else:
+        check_folder_analysis(opts.workdir)
+    manifest = Manifest()
+    basename = build_opts.basename
+    # Prepare the system
+    preparation_key = fingerprint(
+        VERSION,
+        file_sha256(build_opts.file_path),
+        build_opts.opts,
+        build_opts.desmond_path,
+        build_opts.windows,
+    )
+    if manifest.up_to_date("preparation", preparation_key):
+        print("Preparation input files are up to date.")
+    else:
+        prepare_system(opts, build_opts, protocol_opts)
+        manifest.record(
+            "preparation",
+            preparation_key,
+            [
+                build_opts.filename,
+                basename + "_preparation.msj",
+                basename + "_preparation.sh",
+            ],
+        )
+        if path.isfile(basename + "_preparation-out.cms"):
+            print(f"Removing the outdated {basename}_preparation-out.cms")
+            os.remove(basename + "_preparation-out.cms")
     # Run the preparation
-    if str(protocol_opts.run_preparation).lower() in ["yes", "on", "true"]:
-        builder.run_preparation()
-    output_name_builder = os.path.join(opts.workdir, basename + "_system-out.cms")
+    output = basename + "_preparation-out.cms"
+    if (
+        enabled(protocol_opts.run_preparation)
+        and not opts.no_run
+        and not manifest.up_to_date("preparation_output", preparation_key)
+    ):
+        Builder(build_opts, 0).run_preparation()
+        if path.isfile(output):
+            manifest.record("preparation_output", preparation_key, [output])
     # Simulation protocol
-    protocol = Protocol(output_name_builder, build_opts, protocol_opts)
+    protocol = Protocol(file_path, build_opts, protocol_opts)
+    protocol_key = fingerprint(
+        preparation_key,
+        protocol_opts.opts,
+        protocol_opts.cpu,
+        protocol_opts.maxjob,
+        *[file_sha256(file) for file in protocol_opts.restraint_files()],
+    )
+    if manifest.up_to_date("protocol", protocol_key):
+        print("MD protocol input files are up to date.")
+    else:
+        protocol.write()
+        protocol.write_protocol_sh()
+        cfg_files = protocol.cfg_files() if enabled(protocol_opts.production) else []
+        manifest.record(
+            "protocol",
+            protocol_key,
+            [basename + "_md.msj"] + cfg_files + [basename + "_md.sh"],
+        )
+    # Run the simulation protocol
+    if (
+        enabled(protocol_opts.run_protocols)
+        and not opts.no_run
+        and not manifest.up_to_date("md", protocol_key)
+    ):
+        md_output = basename + "_md-out.cms"
+
+        def md_finished() -> bool:
+            # An output newer than _md.sh was written by the current protocol.
+            return (
+                path.isfile(md_output)
+                and cms_complete(md_output)
+                and path.getmtime(md_output) >= path.getmtime(basename + "_md.sh")
+            )
+
+        # _md.sh returns once the job is submitted: a job submitted by a previous
+        # build is recorded when its output is complete.
+        if not md_finished():
+            protocol.run_protocol()
+        if md_finished():
+            manifest.record("md", protocol_key, [md_output])
+        else:
+            print(
+                f"The MD job was submitted, it is recorded by the next incremental "
+                f"build once {md_output} is complete."
+            )
+    return [system_jobs(os.getcwd(), basename, protocol_opts.max_cpus())]
+
+
+# Separator of the values of a swept option, e.g. production_temp = 300|310|320
+SWEEP_SEPARATOR = "|"
+SweepVariant: TypeAlias = Tuple[
+    str, Dict[str, Dict[str, str]], Dict[Tuple[str, str], str]
+]
+
+
+SWEEP_UNSAFE = re.compile(r"[^\w.+-]")
+
+
+def sweep_label(key: str, value: str) -> str:
+    return f"{key}-{SWEEP_UNSAFE.sub('_', value)}"
+
+
+def sweep_variants(config_file: str) -> List[SweepVariant]:
+    """
+    Expand the swept options of a configuration file (`key = a|b|c`) into the
+    Cartesian product of variants. Each variant is (name, sections, swept values)."""
+    config = configparser.ConfigParser()
+    config.read([config_file])
+    sections = {name: dict(config.items(name)) for name in config.sections()}
+    swept = [
+        (section, key, [value.strip() for value in values.split(SWEEP_SEPARATOR)])
+        for section, items in sections.items()
+        for key, values in items.items()
+        if SWEEP_SEPARATOR in values
+    ]
+    variants = []
+    if not swept:
+        return variants
+    for values in itertools.product(*[values for _, _, values in swept]):
+        variant = {name: dict(items) for name, items in sections.items()}
+        swept_values = {}
+        for (section, key, _), value in zip(swept, values):
+            variant[section][key] = value
+            swept_values[(section, key)] = value
+        name = "_".join(
+            sweep_label(key, value) for (_, key), value in swept_values.items()
+        )
+        variants.append((name, variant, swept_values))
+    return variants
+
+
+def sweep_preparation(
+    task: Tuple[str, Args, BuilderOptions, ProtocolOptions, bool],
+) -> str:
+    """Write (and run) the preparation shared by a group of variants, in a worker."""
+    folder, opts, build_opts, protocol_opts, run = task
+    os.makedirs(folder)
+    os.chdir(folder)
+    builder = prepare_system(opts, build_opts, protocol_opts)
+    if run:
+        builder.run_preparation()
+    return folder
+
+
+def sweep_variant(task: Tuple[str, str, BuilderOptions, ProtocolOptions, bool]) -> str:
+    """Write (and run) the MD protocol of one variant, in a worker."""
+    folder, input_cms, build_opts, protocol_opts, run = task
+    os.makedirs(folder)
+    os.chdir(folder)
+    protocol = Protocol(build_opts.file_path, build_opts, protocol_opts, input_cms)
     protocol.write()
     protocol.write_protocol_sh()
-    # Run the simulation protocol
-    if str(protocol_opts.run_protocols).lower() in ["yes", "on", "true"]:
+    if run:
         protocol.run_protocol()
+    return folder
+
+
+def run_sweep(opts: Args, variants: List[SweepVariant]) -> List[SystemJobs]:
+    """
+    Generate every variant of a parameter sweep in its own sub-workdir.
+    Variants with the same [build_geometry] settings and input file share one
+    preparation, and the MD of a variant only runs once its preparation is done."""
+    workdir = os.path.abspath(opts.workdir)
+    groups: Dict[str, Tuple[str, list, list]] = {}
+    for name, sections, swept_values in variants:
+        settings = dict(vars(opts))
+        settings.update(
+            {
+                key: value
+                for (section, key), value in swept_values.items()
+                if section == "settings"
+            }
+        )
+        v_opts, v_build, _, v_protocol = make_options(
+            settings, sections["build_geometry"], sections["protocol"]
+        )
+        group_key = json.dumps(
+            [v_opts.file, sections["build_geometry"]], sort_keys=True
+        )
+        if group_key not in groups:
+            label = "_".join(
+                sweep_label(key, value)
+                for (section, key), value in swept_values.items()
+                if section in ["settings", "build_geometry"]
+            )
+            folder = os.path.join(
+                workdir, "preparation" + (f"_{label}" if label else "")
+            )
+            groups[group_key] = (folder, [v_opts, v_build, v_protocol], [])
+        groups[group_key][2].append((name, v_build, v_protocol))
+
+    check_folder_analysis(opts.workdir)
+    print(f"Parameter sweep: {len(variants)} variants, {len(groups)} preparations.")
+
+    def run_preparation(members) -> bool:
+        # A shared preparation runs if any of its variants asks for it.
+        return not opts.no_run and any(
+            enabled(v_protocol.run_preparation) for _, _, v_protocol in members
+        )
+
+    def variant_tasks(folder, members, run_protocols: bool):
+        # Each variant runs its MD according to its own run_protocols.
+        for name, v_build, v_protocol in members:
+            run = enabled(v_protocol.run_protocols) and not opts.no_run
+            if run != run_protocols:
+                continue
+            variant_folder = os.path.join(workdir, name)
+            input_cms = os.path.relpath(
+                os.path.join(folder, v_build.basename + "_preparation-out.cms"),
+                variant_folder,
+            )
+            yield (variant_folder, input_cms, v_build, v_protocol, run)
+
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        preparations = {
+            pool.submit(
+                sweep_preparation, (folder, *group, run_preparation(members))
+            ): group_key
+            for group_key, (folder, group, members) in groups.items()
+        }
+        # Variants that do not run their MD do not wait for the preparation.
+        jobs = [
+            pool.submit(sweep_variant, task)
+            for folder, _, members in groups.values()
+            for task in variant_tasks(folder, members, False)
+        ]
+        for future in concurrent.futures.as_completed(preparations):
+            folder = future.result()
+            print(f"Preparation ready: {os.path.relpath(folder, workdir)}")
+            members = groups[preparations[future]][2]
+            jobs += [
+                pool.submit(sweep_variant, task)
+                for task in variant_tasks(folder, members, True)
+            ]
+        for future in concurrent.futures.as_completed(jobs):
+            print(f"Variant ready: {os.path.relpath(future.result(), workdir)}")
+    return [
+        system_jobs(
+            folder,
+            members[0][1].basename,
+            members[0][2].max_cpus(),
+            [os.path.join(workdir, name) for name, _, _ in members],
+        )
+        for folder, _, members in groups.values()
+    ]
+
+
+@dataclass
+class CampaignResult:
+    """Status and timing of one system of a campaign."""
+
+    name: str
+    config: str
+    file: Optional[str]
+    workdir: str
+    status: str = "ok"
+    time: float = 0.0
+    error: str = ""
+    jobs: List[SystemJobs] = field(default_factory=list)
+
+
+def campaign_workdir(config: str) -> str:
+    parser = configparser.ConfigParser()
+    parser.read([config])
+    return parser.get("settings", "workdir", fallback="md_run")
+
+
+def campaign_file(config: str) -> str:
+    parser = configparser.ConfigParser()
+    parser.read([config])
+    return parser.get("settings", "file")
+
+
+def campaign_system(task: Tuple[str, Optional[str], str, List[str]]) -> CampaignResult:
+    """Run the whole pipeline for one system of a campaign, in a worker process."""
+    config, file, workdir, extra_argv = task
+    argv = ["-i", config, "--workdir", workdir] + extra_argv
+    if file is not None:
+        argv += ["--file", file]
+        name = os.path.basename(file).split(".")[0]
+    else:
+        name = os.path.basename(workdir.rstrip("/"))
+    result = CampaignResult(name, config, file, workdir)
+    log_file = workdir.rstrip("/") + ".log"
+    if os.path.dirname(log_file):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    with open(log_file, "w", encoding="utf8") as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                result.jobs = run_system(argv)
+            except BaseException as e_rror:
+                # sys.exit() is used for input errors, so SystemExit is a failure too.
+                result.status = "failed"
+                result.error = str(e_rror) or type(e_rror).__name__
+                traceback.print_exc()
+            finally:
+                os.chdir(cwd)
+    result.time = time.perf_counter() - start
+    return result
+
+
+def print_campaign_summary(
+    results: List[CampaignResult], summary: Optional[str]
+) -> None:
+    width = max([len(result.name) for result in results] + [6])
+    print()
+    print(f"{'System':<{width}}  {'Status':<7} {'Time (s)':>9}  Workdir")
+    for result in results:
+        print(
+            f"{result.name:<{width}}  {result.status:<7} {result.time:>9.2f}  {result.workdir}"
+        )
+        if result.error:
+            print(f"{'':<{width}}  {result.error}")
+    failed = sum(result.status != "ok" for result in results)
+    print(f"\n{len(results)} systems, {len(results) - failed} ok, {failed} failed.")
+    if summary:
+        with open(summary, "w", encoding="utf8") as fd:
+            print("system\tconfig\tfile\tworkdir\tstatus\ttime\terror", file=fd)
+            for result in results:
+                print(
+                    f"{result.name}\t{result.config}\t{result.file or ''}\t{result.workdir}"
+                    f"\t{result.status}\t{result.time:.3f}\t{result.error}",
+                    file=fd,
+                )
+
+
+def campaign(argv) -> List[CampaignResult]:
+    """Build many systems in parallel from several configs or one config and a .mae glob."""
+    parser = argparse.ArgumentParser(
+        prog="desmond_builder.py campaign",
+        description="Build many systems in parallel with a pool of processes.",
+    )
+    parser.add_argument(
+        "-i", "--input", nargs="+", required=True, help="Configuration files"
+    )
+    parser.add_argument(
+        "--files",
+        nargs="+",
+        help="Input .mae files or glob patterns; each one is built with every config",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count(), help="Number of processes"
+    )
+    parser.add_argument("--summary", help="Write the summary table to a TSV file")
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Launch the preparation of every system as soon as it is written, "
+        "and its MD as soon as the preparation output is complete",
+    )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        help="Number of concurrent Desmond jobs in --pipeline mode (default 1, "
+        "or as many as the node fits with --schedule)",
+    )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="Size the -cpu of every system from its atoms and the CPUs and memory "
+        "of the node, and pack the jobs onto the node in --pipeline mode",
+    )
+    parser.add_argument(
+        "--atoms-per-cpu",
+        type=int,
+        default=ATOMS_PER_CPU,
+        help="Solute atoms per CPU of an MD job with --schedule",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=5.0,
+        help="Seconds between checks of the preparation output in --pipeline mode",
+    )
+    args, extra_argv = parser.parse_known_args(argv)
+    if args.pipeline:
+        extra_argv = extra_argv + ["--no-run"]
+
+    tasks = []
+    for config in args.input:
+        if not os.path.isfile(config):
+            print(f"Error: file '{config}' does not exist. Please check the -i option.")
+            sys.exit(1)
+        workdir = campaign_workdir(config)
+        if not args.files:
+            tasks.append((config, None, workdir, extra_argv))
+            continue
+        for pattern in args.files:
+            for file in sorted(glob.glob(pattern)) or [pattern]:
+                file = os.path.abspath(file)
+                name = os.path.basename(file).split(".")[0]
+                tasks.append((config, file, os.path.join(workdir, name), extra_argv))
+
+    runner = JobRunner(args.max_jobs or 1)
+    if args.schedule:
+        tasks, runner = schedule_campaign(tasks, args.atoms_per_cpu, args.max_jobs)
+    print(f"Building {len(tasks)} systems with {args.workers} workers...")
+    if args.pipeline:
+        results = asyncio.run(pipeline_campaign(tasks, args.workers, runner, args.poll))
+        print_campaign_summary(results, args.summary)
+        return results
+    results: List[Optional[CampaignResult]] = [None] * len(tasks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(campaign_system, task): i for i, task in enumerate(tasks)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            print(f"[{result.status}] {result.name} ({result.time:.2f} s)")
+    print_campaign_summary(results, args.summary)
+    return results
+
+
+# Solute atoms per CPU of an MD job, and memory reserved for each concurrent job.
+ATOMS_PER_CPU = 1000
+MEMORY_PER_JOB = 2 * 1024**3
+
+
+def read_first_line(file: str) -> Optional[str]:
+    try:
+        with open(file, "r", encoding="utf8") as fd:
+            return fd.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpus() -> Optional[float]:
+    """CPU quota of the cgroup (v2 cpu.max or v1 CFS quota), None if unlimited."""
+    line = read_first_line("/sys/fs/cgroup/cpu.max")
+    if line:
+        quota, _, period = line.partition(" ")
+        return None if quota == "max" else int(quota) / int(period or 100000)
+    quota = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory() -> Optional[int]:
+    """Memory limit of the cgroup (v2 memory.max or v1 limit_in_bytes), if any."""
+    for file in [
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ]:
+        line = read_first_line(file)
+        if line and line.isdigit():
+            return int(line)
+    return None
+
+
+def available_memory() -> int:
+    line = None
+    if os.path.isfile("/proc/meminfo"):
+        with open("/proc/meminfo", "r", encoding="utf8") as fd:
+            line = next((line for line in fd if line.startswith("MemAvailable:")), None)
+    if line:
+        return int(line.split()[1]) * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+@dataclass
+class NodeResources:
+    """CPUs and memory (bytes) that the jobs of this machine can use."""
+
+    cpus: int
+    memory: int
+
+    @classmethod
+    def detect(cls) -> "NodeResources":
+        """Honour the CPU affinity of the process and the cgroup CPU and memory limits."""
+        if hasattr(os, "sched_getaffinity"):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+        quota = cgroup_cpus()
+        if quota:
+            cpus = min(cpus, max(1, int(quota)))
+        memory = available_memory()
+        limit = cgroup_memory()
+        if limit:
+            memory = min(memory, limit)
+        return cls(cpus, memory)
+
+
+class LocalScheduler:
+    """
+    Size the MD jobs for this machine. The CPUs of a job grow with the atoms of
+    its system, in powers of two up to every CPU of the node, and the node runs
+    as many jobs at a time as its CPUs and memory allow."""
+
+    def __init__(
+        self,
+        resources: Optional[NodeResources] = None,
+        atoms_per_cpu: int = ATOMS_PER_CPU,
+        memory_per_job: int = MEMORY_PER_JOB,
+    ) -> None:
+        self.resources = resources or NodeResources.detect()
+        self.atoms_per_cpu = max(1, atoms_per_cpu)
+        self.memory_per_job = max(1, memory_per_job)
+
+    @property
+    def slots(self) -> int:
+        """Number of jobs that fit in memory and CPUs at the same time."""
+        by_memory = self.resources.memory // self.memory_per_job
+        return max(1, min(self.resources.cpus, by_memory))
+
+    def job_cpus(self, atoms: int) -> int:
+        wanted = max(1, min(self.resources.cpus, -(-atoms // self.atoms_per_cpu)))
+        return 1 << (wanted.bit_length() - 1)
+
+    def job_slots(self, cpu: int) -> int:
+        return max(1, min(self.resources.cpus // max(1, cpu), self.slots))
+
+    def size_protocol(self, protocol_opts: ProtocolOptions, atoms: int) -> None:
+        """Replace the "auto" cpu and maxjob of a protocol by their values for this node."""
+        if str(protocol_opts.cpu).lower() == "auto":
+            protocol_opts.cpu = self.job_cpus(atoms)
+        if str(protocol_opts.maxjob).lower() == "auto":
+            protocol_opts.maxjob = self.job_slots(int(protocol_opts.cpu))
+
+
+@dataclass
+class Job:
+    """A generated _preparation.sh or _md.sh script, launched by a JobRunner."""
+
+    name: str
+    script: str
+    cpu: int = 1
+    status: str = "pending"
+    returncode: Optional[int] = None
+    time: float = 0.0
+    # Launch the command of the script with -WAIT, so the job ends with Desmond
+    wait: bool = False
+
+    @property
+    def folder(self) -> str:
+        return os.path.dirname(os.path.abspath(self.script))
+
+    @property
+    def log(self) -> str:
+        return os.path.splitext(os.path.abspath(self.script))[0] + "_job.log"
+
+
+def print_job_event(event: str, job: Job) -> None:
+    if event == "started":
+        print(f"[started] {job.name}")
+    else:
+        print(f"[{event}] {job.name} (exit code {job.returncode}, {job.time:.2f} s)")
+
+
+class JobRunner:
+    """
+    Launch job scripts as asyncio subprocesses, at most max_jobs at a time.
+    With cpus, the CPUs of the running jobs also add up to at most cpus, and a
+    waiting job starts as soon as its CPUs are free, so small jobs fill the gaps
+    left by large ones. The stdout and stderr of every job are streamed to its
+    own log file, and on_event(event, job) is called when a job is "started",
+    "done" or "failed". running_cpus counts the CPUs of the running jobs and
+    peak_cpus its maximum."""
+
+    def __init__(
+        self,
+        max_jobs: int = 1,
+        on_event: Optional[Callable[[str, Job], None]] = None,
+        cpus: Optional[int] = None,
+    ) -> None:
+        self.max_jobs = max(1, max_jobs)
+        self.on_event = on_event or print_job_event
+        self.cpus = cpus
+        self.free_cpus = cpus
+        self.running_cpus = 0
+        self.peak_cpus = 0
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.condition: Optional[asyncio.Condition] = None
+
+    async def run_job(self, job: Job) -> Job:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_jobs)
+            self.condition = asyncio.Condition()
+        cpu = min(job.cpu, self.cpus) if self.cpus else 0
+        async with self.condition:
+            await self.condition.wait_for(lambda: not cpu or self.free_cpus >= cpu)
+            if cpu:
+                self.free_cpus -= cpu
+        try:
+            async with self.semaphore:
+                self.running_cpus += cpu
+                self.peak_cpus = max(self.peak_cpus, self.running_cpus)
+                try:
+                    if self.cpus and self.running_cpus > self.cpus:
+                        raise RuntimeError(
+                            f"{self.running_cpus} CPUs running, more than {self.cpus}."
+                        )
+                    await self.launch(job)
+                finally:
+                    self.running_cpus -= cpu
+        finally:
+            async with self.condition:
+                if cpu:
+                    self.free_cpus += cpu
+                self.condition.notify_all()
+        return job
+
+    async def launch(self, job: Job) -> None:
+        job.status = "running"
+        self.on_event("started", job)
+        start = time.perf_counter()
+        command = ["bash", os.path.basename(job.script)]
+        if job.wait:
+            with open(job.script, "r", encoding="utf8") as fd:
+                text = fd.read().strip()
+            # multisim returns once the job is submitted unless it is given -WAIT.
+            if "\n" not in text and "-WAIT" not in shlex.split(text):
+                command = ["bash", "-c", f"{text} -WAIT"]
+        with open(job.log, "wb") as log:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    cwd=job.folder,
+                    stdout=log,
+                    stderr=asyncio.subprocess.STDOUT,
+                )
+            except OSError as e_rror:
+                log.write(f"Error: {e_rror}\n".encode())
+                job.returncode = -1
+            else:
+                try:
+                    job.returncode = await process.wait()
+                except asyncio.CancelledError:
+                    process.terminate()
+                    raise
+        job.time = time.perf_counter() - start
+        job.status = "done" if job.returncode == 0 else "failed"
+        self.on_event(job.status, job)
+
+    async def run_jobs(self, jobs: List[Job]) -> List[Job]:
+        self.semaphore = asyncio.Semaphore(self.max_jobs)
+        self.condition = asyncio.Condition()
+        self.free_cpus = self.cpus
+        self.running_cpus = self.peak_cpus = 0
+        return list(await asyncio.gather(*[self.run_job(job) for job in jobs]))
+
+    def run(self, jobs: List[Job]) -> List[Job]:
+        """Run the jobs to completion from synchronous code."""
+        return asyncio.run(self.run_jobs(jobs))
+
+
+def job_name(script: str) -> str:
+    folder = os.path.basename(os.path.dirname(os.path.abspath(script)))
+    return f"{folder}/{os.path.splitext(os.path.basename(script))[0]}"
+
+
+def jobs(argv) -> List[Job]:
+    """Launch generated _preparation.sh/_md.sh scripts concurrently with a JobRunner."""
+    parser = argparse.ArgumentParser(
+        prog="desmond_builder.py jobs",
+        description="Launch generated job scripts with a limit of concurrent jobs.",
+    )
+    parser.add_argument(
+        "scripts", nargs="+", help="Job scripts (.sh) or glob patterns to launch"
+    )
+    parser.add_argument(
+        "-j", "--max-jobs", type=int, default=1, help="Number of concurrent jobs"
+    )
+    args = parser.parse_args(argv)
+
+    scripts = []
+    for pattern in args.scripts:
+        scripts += sorted(glob.glob(pattern)) or [pattern]
+    missing = [script for script in scripts if not os.path.isfile(script)]
+    if missing:
+        print(f"Error: job script '{missing[0]}' does not exist.")
+        sys.exit(1)
+    print(f"Launching {len(scripts)} jobs, {args.max_jobs} at a time...")
+    results = JobRunner(args.max_jobs).run(
+        [Job(job_name(script), script, wait=True) for script in scripts]
+    )
+    failed = sum(job.status != "done" for job in results)
+    print(f"\n{len(results)} jobs, {len(results) - failed} done, {failed} failed.")
+    return results
+
+
+def job_folder(workdir: str, file: str) -> str:
+    """
+    The folder of the _md.sh that a file under workdir belongs to: the nearest
+    folder holding one, from the folder of the file up to workdir. Sweep variants
+    and campaign systems each have their own."""
+    folder = os.path.dirname(os.path.abspath(file))
+    while not glob.glob(os.path.join(folder, "*_md.sh")):
+        if folder == workdir or not folder.startswith(workdir):
+            return os.path.dirname(os.path.abspath(file))
+        folder = os.path.dirname(folder)
+    return folder
+
+
+def latest_checkpoints(workdir: str) -> Dict[Tuple[str, str], str]:
+    """
+    The newest .cpt file of every job found under a workdir, by the folder of its
+    _md.sh and its checkpoint name."""
+    checkpoints: Dict[Tuple[str, str], str] = {}
+    for file in glob.glob(os.path.join(workdir, "**", "*.cpt"), recursive=True):
+        key = (job_folder(workdir, file), os.path.basename(file)[: -len(".cpt")])
+        if key not in checkpoints or os.path.getmtime(file) > os.path.getmtime(
+            checkpoints[key]
+        ):
+            checkpoints[key] = file
+    return checkpoints
+
+
+CFG_TIME = re.compile(r"^(time\s*=\s*)(\S+)$", re.MULTILINE)
+
+
+def production_cfg(workdir: str, jobname: str) -> Optional[str]:
+    """The production cfg of a job: _md_replica<i>.cfg for a replica, else _md.cfg."""
+    replica = re.search(r"-replica(\d+)$", jobname)
+    suffix = f"_md_replica{replica.group(1)}.cfg" if replica else "_md.cfg"
+    files = glob.glob(os.path.join(workdir, "*" + suffix))
+    return files[0] if files else None
+
+
+def extend_production(workdir: str, jobname: str, ps: float) -> float:
+    """
+    Add ps to the time of the production cfg of a job, so that later extensions
+    add up, and return it."""
+    cfg_file = production_cfg(workdir, jobname)
+    if cfg_file is None:
+        print(f"Error: no production cfg file in '{workdir}' to extend '{jobname}'.")
+        sys.exit(1)
+    with open(cfg_file, "r", encoding="utf8") as fd:
+        text = fd.read()
+    match = CFG_TIME.search(text)
+    if match is None:
+        print(f"Error: '{cfg_file}' has no time setting.")
+        sys.exit(1)
+    last_time = float(match.group(2)) + ps
+    with open(cfg_file, "w", encoding="utf8") as fd:
+        fd.write(CFG_TIME.sub(rf"\g<1>{last_time}", text, count=1))
+    return last_time
+
+
+def extend_script(workdir: str, jobname: str, checkpoint: str, last_time: float) -> str:
+    """
+    Write <jobname>_extend.sh, which restores a finished production from its
+    checkpoint up to last_time with the desmond of the _md.sh of workdir, the
+    folder of the job."""
+    md_scripts = glob.glob(os.path.join(workdir, "*_md.sh"))
+    if not md_scripts:
+        print(f"Error: no _md.sh file in '{workdir}'.")
+        sys.exit(1)
+    with open(md_scripts[0], "r", encoding="utf8") as fd:
+        args = shlex.split(fd.readline())
+    multisim = args[0]
+    executable = os.path.join(os.path.dirname(os.path.dirname(multisim)), "desmond")
+    if multisim.endswith(".exe"):
+        executable += ".exe"
+    cpu = args[args.index("-cpu") + 1] if "-cpu" in args else "1"
+    folder = os.path.dirname(checkpoint)
+    input_cms = f"{jobname}-in.cms"
+    if not os.path.isfile(os.path.join(folder, input_cms)):
+        print(f"Error: '{input_cms}' of checkpoint '{checkpoint}' does not exist.")
+        sys.exit(1)
+    args = f"-HOST localhost -JOBNAME {jobname} -cpu {cpu} -restore {os.path.basename(checkpoint)} -in {input_cms}"
+    path_script = os.path.join(folder, f"{jobname}_extend.sh")
+    with open(path_script, "w", encoding="utf8") as fd:
+        print(executable, args, f"-cfg mdsim.last_time={last_time}", "-WAIT", file=fd)
+    return path_script
+
+
+def resume_script(md_script: str) -> Optional[str]:
+    """
+    The script that finishes the multisim workflow of an _md.sh: None if its
+    -out.cms is complete, <jobname>_resume.sh, which restarts it from the stage
+    after the last one completed, if it wrote a -multisim_checkpoint, else the
+    _md.sh itself if it was started."""
+    folder = os.path.dirname(md_script)
+    with open(md_script, "r", encoding="utf8") as fd:
+        args = shlex.split(fd.readline())
+    jobname = args[args.index("-JOBNAME") + 1]
+    output = args[args.index("-o") + 1] if "-o" in args else f"{jobname}-out.cms"
+    if os.path.isfile(os.path.join(folder, output)) and cms_complete(
+        os.path.join(folder, output)
+    ):
+        return None
+    checkpoint = f"{jobname}-multisim_checkpoint"
+    if not os.path.isfile(os.path.join(folder, checkpoint)):
+        started = os.path.isfile(os.path.join(folder, f"{jobname}_multisim.log"))
+        return md_script if started else None
+    command = [args[0], "-HOST", "localhost", "-JOBNAME", jobname]
+    for option in ["-maxjob", "-cpu", "-o"]:
+        if option in args:
+            command += [option, args[args.index(option) + 1]]
+    command += ["-RESTART", checkpoint]
+    if "-LOCAL" in args:
+        command.append("-LOCAL")
+    path_script = os.path.join(folder, f"{jobname}_resume.sh")
+    with open(path_script, "w", encoding="utf8") as fd:
+        print(" ".join(shlex.quote(arg) for arg in command), "-WAIT", file=fd)
+    return path_script
+
+
+def restart(argv, command: str) -> List[Job]:
+    """Resume the unfinished workflows of a workdir, or extend its productions."""
+    parser = argparse.ArgumentParser(
+        prog=f"desmond_builder.py {command}",
+        description=(
+            "Restore the productions of a workdir from their latest checkpoint, and "
+            "extend them by --ns nanoseconds."
+            if command == "extend"
+            else "Restart the unfinished multisim workflows of a workdir from their "
+            "-multisim_checkpoint."
+        ),
+    )
+    parser.add_argument("workdir", help="Workdir of the system")
+    if command == "extend":
+        parser.add_argument(
+            "--ns",
+            type=float,
+            required=True,
+            help="Nanoseconds to add to the production",
+        )
+    parser.add_argument(
+        "--no-run", action="store_true", help="Only write the restart scripts"
+    )
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir)
+    if not os.path.isdir(workdir):
+        print(f"Error: workdir '{args.workdir}' does not exist.")
+        sys.exit(1)
+    scripts = []
+    folders = set()
+    if command == "resume":
+        for md_script in sorted(
+            glob.glob(os.path.join(workdir, "**", "*_md.sh"), recursive=True)
+        ):
+            script = resume_script(md_script)
+            if script is not None:
+                scripts.append(script)
+                folders.add(os.path.dirname(md_script))
+                print(
+                    f"{os.path.relpath(md_script, workdir)}: {os.path.relpath(script)}"
+                )
+    else:
+        # The new length of every extended cfg, so that each is extended once.
+        extended: Dict[Optional[str], float] = {}
+        for (folder, jobname), checkpoint in sorted(
+            latest_checkpoints(workdir).items()
+        ):
+            cfg_file = production_cfg(folder, jobname)
+            if cfg_file not in extended:
+                extended[cfg_file] = extend_production(folder, jobname, args.ns * 1000)
+            scripts.append(
+                extend_script(folder, jobname, checkpoint, extended[cfg_file])
+            )
+            folders.add(folder)
+            print(
+                f"{os.path.relpath(checkpoint, workdir)}: {os.path.relpath(scripts[-1])}"
+            )
+    if not scripts:
+        print(f"Nothing to {command} in '{args.workdir}'.")
+        return []
+    if args.no_run:
+        return []
+    results = JobRunner(len(scripts)).run(
+        [Job(job_name(script), script, wait=True) for script in scripts]
+    )
+    for folder in sorted(folders):
+        write_metrics(folder)
+    return results
+
+
+MULTISIM_STAGE = re.compile(r"\bStage (\d+)")
+STAGE_JOB = re.compile(r"_(\d+)$")
+# A setting of a stage of a .msj file, or a top-level setting of a .cfg file.
+MSJ_SETTING = re.compile(r"^    ([\w.]+)\s*=\s*(.*?)\s*$")
+CFG_SETTING = re.compile(r"^(\w+)\s*=\s*(.*?)\s*$")
+
+
+class FileFollower:
+    """Return the complete lines appended to a file since the previous call."""
+
+    def __init__(self, file: str) -> None:
+        self.file = file
+        self.offset = 0
+        self.partial = b""
+
+    def new_lines(self) -> List[str]:
+        try:
+            size = os.path.getsize(self.file)
+        except OSError:
+            return []
+        if size < self.offset:
+            # The file was truncated or replaced: follow it from the start.
+            self.offset, self.partial = 0, b""
+        if size == self.offset:
+            return []
+        with open(self.file, "rb") as fd:
+            fd.seek(self.offset)
+            data = fd.read(size - self.offset)
+        self.offset += len(data)
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return [line.decode("utf8", "replace") for line in lines]
+
+
+def msj_stages(msj_file: str) -> Dict[int, Dict[str, str]]:
+    """The settings of every stage of a .msj file, by stage number (task is 1)."""
+    stages: Dict[int, Dict[str, str]] = {}
+    with open(msj_file, "r", encoding="utf8") as fd:
+        for line in fd:
+            if line.startswith(("task", "simulate")):
+                stages[len(stages) + 1] = {}
+            match = MSJ_SETTING.match(line)
+            if match and stages:
+                stages[len(stages)].setdefault(match.group(1), match.group(2))
+    return stages
+
+
+def msj_stage_times(msj_file: str) -> Dict[int, float]:
+    """The time (ps) of every stage of a .msj file, by stage number."""
+    return {
+        stage: float(settings["time"])
+        for stage, settings in msj_stages(msj_file).items()
+        if "time" in settings
+    }
+
+
+def cfg_settings(cfg_file: str) -> Dict[str, str]:
+    """The top-level settings of a .cfg file."""
+    settings = {}
+    with open(cfg_file, "r", encoding="utf8") as fd:
+        for line in fd:
+            match = CFG_SETTING.match(line)
+            if match:
+                settings[match.group(1)] = match.group(2)
+    return settings
+
+
+@dataclass
+class JobProgress:
+    """Simulated time and speed of a Desmond job, from the progress of its .ene file."""
+
+    system: str
+    job: str
+    stage: str = ""
+    time: float = 0.0
+    target: Optional[float] = None
+    ns_per_day: Optional[float] = None
+    first: Optional[Tuple[float, float]] = None
+
+    def update(self, time_ps: float, now: float) -> None:
+        # The rows read by the first refresh were written before it: the speed is
+        # measured from the last of them on.
+        if self.first is None or now <= self.first[0]:
+            self.first = (now, time_ps)
+        elif now > self.first[0] and time_ps > self.first[1]:
+            days = (now - self.first[0]) / 86400
+            self.ns_per_day = (time_ps - self.first[1]) / 1000 / days
+        self.time = time_ps
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """Simulated time (ps) left, if the length of the job is known."""
+        return None if self.target is None else max(0.0, self.target - self.time)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Wall time (s) left at the current speed."""
+        if self.remaining == 0:
+            return 0.0
+        if self.remaining is None or not self.ns_per_day:
+            return None
+        return self.remaining / 1000 / self.ns_per_day * 86400
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds == 0:
+        return "done"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Inotify:
+    """Wait for changes in folders with Linux inotify, called through ctypes."""
+
+    # IN_MODIFY | IN_MOVED_TO | IN_CREATE
+    MASK = 0x00000002 | 0x00000080 | 0x00000100
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders: Set[str] = set()
+
+    def watch(self, folder: str) -> None:
+        if folder in self.folders:
+            return
+        descriptor = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(folder), self.MASK
+        )
+        if descriptor >= 0:
+            self.folders.add(folder)
+
+    def wait(self, timeout: float) -> bool:
+        """Wait until a watched folder changes or timeout seconds pass."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+
+class Monitor:
+    """
+    Follow the .ene and log files of the jobs under workdirs or campaign folders.
+    Only the bytes appended since the previous refresh are read."""
+
+    def __init__(self, folders: List[str]) -> None:
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.followers: Dict[str, FileFollower] = {}
+        self.jobs: Dict[str, JobProgress] = {}
+        self.stages: Dict[str, str] = {}
+
+    def system_name(self, folder: str, root: str) -> str:
+        relative = os.path.relpath(folder, root)
+        return os.path.basename(root) if relative == "." else relative
+
+    def follower(self, file: str) -> FileFollower:
+        if file not in self.followers:
+            self.followers[file] = FileFollower(file)
+        return self.followers[file]
+
+    def job_target(self, folder: str, root: str, job: str) -> Optional[float]:
+        """Length (ps) of a job: its stage in _md.msj or its production cfg."""
+        while True:
+            stage = STAGE_JOB.search(job)
+            msj_files = glob.glob(os.path.join(folder, "*_md.msj"))
+            if stage and msj_files:
+                return msj_stage_times(msj_files[0]).get(int(stage.group(1)))
+            cfg_file = production_cfg(folder, job)
+            if cfg_file is not None:
+                with open(cfg_file, "r", encoding="utf8") as fd:
+                    match = CFG_TIME.search(fd.read())
+                return float(match.group(2)) if match else None
+            if folder == root or not folder.startswith(root):
+                return None
+            folder = os.path.dirname(folder)
+
+    def scan(self) -> List[str]:
+        """Find new jobs and return every folder to watch."""
+        folders = []
+        for root in self.folders:
+            for folder, _, files in os.walk(root):
+                folders.append(folder)
+                for file in files:
+                    path_file = os.path.join(folder, file)
+                    if file.endswith(".ene") and path_file not in self.jobs:
+                        job = file[: -len(".ene")]
+                        self.jobs[path_file] = JobProgress(
+                            self.system_name(folder, root),
+                            job,
+                            target=self.job_target(folder, root, job),
+                        )
+                    elif file.endswith("_multisim.log"):
+                        self.follower(path_file)
+        return folders
+
+    def refresh(self) -> None:
+        now = time.time()
+        for ene_file, job in self.jobs.items():
+            for line in self.follower(ene_file).new_lines():
+                fields = line.split()
+                if fields and not line.startswith("#"):
+                    try:
+                        job.update(float(fields[0]), now)
+                    except ValueError:
+                        continue
+        for file, follower in self.followers.items():
+            if file.endswith("_multisim.log"):
+                root = next(root for root in self.folders if file.startswith(root))
+                system = self.system_name(os.path.dirname(file), root)
+                for line in follower.new_lines():
+                    match = MULTISIM_STAGE.search(line)
+                    if match:
+                        self.stages[system] = match.group(1)
+
+    def table(self) -> List[str]:
+        width = max([len(job.system) for job in self.jobs.values()] + [6])
+        job_width = max([len(job.job) for job in self.jobs.values()] + [8])
+        rows = [
+            f"{'System':<{width}} {'Job':<{job_width}} {'Stage':>5} {'Time (ns)':>10} "
+            f"{'Total (ns)':>10} {'ns/day':>8} {'ETA':>10}"
+        ]
+        systems: Dict[str, List[JobProgress]] = {}
+        for job in self.jobs.values():
+            systems.setdefault(job.system, []).append(job)
+        for system, jobs in sorted(systems.items()):
+            for job in sorted(jobs, key=lambda job: job.job):
+                total = "-" if job.target is None else f"{job.target / 1000:.3f}"
+                speed = "-" if job.ns_per_day is None else f"{job.ns_per_day:.1f}"
+                stage = STAGE_JOB.search(job.job)
+                rows.append(
+                    f"{system:<{width}} {job.job:<{job_width}} "
+                    f"{stage.group(1) if stage else '-':>5} "
+                    f"{job.time / 1000:>10.3f} {total:>10} {speed:>8} {format_eta(job.eta):>10}"
+                )
+            running = [job for job in jobs if job.remaining and job.ns_per_day]
+            remaining = [job.remaining for job in jobs]
+            if None in remaining or (sum(remaining) and not running):
+                eta = None
+            else:
+                speed = sum(job.ns_per_day for job in running)
+                eta = sum(remaining) / 1000 / speed * 86400 if running else 0.0
+            rows.append(
+                f"{system:<{width}} {'(system)':<{job_width}} "
+                f"{self.stages.get(system, '-'):>5} "
+                f"{sum(job.time for job in jobs) / 1000:>10.3f} {'':>10} {'':>8} "
+                f"{format_eta(eta):>10}"
+            )
+        return rows
+
+
+def monitor(argv) -> None:
+    """Show the simulated time, ns/day and ETA of the jobs of workdirs or campaigns."""
+    parser = argparse.ArgumentParser(
+        prog="desmond_builder.py monitor",
+        description="Follow the .ene and log files of the jobs of workdirs or campaigns.",
+    )
+    parser.add_argument("folders", nargs="+", help="Workdirs or campaign folders")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10.0,
+        help="Seconds between refreshes without changes (or between polls)",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Print the table once and exit"
+    )
+    parser.add_argument(
+        "--poll", action="store_true", help="Poll the files instead of using inotify"
+    )
+    args = parser.parse_args(argv)
+
+    watcher = None
+    if not args.poll and not args.once and sys.platform.startswith("linux"):
+        try:
+            watcher = Inotify()
+        except (OSError, AttributeError):
+            watcher = None
+    progress = Monitor(args.folders)
+    clear = "\033[H\033[J" if sys.stdout.isatty() and not args.once else ""
+    try:
+        while True:
+            folders = progress.scan()
+            progress.refresh()
+            print(clear + "\n".join(progress.table()), flush=True)
+            if args.once:
+                return
+            if watcher is None:
+                time.sleep(args.interval)
+                continue
+            for folder in folders:
+                watcher.watch(folder)
+            if watcher.wait(args.interval):
+                # Let a burst of writes settle before the next refresh.
+                time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+
+
+# Performance and wall time reported in the log of a Desmond job, e.g.
+# "Chemical time: 1200.0000 ps, Step: 480000, ns/day: 231.372" and
+# "Total wall clock time: 450.21" (seconds, or h:m:s).
+LOG_NS_PER_DAY = re.compile(r"ns/day\s*[:=]?\s*([0-9.]+)")
+LOG_WALL_TIME = re.compile(
+    r"[Ww]all[ _-]?(?:clock[ _-]?)?time\s*[:=]?\s*([0-9]+(?::[0-9]+)*(?:\.[0-9]*)?)"
+)
+METRICS = "metrics.json"
+
+
+def last_ene_time(ene_file: str) -> Optional[float]:
+    """The simulated time (ps) of the last row of a .ene file, reading only its tail."""
+    with open(ene_file, "rb") as fd:
+        fd.seek(max(0, os.fstat(fd.fileno()).st_size - 4096))
+        lines = fd.read().decode("utf8", "replace").splitlines()
+    for line in reversed(lines):
+        fields = line.split()
+        if fields and not line.startswith("#"):
+            try:
+                return float(fields[0])
+            except ValueError:
+                continue
+    return None
+
+
+def log_values(log_file: str) -> Tuple[Optional[float], Optional[float]]:
+    """The last ns/day and wall time (s) reported in the log of a Desmond job."""
+    ns_per_day = wall_time = None
+    if os.path.isfile(log_file):
+        with open(log_file, "r", encoding="utf8", errors="replace") as fd:
+            for line in fd:
+                match = LOG_NS_PER_DAY.search(line)
+                if match:
+                    ns_per_day = float(match.group(1))
+                match = LOG_WALL_TIME.search(line)
+                if match:
+                    wall_time = 0.0
+                    for field in match.group(1).split(":"):
+                        wall_time = wall_time * 60 + float(field)
+    return ns_per_day, wall_time
+
+
+def stage_metrics(
+    ene_file: str, workdir: str, stages: Dict[int, Dict[str, str]], cpu: Optional[str]
+) -> Dict:
+    """Throughput and settings of the job (stage or replica) that wrote a .ene file."""
+    folder = os.path.dirname(ene_file)
+    job = os.path.basename(ene_file)[: -len(".ene")]
+    stage = STAGE_JOB.search(job)
+    # multisim -c gives every stage the settings of the _md.cfg, which the
+    # stages of the .msj override.
+    cfg_file = production_cfg(workdir, job[: stage.start()] if stage else job)
+    settings = cfg_settings(cfg_file) if cfg_file else {}
+    if stage:
+        settings = {**settings, **stages.get(int(stage.group(1)), {})}
+        kind = "relaxation"
+    else:
+        kind = "production"
+    simulated = last_ene_time(ene_file)
+    ns_per_day, wall_time = log_values(os.path.join(folder, job + ".log"))
+    input_cms = os.path.join(folder, job + "-in.cms")
+    if wall_time is None and simulated and ns_per_day:
+        wall_time = simulated / 1000 / ns_per_day * 86400
+    if wall_time is None and os.path.isfile(input_cms):
+        # Without a log, the job wrote its -in.cms when it started and its .ene
+        # until it ended.
+        wall_time = os.path.getmtime(ene_file) - os.path.getmtime(input_cms)
+        wall_time = wall_time if wall_time > 0 else None
+    if ns_per_day is None and simulated and wall_time:
+        ns_per_day = simulated / 1000 / (wall_time / 86400)
+    atoms = None
+    for structure in [input_cms] + glob.glob(
+        os.path.join(workdir, "*_preparation-out.cms")
+    ):
+        if os.path.isfile(structure):
+            # A .cms holds the full_system CT followed by its component CTs.
+            blocks = MaeAtomTable(structure).blocks
+            atoms = blocks[0][0] if blocks else None
+            break
+    return {
+        "job": job,
+        "stage": int(stage.group(1)) if stage else None,
+        "type": kind,
+        "title": settings.get("title", "").strip('"'),
+        "time_ps": float(settings["time"]) if "time" in settings else None,
+        "simulated_ps": simulated,
+        "wall_time_s": wall_time,
+        "ns_per_day": ns_per_day,
+        "atoms": atoms,
+        "cutoff": settings.get("cutoff_radius"),
+        "timestep": settings.get("timestep"),
+        "cpu": int(settings.get("cpu", cpu or 1)),
+    }
+
+
+def write_metrics(workdir: str) -> Dict:
+    """Collect the metrics of every job of a workdir into its metrics.json."""
+    workdir = os.path.abspath(workdir)
+    msj_files = glob.glob(os.path.join(workdir, "*_md.msj"))
+    stages = msj_stages(msj_files[0]) if msj_files else {}
+    cpu = None
+    md_scripts = glob.glob(os.path.join(workdir, "*_md.sh"))
+    if md_scripts:
+        with open(md_scripts[0], "r", encoding="utf8") as fd:
+            args = shlex.split(fd.readline())
+        cpu = args[args.index("-cpu") + 1] if "-cpu" in args else None
+    ene_files = sorted(
+        glob.glob(os.path.join(workdir, "**", "*.ene"), recursive=True),
+        key=lambda file: (os.path.getmtime(file), file),
+    )
+    metrics = {
+        "version": VERSION,
+        "workdir": workdir,
+        "stages": [stage_metrics(file, workdir, stages, cpu) for file in ene_files],
+    }
+    with open(os.path.join(workdir, METRICS), "w", encoding="utf8") as fd:
+        json.dump(metrics, fd, indent=2)
+    return metrics
+
+
+def metrics(argv) -> None:
+    """Write the metrics.json of workdirs and print their throughput."""
+    parser = argparse.ArgumentParser(
+        prog="desmond_builder.py metrics",
+        description="Collect the wall time, simulated time, ns/day, atoms, cutoff, "
+        "timesteps and CPUs of every stage of workdirs into their metrics.json.",
+    )
+    parser.add_argument("workdirs", nargs="+", help="Workdirs of the systems")
+    args = parser.parse_args(argv)
+    for workdir in args.workdirs:
+        if not os.path.isdir(workdir):
+            print(f"Error: workdir '{workdir}' does not exist.")
+            sys.exit(1)
+        stages = write_metrics(workdir)["stages"]
+        print(f"{os.path.join(workdir, METRICS)}: {len(stages)} stages")
+        for stage in stages:
+            speed = stage["ns_per_day"]
+            print(
+                f"    {stage['job']:<24} {stage['type']:<10} "
+                f"{(stage['simulated_ps'] or 0) / 1000:>10.3f} ns "
+                f"{'-' if speed is None else f'{speed:.1f}':>8} ns/day"
+            )
+
+
+def cms_complete(file: str) -> bool:
+    """
+    Check that a .cms/.mae file was fully written: it starts with the header block
+    and its trailer closes the last block."""
+    with open(file, "rb") as fd:
+        head = fd.read(64).lstrip()
+        fd.seek(max(0, os.fstat(fd.fileno()).st_size - 64))
+        tail = fd.read().rstrip()
+    return head.startswith(b"{") and tail.endswith(b"}")
+
+
+async def wait_for_output(file: str, job: "asyncio.Future[Job]", poll: float) -> bool:
+    """
+    Wait until the output of a job is complete: its size did not change between
+    two checks and its trailer is parseable. Return False if the job finished
+    without a complete output."""
+    size = -1
+    while True:
+        finished = job.done()
+        new_size = os.path.getsize(file) if os.path.isfile(file) else -1
+        if new_size > 0 and new_size == size and cms_complete(file):
+            return True
+        if finished and (new_size == size or job.result().status != "done"):
+            return False
+        size = new_size
+        await asyncio.sleep(poll)
+
+
+async def pipeline_jobs(runner: JobRunner, entry: SystemJobs, poll: float) -> List[Job]:
+    """Run the preparation of a system and submit its MD once the output is ready."""
+    preparation_sh, output, md_scripts, cpu = entry
+    preparation = asyncio.ensure_future(
+        runner.run_job(Job(job_name(preparation_sh), preparation_sh))
+    )
+    if not await wait_for_output(output, preparation, poll):
+        print(f"[skipped] MD of {job_name(preparation_sh)}: {output} is not complete")
+        return [await preparation]
+    print(f"[ready] {job_name(output)}")
+    md_jobs = [
+        asyncio.ensure_future(
+            runner.run_job(Job(job_name(script), script, cpu, wait=True))
+        )
+        for script in md_scripts
+    ]
+    for md_job, script in zip(md_jobs, md_scripts):
+        job = await md_job
+        # The metrics need the production output, so it is checked first.
+        md_output = script[: -len(".sh")] + "-out.cms"
+        if job.status == "done" and await wait_for_output(md_output, md_job, poll):
+            write_metrics(job.folder)
+        elif job.status == "done":
+            job.status = "failed"
+            print(f"[failed] {job.name}: {md_output} is not complete")
+    return [await preparation] + [md_job.result() for md_job in md_jobs]
+
+
+def schedule_campaign(
+    tasks: List[Tuple[str, Optional[str], str, List[str]]],
+    atoms_per_cpu: int,
+    max_jobs: Optional[int],
+) -> Tuple[List[Tuple[str, Optional[str], str, List[str]]], JobRunner]:
+    """
+    Give every system of a campaign its -cpu from its atoms, largest systems
+    first, and a JobRunner that packs their jobs onto the CPUs of the node."""
+    scheduler = LocalScheduler(atoms_per_cpu=atoms_per_cpu)
+    resources = scheduler.resources
+    print(
+        f"Node: {resources.cpus} CPUs, {resources.memory / 1024**3:.1f} GB, "
+        f"{scheduler.slots} job slots."
+    )
+    sized = []
+    for config, file, workdir, extra_argv in tasks:
+        cpu = scheduler.job_cpus(len(MaeAtomTable(file or campaign_file(config))))
+        argv = extra_argv + ["--cpu", str(cpu)]
+        sized.append((cpu, (config, file, workdir, argv)))
+    sized.sort(key=lambda item: -item[0])
+    runner = JobRunner(max_jobs or scheduler.slots, cpus=resources.cpus)
+    return [task for _, task in sized], runner
+
+
+async def pipeline_campaign(
+    tasks: List[Tuple[str, Optional[str], str, List[str]]],
+    workers: int,
+    runner: JobRunner,
+    poll: float,
+) -> List[CampaignResult]:
+    """
+    Write the systems of a campaign in a pool of processes while the jobs of the
+    systems already written run: the preparation starts as soon as its system is
+    written, and the MD as soon as the preparation output is complete."""
+    loop = asyncio.get_running_loop()
+    results: List[Optional[CampaignResult]] = [None] * len(tasks)
+
+    async def build(index, task, pool):
+        result = await loop.run_in_executor(pool, campaign_system, task)
+        results[index] = result
+        print(f"[{result.status}] {result.name} ({result.time:.2f} s)")
+        entries = await asyncio.gather(
+            *[pipeline_jobs(runner, entry, poll) for entry in result.jobs]
+        )
+        failed = [job.name for jobs in entries for job in jobs if job.status != "done"]
+        if failed:
+            result.status = "failed"
+            result.error = f"job {', '.join(failed)} failed"
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        await asyncio.gather(*[build(i, task, pool) for i, task in enumerate(tasks)])
+    return results
+
+
+def main(argv):
+    if argv and argv[0] == "campaign":
+        results = campaign(argv[1:])
+        if any(result.status != "ok" for result in results):
+            sys.exit(1)
+        return
+    if argv and argv[0] == "jobs":
+        if any(job.status != "done" for job in jobs(argv[1:])):
+            sys.exit(1)
+        return
+    if argv and argv[0] == "metrics":
+        metrics(argv[1:])
+        return
+    if argv and argv[0] == "monitor":
+        monitor(argv[1:])
+        return
+    if argv and argv[0] in ["resume", "extend"]:
+        if any(job.status != "done" for job in restart(argv[1:], argv[0])):
+            sys.exit(1)
+        return
+    run_system(argv)
 
 
 if __name__ == "__main__":
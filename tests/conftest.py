@@ -0,0 +1,56 @@
+"""
+Configuration files of examples/5yok.mae, written with the fake desmond_path tree
+so that systems can be built without Schrodinger.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONFIG = """[settings]
+workdir = md_run
+file = {root}/examples/5yok.mae
+desmond_path = {root}/benchmarks/fake_desmond
+
+[build_geometry]
+counterions = yes
+ions_away = yes
+ion_awaydistance = 5.0
+ion_awayfrom = protein
+size = 20.0 20.0 20.0
+salt = yes
+concentration = 0.15
+solvent = TIP3P
+
+[protocol]
+stage1 = yes
+stage2 = yes
+stage3 = yes
+stage4 = yes
+stage5 = yes
+production = yes
+production_time = 100
+run_preparation = no
+run_protocols = no
+"""
+
+
+@pytest.fixture
+def write_config(tmp_path, monkeypatch):
+    """Write config.dat in a temporary folder, with extra [protocol] lines."""
+    monkeypatch.chdir(tmp_path)
+
+    def write(*protocol_lines: str) -> str:
+        file = os.path.join(str(tmp_path), "config.dat")
+        with open(file, "w", encoding="utf8") as fd:
+            fd.write(
+                CONFIG.format(root=ROOT)
+                + "".join(f"{line}\n" for line in protocol_lines)
+            )
+        return file
+
+    return write
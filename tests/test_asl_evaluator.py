@@ -0,0 +1,165 @@
+"""
+Compare the in-process ASL evaluator with the selections of examples/5yok.mae read
+row by row with shlex.
+"""
+import os
+import shlex
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+MAE = os.path.join(ROOT, "examples", "5yok.mae")
+
+
+def read_atoms(file: str) -> list:
+    """The m_atom rows of a single-CT .mae file as dicts of stripped values."""
+    with open(file, "r", encoding="utf8") as fd:
+        lines = fd.read().splitlines()
+    start = next(i for i, line in enumerate(lines) if "m_atom[" in line)
+    separator = lines.index("  :::", start)
+    columns = [
+        line.strip()
+        for line in lines[start + 1 : separator]
+        if line.strip() and not line.strip().startswith("#")
+    ]
+    atoms = []
+    for line in lines[separator + 1 :]:
+        if line.strip() == ":::":
+            break
+        values = shlex.split(line)[1:]
+        atoms.append({key: value.strip() for key, value in zip(columns, values)})
+    return atoms
+
+
+ATOMS = read_atoms(MAE)
+
+
+def numbers(condition) -> list:
+    return [i for i, atom in enumerate(ATOMS, 1) if condition(atom)]
+
+
+@pytest.fixture(scope="module")
+def evaluator():
+    return desmond_builder.AslEvaluator(desmond_builder.MaeAtomTable(MAE))
+
+
+@pytest.mark.parametrize(
+    "asl, condition",
+    [
+        ("all", lambda atom: True),
+        ("res.num 1-10", lambda atom: 1 <= int(atom["i_m_residue_number"]) <= 10),
+        ("chain.name A", lambda atom: atom["s_m_chain_name"] == "A"),
+        ('res.ptype "PRO "', lambda atom: atom["s_m_pdb_residue_name"] == "PRO"),
+        ('atom.ptype " CA "', lambda atom: atom["s_m_pdb_atom_name"] == "CA"),
+        (
+            'res.ptype "GLY ","ALA " and atom.ptype " N  "',
+            lambda atom: atom["s_m_pdb_residue_name"] in ["GLY", "ALA"]
+            and atom["s_m_pdb_atom_name"] == "N",
+        ),
+        ("heavy_atom", lambda atom: int(atom["i_m_atomic_number"]) > 1),
+        ("solute_heavy_atom", lambda atom: int(atom["i_m_atomic_number"]) > 1),
+        (
+            "res.num 5 and not atom.ele H",
+            lambda atom: atom["i_m_residue_number"] == "5"
+            and atom["i_m_atomic_number"] != "1",
+        ),
+    ],
+)
+def test_selections(evaluator, asl, condition):
+    expected = numbers(condition)
+    assert expected
+    assert evaluator.atoms(asl) == expected
+
+
+def test_atom_numbers(evaluator):
+    assert evaluator.atoms("atom.num 3-5,9") == [3, 4, 5, 9]
+
+
+def test_protein_selects_the_amino_acids(evaluator):
+    protein = evaluator.atoms("protein")
+    residues = {ATOMS[i - 1]["s_m_pdb_residue_name"] for i in protein}
+    assert residues <= desmond_builder.PROTEIN_RESIDUES
+    assert len(protein) == len(
+        numbers(
+            lambda atom: atom["s_m_pdb_residue_name"]
+            in desmond_builder.PROTEIN_RESIDUES
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "asl",
+    ["ligand", 'res.ptype "XYZ "', "within 5 protein"],
+)
+def test_left_to_schrodinger(evaluator, asl):
+    with pytest.raises(desmond_builder.ASLError):
+        evaluator.evaluate(asl)
+
+
+SOLVATED = """{
+  s_m_m2io_version
+  :::
+  2.0.0
+}
+
+f_m_ct {
+  s_m_title
+  :::
+  "full system"
+  m_atom[6] {
+    # First column is atom index #
+    i_m_atomic_number
+    i_m_formal_charge
+    s_m_pdb_residue_name
+    i_m_residue_number
+    s_m_chain_name
+    s_m_pdb_atom_name
+    :::
+    1 6 0 "ALA " 1 A " CA "
+    2 1 0 "ALA " 1 A " HA "
+    3 8 0 "HOH " 2 W " O  "
+    4 1 0 "HOH " 2 W " H1 "
+    5 11 1 "NA  " 3 I "NA  "
+    6 17 -1 "CL  " 4 I "CL  "
+    :::
+  }
+  m_bond[3] {
+    # First column is bond index #
+    i_m_from
+    i_m_to
+    i_m_order
+    :::
+    1 1 2 1
+    2 3 4 1
+    3 4 3 1
+    :::
+  }
+}
+"""
+
+
+@pytest.fixture
+def solvated(tmp_path):
+    file = os.path.join(str(tmp_path), "solvated.mae")
+    with open(file, "w", encoding="utf8") as fd:
+        fd.write(SOLVATED)
+    return desmond_builder.AslEvaluator(desmond_builder.MaeAtomTable(file))
+
+
+@pytest.mark.parametrize(
+    "asl, expected",
+    [
+        ("ions", [5, 6]),
+        ("solute", [1, 2]),
+        ("solute_heavy_atom", [1]),
+        ("solvent_heavy_atom", [3]),
+        ("not (water or ions)", [1, 2]),
+    ],
+)
+def test_desmond_keywords(solvated, asl, expected):
+    assert solvated.atoms(asl) == expected
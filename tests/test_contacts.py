@@ -0,0 +1,84 @@
+"""
+Find the close pairs of a set of points with the cell list, and the contacts of
+examples/5yok.mae used by the contact distance restraints.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+MAE = os.path.join(ROOT, "examples", "5yok.mae")
+
+
+def brute_force_pairs(coordinates: np.ndarray, cutoff: float) -> set:
+    return {
+        (i, j)
+        for i in range(len(coordinates))
+        for j in range(i + 1, len(coordinates))
+        if np.sum((coordinates[i] - coordinates[j]) ** 2) < cutoff**2
+    }
+
+
+@pytest.mark.parametrize("seed, cutoff", [(0, 1.0), (1, 2.5), (2, 10.0)])
+def test_close_pairs(seed, cutoff):
+    coordinates = np.random.default_rng(seed).uniform(-5.0, 5.0, (300, 3))
+    i, j = desmond_builder.close_pairs(coordinates, cutoff)
+    assert np.all(i < j)
+    assert set(zip(i.tolist(), j.tolist())) == brute_force_pairs(coordinates, cutoff)
+
+
+def test_close_pairs_of_few_points():
+    for coordinates in [np.zeros((0, 3)), np.zeros((1, 3))]:
+        i, j = desmond_builder.close_pairs(coordinates, 4.0)
+        assert i.size == j.size == 0
+    i, j = desmond_builder.close_pairs(np.array([[0.0, 0, 0], [0, 0, 3.9]]), 4.0)
+    assert (i.tolist(), j.tolist()) == ([0], [1])
+
+
+@pytest.fixture(scope="module")
+def table():
+    return desmond_builder.MaeAtomTable(MAE)
+
+
+@pytest.mark.parametrize("kind", ["hbond", "heavy"])
+def test_contact_map(table, kind):
+    contacts = desmond_builder.contact_map(table, kind, 3.5, "protein", None, 3)
+    assert contacts
+    assert contacts == sorted(contacts)
+    first = np.array([contact[0] for contact in contacts]) - 1
+    second = np.array([contact[1] for contact in contacts]) - 1
+    assert np.all(first < second)
+    distances = np.linalg.norm(
+        table.coordinates[first] - table.coordinates[second], axis=1
+    )
+    assert np.allclose(distances, [contact[2] for contact in contacts])
+    assert np.all(distances < 3.5)
+    if kind == "hbond":
+        assert set(table.element[first]) | set(table.element[second]) <= {"N", "O"}
+    else:
+        assert np.all(table.atomic_number[first] > 1)
+        assert np.all(table.atomic_number[second] > 1)
+    # Residues of a chain less than 3 apart are not in contact.
+    same_chain = table.chain[first] == table.chain[second]
+    gap = np.abs(table.residue_number[first] - table.residue_number[second])
+    assert np.all(~same_chain | (gap >= 3))
+
+
+def test_contact_map_with_partner(table):
+    contacts = desmond_builder.contact_map(
+        table, "heavy", 4.0, "res.num 1-20", "res.num 50-200", 3
+    )
+    assert contacts
+    evaluator = desmond_builder.AslEvaluator(table)
+    selected = evaluator.evaluate("res.num 1-20")
+    partner = evaluator.evaluate("res.num 50-200")
+    for first, second, _ in contacts:
+        assert (selected[first - 1] and partner[second - 1]) or (
+            partner[first - 1] and selected[second - 1]
+        )
@@ -0,0 +1,69 @@
+"""
+Rebuild only the artifacts of a workdir whose inputs changed, with the
+fingerprints of its manifest.
+"""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def test_manifest(tmp_path):
+    file = tmp_path / "a.msj"
+    file.write_text("task {}\n")
+    manifest = desmond_builder.Manifest(str(tmp_path))
+    assert not manifest.up_to_date("protocol", "key")
+    manifest.record("protocol", "key", [str(file)])
+    assert manifest.up_to_date("protocol", "key")
+    assert not manifest.up_to_date("protocol", "other")
+    # The manifest is read back from the workdir.
+    manifest = desmond_builder.Manifest(str(tmp_path))
+    assert manifest.up_to_date("protocol", "key")
+    file.unlink()
+    assert not manifest.up_to_date("protocol", "key")
+
+
+def test_fingerprint():
+    key = desmond_builder.fingerprint("1.0", {"a": 1, "b": [2, 3]})
+    assert key == desmond_builder.fingerprint("1.0", {"b": [2, 3], "a": 1})
+    assert key != desmond_builder.fingerprint("1.0", {"a": 1, "b": [3, 2]})
+
+
+def test_incremental_rebuild(write_config, tmp_path, monkeypatch, capsys):
+    workdir = os.path.join(str(tmp_path), "md_run")
+
+    def build(*protocol_lines: str) -> dict:
+        monkeypatch.chdir(tmp_path)
+        desmond_builder.run_system(
+            ["-i", write_config(*protocol_lines), "--incremental"]
+        )
+        return {
+            file: os.path.getmtime(os.path.join(workdir, file))
+            for file in ["5yok_preparation.msj", "5yok_md.msj", "5yok_md.cfg"]
+        }
+
+    first = build()
+    with open(
+        os.path.join(workdir, desmond_builder.MANIFEST), "r", encoding="utf8"
+    ) as fd:
+        artifacts = json.load(fd)["artifacts"]
+    assert sorted(artifacts) == ["preparation", "protocol"]
+    assert "5yok_md.cfg" in artifacts["protocol"]["files"]
+    capsys.readouterr()
+
+    assert build() == first
+    output = capsys.readouterr().out
+    assert "Preparation input files are up to date." in output
+    assert "MD protocol input files are up to date." in output
+
+    changed = build("production_temp = 310")
+    output = capsys.readouterr().out
+    assert "Preparation input files are up to date." in output
+    assert "MD protocol input files are up to date." not in output
+    assert changed["5yok_preparation.msj"] == first["5yok_preparation.msj"]
+    with open(os.path.join(workdir, "5yok_md.cfg"), "r", encoding="utf8") as fd:
+        assert "310" in fd.read()
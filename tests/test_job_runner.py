@@ -0,0 +1,55 @@
+"""
+Run sleep scripts with a JobRunner and check the CPUs of the running jobs.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def sleep_jobs(folder, cpus: list) -> list:
+    jobs = []
+    for i, cpu in enumerate(cpus):
+        script = os.path.join(str(folder), f"job_{i}.sh")
+        with open(script, "w", encoding="utf8") as fd:
+            fd.write("sleep 0.2\n")
+        jobs.append(desmond_builder.Job(f"job_{i}", script, cpu))
+    return jobs
+
+
+def test_running_cpus_stay_within_total(tmp_path):
+    runner = desmond_builder.JobRunner(8, on_event=lambda event, job: None, cpus=4)
+    jobs = runner.run(sleep_jobs(tmp_path, [2, 2, 3, 1, 4, 1]))
+    assert [job.status for job in jobs] == ["done"] * 6
+    assert runner.peak_cpus == 4
+    assert runner.running_cpus == 0
+
+
+def test_max_jobs_without_cpus(tmp_path):
+    runner = desmond_builder.JobRunner(2, on_event=lambda event, job: None)
+    jobs = runner.run(sleep_jobs(tmp_path, [1, 1, 1]))
+    assert [job.status for job in jobs] == ["done"] * 3
+    assert runner.peak_cpus == 0
+
+
+def test_job_larger_than_total_is_clamped(tmp_path):
+    runner = desmond_builder.JobRunner(2, on_event=lambda event, job: None, cpus=2)
+    jobs = runner.run(sleep_jobs(tmp_path, [8, 1]))
+    assert [job.status for job in jobs] == ["done"] * 2
+    assert runner.peak_cpus <= 2
+
+
+def test_wait_is_added_by_the_runner(tmp_path):
+    script = os.path.join(str(tmp_path), "5yok_md.sh")
+    with open(script, "w", encoding="utf8") as fd:
+        fd.write("echo multisim -LOCAL\n")
+    runner = desmond_builder.JobRunner(1, on_event=lambda event, job: None)
+    (job,) = runner.run([desmond_builder.Job("md", script, wait=True)])
+    assert job.status == "done"
+    with open(job.log, "r", encoding="utf8") as fd:
+        assert fd.read() == "multisim -LOCAL -WAIT\n"
+    with open(script, "r", encoding="utf8") as fd:
+        assert fd.read() == "echo multisim -LOCAL\n"
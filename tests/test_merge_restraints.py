@@ -0,0 +1,77 @@
+"""
+Merge the restraints of a stage with the same parameters into one term, and
+report the terms eliminated by the compaction of a protocol.
+"""
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+Restraint = desmond_builder.Restraint
+
+
+def test_atom_ranges():
+    assert desmond_builder.atom_ranges(np.array([1, 2, 3, 4, 7, 9, 10])) == "1-4,7,9-10"
+    assert desmond_builder.atom_ranges(np.array([], dtype=int)) == ""
+    numbers = desmond_builder.atom_numbers(["9-10", "1-4", "3", "7"])
+    assert numbers.tolist() == [1, 2, 3, 4, 7, 9, 10]
+
+
+def test_positional_restraints_of_one_force():
+    merged = desmond_builder.merge_restraints(
+        [
+            Restraint("pos", "posre_harm", ["atom.num 1-3"], "10.0"),
+            Restraint("pos", "posre_harm", ["protein"], "5.0"),
+            Restraint("pos", "posre_harm", ["atom.num 4,8"], "10.0"),
+            Restraint("pos", "posre_harm", ["ligand"], "10.0"),
+            Restraint("pos", "posre_harm", ["protein"], "5.0"),
+        ]
+    )
+    assert merged == [
+        Restraint("pos", "posre_harm", ["(ligand) or (atom.num 1-4,8)"], "10.0"),
+        Restraint("pos", "posre_harm", ["protein"], "5.0"),
+    ]
+
+
+def test_repeated_restraints():
+    merged = desmond_builder.merge_restraints(
+        [
+            Restraint("dist", "stretch_harm", ["a", "b"], "1.0", "3.0"),
+            Restraint("dist", "stretch_harm", ["b", "a"], "1.0", "3.0"),
+            Restraint("dist", "stretch_harm", ["a", "b"], "1.0", "4.0"),
+            Restraint("ang", "angle_harm", ["a", "b", "c"], "1.0", "90"),
+            Restraint("ang", "angle_harm", ["c", "b", "a"], "1.0", "90"),
+            Restraint("imp", "improper_harm", ["a", "b", "c", "d"], "1.0", "0"),
+            Restraint("imp", "improper_harm", ["d", "c", "b", "a"], "1.0", "0"),
+        ]
+    )
+    assert [(r.kind, r.atoms, r.constant) for r in merged] == [
+        ("dist", ["a", "b"], "3.0"),
+        ("dist", ["a", "b"], "4.0"),
+        ("ang", ["a", "b", "c"], "90"),
+        ("imp", ["a", "b", "c", "d"], "0"),
+        ("imp", ["d", "c", "b", "a"], "0"),
+    ]
+
+
+def test_compaction_of_a_stage(write_config, capsys):
+    config = write_config(
+        "restraints_compact = yes",
+        "stage1_restraints_number_pos = 3",
+        "stage1_restraints_atoms_pos = atom.num 1-5,atom.num 6-9,protein",
+        "stage1_restraints_forces_pos = 50.0,50.0,50.0",
+    )
+    _, build_opts, file_path, protocol_opts = desmond_builder.parse_args(["-i", config])
+    protocol = desmond_builder.Protocol(file_path, build_opts, protocol_opts)
+    restraints = protocol.stage_restraints("stage1")
+    assert restraints == [
+        Restraint("pos", "posre_harm", ["(protein) or (atom.num 1-9)"], "50.0")
+    ]
+    assert protocol.stage_restraints("stage1") is restraints
+    output = capsys.readouterr().out
+    assert output.count("Restraint compaction (stage1): 2 of 3 terms eliminated") == 1
@@ -0,0 +1,55 @@
+"""
+Collect the metrics of the jobs of a workdir from their .log and .ene files.
+"""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def write_job(folder: str, job: str, times: list, log: str = "") -> None:
+    with open(os.path.join(folder, f"{job}-in.cms"), "w", encoding="utf8") as fd:
+        fd.write("{}\n")
+    with open(os.path.join(folder, f"{job}.ene"), "w", encoding="utf8") as fd:
+        fd.write("# 0:time (ps)   1:E (kcal/mol)\n")
+        fd.write("".join(f"{time:.4f} -1000.0\n" for time in times))
+    if log:
+        with open(os.path.join(folder, f"{job}.log"), "w", encoding="utf8") as fd:
+            fd.write(log)
+
+
+def test_metrics_from_logs(tmp_path, write_config):
+    desmond_builder.run_system(["-i", write_config()])
+    folder = os.path.join(str(tmp_path), "md_run")
+    write_job(
+        folder,
+        "5yok_md_3",
+        [6.0, 12.0],
+        "Chemical time:         6.0000 ps, Step:   3000, ns/day:      100.000\n"
+        "Chemical time:        12.0000 ps, Step:   6000, ns/day:      120.000\n"
+        "Total wall clock time: 0:01:30\n",
+    )
+    write_job(folder, "5yok_md", [50.0, 100.0])
+    os.utime(os.path.join(folder, "5yok_md-in.cms"), (1000.0, 1000.0))
+    os.utime(os.path.join(folder, "5yok_md.ene"), (1086.4, 1086.4))
+
+    desmond_builder.write_metrics(folder)
+    with open(os.path.join(folder, "metrics.json"), "r", encoding="utf8") as fd:
+        stages = {stage["job"]: stage for stage in json.load(fd)["stages"]}
+    relaxation = stages["5yok_md_3"]
+    assert relaxation["type"] == "relaxation"
+    assert relaxation["simulated_ps"] == 12.0
+    assert relaxation["ns_per_day"] == 120.0
+    assert relaxation["wall_time_s"] == 90.0
+    # The stage sets its timestep and takes the cutoff of the _md.cfg.
+    assert relaxation["timestep"] == "[0.001 0.001 0.003]"
+    assert relaxation["cutoff"] == "9.0"
+    # Without a log, the wall time comes from the -in.cms and .ene of the job.
+    production = stages["5yok_md"]
+    assert production["type"] == "production"
+    assert abs(production["wall_time_s"] - 86.4) < 1e-6
+    assert abs(production["ns_per_day"] - 100.0) < 1e-6
@@ -0,0 +1,47 @@
+"""
+Measure the speed of jobs from the rows appended to their .ene files.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+# Wall time (s) of 1 ps at 100 ns/day.
+PS_AT_100 = 86400 / 100 / 1000
+
+
+def test_job_in_progress():
+    job = desmond_builder.JobProgress("system", "5yok_md")
+    # The monitor starts while the job is at 500 ps: the first refresh reads it all.
+    for time_ps in range(0, 501, 10):
+        job.update(float(time_ps), 1000.0)
+    assert job.ns_per_day is None
+    assert job.time == 500.0
+    job.update(510.0, 1000.0 + 10 * PS_AT_100)
+    assert job.ns_per_day == pytest.approx(100.0)
+    job.update(530.0, 1000.0 + 30 * PS_AT_100)
+    assert job.ns_per_day == pytest.approx(100.0)
+
+
+def test_monitor_refresh(tmp_path, monkeypatch):
+    ene_file = os.path.join(str(tmp_path), "5yok_md.ene")
+    with open(ene_file, "w", encoding="utf8") as fd:
+        fd.write("# 0:time (ps)\n")
+        fd.writelines(f"{time_ps:.4f} -1000.0\n" for time_ps in range(0, 501, 10))
+    monitor = desmond_builder.Monitor([str(tmp_path)])
+    monitor.scan()
+    clock = [1000.0]
+    monkeypatch.setattr(desmond_builder.time, "time", lambda: clock[0])
+    monitor.refresh()
+    (job,) = monitor.jobs.values()
+    assert job.ns_per_day is None
+    with open(ene_file, "a", encoding="utf8") as fd:
+        fd.write("520.0000 -1000.0\n")
+    clock[0] += 20 * PS_AT_100
+    monitor.refresh()
+    assert job.ns_per_day == pytest.approx(100.0)
@@ -0,0 +1,46 @@
+"""
+Seed the production replicas from the master velocity seed and write one cfg
+file per replica.
+"""
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def test_single_production_keeps_the_seed():
+    assert desmond_builder.replica_seeds(1234, 1) == [1234]
+
+
+def test_replica_seeds_are_reproducible():
+    seeds = desmond_builder.replica_seeds(1234, 4)
+    assert seeds == desmond_builder.replica_seeds("1234", 4)
+    assert len(set(seeds)) == 4
+    assert all(0 <= seed < 2**31 for seed in seeds)
+    # More replicas keep the seeds of the first ones.
+    assert desmond_builder.replica_seeds(1234, 2) == seeds[:2]
+    assert desmond_builder.replica_seeds(1235, 4) != seeds
+
+
+def test_replica_cfg_files(write_config, tmp_path):
+    config = write_config(
+        "production_replicas = 3", "production_randomize_vel_seed = 7"
+    )
+    desmond_builder.run_system(["-i", config])
+    workdir = os.path.join(str(tmp_path), "md_run")
+    assert not os.path.isfile(os.path.join(workdir, "5yok_md.cfg"))
+    seeds = []
+    for i in range(1, 4):
+        cfg_file = os.path.join(workdir, f"5yok_md_replica{i}.cfg")
+        with open(cfg_file, "r", encoding="utf8") as fd:
+            seeds.append(int(re.search(r"^\s*seed\s*=\s*(\d+)", fd.read(), re.M)[1]))
+    assert seeds == desmond_builder.replica_seeds(7, 3)
+    with open(os.path.join(workdir, "5yok_md.msj"), "r", encoding="utf8") as fd:
+        msj = fd.read()
+    for i in range(1, 4):
+        assert f'cfg_file     = "5yok_md_replica{i}.cfg"' in msj
+        assert f'"$MASTERJOBNAME-replica{i}"' in msj
@@ -0,0 +1,42 @@
+"""
+Resume a multisim workflow of the fake desmond_path tree that failed during the
+equilibration.
+"""
+
+import glob
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def test_resume_failure_during_equilibration(tmp_path, write_config, monkeypatch):
+    desmond_builder.run_system(["-i", write_config()])
+    folder = os.path.join(str(tmp_path), "md_run")
+    monkeypatch.setenv("FAKE_DESMOND_SPEEDUP", "1000000")
+    monkeypatch.setenv("FAKE_DESMOND_WAIT", "1")
+    (preparation,) = glob.glob(os.path.join(folder, "*_preparation.sh"))
+    subprocess.run(["bash", preparation], cwd=folder, check=True)
+    (md_script,) = glob.glob(os.path.join(folder, "*_md.sh"))
+    env = dict(os.environ, FAKE_DESMOND_FAIL_STAGE="4")
+    failed = subprocess.run(["bash", md_script], cwd=folder, env=env, check=False)
+    assert failed.returncode != 0
+    assert os.path.isfile(os.path.join(folder, "5yok_md_3-out.cms"))
+    assert not os.path.isfile(os.path.join(folder, "5yok_md_4-out.cms"))
+
+    jobs = desmond_builder.restart([folder], "resume")
+    assert [job.status for job in jobs] == ["done"]
+    assert jobs[0].script == os.path.join(folder, "5yok_md_resume.sh")
+    with open(jobs[0].script, "r", encoding="utf8") as fd:
+        assert "-RESTART 5yok_md-multisim_checkpoint" in fd.read()
+    for file in ["5yok_md_4-out.cms", "5yok_md_6-out.cms", "5yok_md-out.cms"]:
+        assert os.path.isfile(os.path.join(folder, file))
+    with open(os.path.join(folder, "5yok_md_multisim.log"), "r", encoding="utf8") as fd:
+        log = fd.read()
+    assert "Stage 3 - simulate launched" not in log.split("Stage 4 failed")[1]
+    assert "Multisim completed" in log
+    assert desmond_builder.restart([folder], "resume") == []
@@ -0,0 +1,32 @@
+"""
+Read restraint files and reject malformed rows.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def write_csv(folder, text: str) -> str:
+    file = os.path.join(str(folder), "restraints.csv")
+    with open(file, "w", encoding="utf8") as fd:
+        fd.write(text)
+    return file
+
+
+def test_rows(tmp_path):
+    file = write_csv(tmp_path, "# atoms, force, r0\n12,res.num 5,10.0,3.5\n")
+    (restraint,) = desmond_builder.read_restraint_file(file, "dist", "stretch_harm")
+    assert restraint.atoms == ["atom.num 12", "res.num 5"]
+
+
+@pytest.mark.parametrize("text", ["1,2,3\n", "1,2,abc,3.5\n", "1,2,10.0,\n"])
+def test_malformed_rows(tmp_path, text):
+    file = write_csv(tmp_path, text)
+    with pytest.raises(ValueError):
+        list(desmond_builder.read_restraint_file(file, "dist", "stretch_harm"))
@@ -0,0 +1,104 @@
+"""
+Build the restraints of a stage from its restraint options, and partition the
+restraint lists of the additional stages once per Protocol.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+ADDITIONAL_STAGES = (
+    "additional_stages = 3",
+    "additional_stage_times = 100",
+    "additional_stage_temps = 300",
+    "additional_stage_ensembles = NPT",
+    "additional_stage_methods = Berendsen",
+)
+
+
+def protocol(config: str) -> desmond_builder.Protocol:
+    _, build_opts, file_path, protocol_opts = desmond_builder.parse_args(["-i", config])
+    return desmond_builder.Protocol(file_path, build_opts, protocol_opts)
+
+
+def test_stage_restraints(write_config):
+    system = protocol(
+        write_config(
+            "stage1_restraints_number_pos = 2",
+            "stage1_restraints_atoms_pos = protein,ligand",
+            "stage1_restraints_forces_pos = 5.0,1.0",
+            "stage1_restraints_number_dist = 2",
+            "stage1_restraints_atoms_dist = a,b,c,d",
+            "stage1_restraints_forces_dist = 1.0,2.0",
+            "stage1_restraints_r0_dist = 3.0,4.0",
+        )
+    )
+    restraints = system.stage_restraints("stage1")
+    assert [(r.kind, r.atoms, r.force, r.constant) for r in restraints] == [
+        ("pos", ["protein"], "5.0", None),
+        ("pos", ["ligand"], "1.0", None),
+        ("dist", ["a", "b"], "1.0", "3.0"),
+        ("dist", ["c", "d"], "2.0", "4.0"),
+    ]
+    # A single force or r0 applies to every restraint.
+    system.p_opts.stage1_restraints_forces_dist = "7.0"
+    system.p_opts.stage1_restraints_r0_dist = "2.5"
+    restraints = system.set_restraint("stage1", "dist", 2, True)
+    assert [(r.atoms, r.force, r.constant) for r in restraints] == [
+        (["a", "b"], "7.0", "2.5"),
+        (["c", "d"], "7.0", "2.5"),
+    ]
+
+
+def test_partition_of_the_additional_stages(write_config, monkeypatch):
+    system = protocol(
+        write_config(
+            *ADDITIONAL_STAGES,
+            "additional_stage_restraints_number_pos = 2,0,1",
+            "additional_stage_restraints_atoms_pos = a,b,c",
+            "additional_stage_restraints_forces_pos = 10,20,30",
+            "additional_stage_restraints_number_ang = 0,1,1",
+            "additional_stage_restraints_atoms_ang = d,e,f,g,h,i",
+            "additional_stage_restraints_forces_ang = 1,2",
+            "additional_stage_restraints_theta0_ang = 90,120",
+        )
+    )
+    calls = []
+    partition = system.partition_restraints
+    monkeypatch.setattr(
+        system,
+        "partition_restraints",
+        lambda *args: calls.append(args[1]) or partition(*args),
+    )
+    stages = [
+        [
+            (r.kind, r.atoms, r.force, r.constant)
+            for r in system.stage_restraints("additional_stage", stage)
+        ]
+        for stage in range(3)
+    ]
+    assert stages == [
+        [("pos", ["a"], "10", None), ("pos", ["b"], "20", None)],
+        [("ang", ["d", "e", "f"], "1", "90")],
+        [("pos", ["c"], "30", None), ("ang", ["g", "h", "i"], "2", "120")],
+    ]
+    # Every restraint type is partitioned once for all the stages.
+    assert calls == ["pos", "ang"]
+
+
+def test_partition_needs_every_value(write_config):
+    system = protocol(
+        write_config(
+            *ADDITIONAL_STAGES,
+            "additional_stage_restraints_number_pos = 1,1,1",
+            "additional_stage_restraints_atoms_pos = a,b,c",
+            "additional_stage_restraints_forces_pos = 10",
+        )
+    )
+    with pytest.raises(ValueError, match="additional_stage_restraints_forces_pos"):
+        system.partition_restraints("additional_stage", "pos", "1,1,1")
@@ -0,0 +1,89 @@
+"""
+Expand additional_stage_schedule into the additional stages of a restraint-decay
+ladder.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+STAGES = (
+    "additional_stage_temps = 300",
+    "additional_stage_ensembles = NPT",
+    "additional_stage_methods = Berendsen",
+)
+
+
+def protocol_options(config: str) -> desmond_builder.ProtocolOptions:
+    return desmond_builder.parse_args(["-i", config])[3]
+
+
+def test_geometric_schedule(write_config):
+    p_opts = protocol_options(
+        write_config(
+            *STAGES,
+            "additional_stage_schedule = geometric 50 0.1",
+            "additional_stage_schedule_stages = 4",
+            "additional_stage_schedule_time = 250",
+            "additional_stage_schedule_atoms = protein and backbone",
+        )
+    )
+    assert p_opts.additional_stages == 4
+    assert p_opts.additional_stage_times == "250,250,250,250"
+    assert p_opts.additional_stage_restraints_number_pos == "1,1,1,1"
+    assert p_opts.additional_stage_restraints_atoms_pos == ",".join(
+        ["protein and backbone"] * 4
+    )
+    assert p_opts.additional_stage_restraints_forces_pos == "50.0,6.3,0.7937,0.1"
+
+
+def test_linear_schedule_to_zero(write_config, tmp_path):
+    config = write_config(
+        *STAGES,
+        "additional_stage_schedule = linear 10 0",
+        "additional_stage_schedule_stages = 3",
+    )
+    p_opts = protocol_options(config)
+    # The last stage has no force, and no restraint.
+    assert p_opts.additional_stage_restraints_number_pos == "1,1,0"
+    assert p_opts.additional_stage_restraints_atoms_pos == "protein,protein"
+    assert p_opts.additional_stage_restraints_forces_pos == "10.0,5.0"
+    desmond_builder.run_system(["-i", config])
+    with open(
+        os.path.join(str(tmp_path), "md_run", "5yok_md.msj"), "r", encoding="utf8"
+    ) as fd:
+        msj = fd.read()
+    assert msj.count("Additional stage = ") == 3
+    assert "force_constants = [10.0 10.0 10.0]" in msj
+    assert "force_constants = [5.0 5.0 5.0]" in msj
+
+
+@pytest.mark.parametrize(
+    "lines, message",
+    [
+        (
+            ["additional_stage_schedule_atoms = protein,ligand"],
+            "additional_stage_schedule_atoms cannot contain commas",
+        ),
+        (
+            ["additional_stage_restraints_number_pos = 1"],
+            "additional_stage_restraints_number_pos is generated",
+        ),
+        (["additional_stage_schedule_stages = 0"], "must be positive"),
+    ],
+)
+def test_invalid_schedule(write_config, capsys, lines, message):
+    config = write_config(
+        *STAGES,
+        "additional_stage_schedule = geometric 50 0.1",
+        *(["additional_stage_schedule_stages = 4"] if "stages" not in lines[0] else []),
+        *lines,
+    )
+    with pytest.raises(SystemExit):
+        protocol_options(config)
+    assert message in capsys.readouterr().out
@@ -0,0 +1,64 @@
+"""
+Expand a|b|c values of a config into a parameter sweep and build its variants.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+
+def test_variants(write_config):
+    config = write_config(
+        "production_temp = 300|310", "production_traj_interval = 10|20"
+    )
+    variants = desmond_builder.sweep_variants(config)
+    assert [name for name, _, _ in variants] == [
+        "production_temp-300_production_traj_interval-10",
+        "production_temp-300_production_traj_interval-20",
+        "production_temp-310_production_traj_interval-10",
+        "production_temp-310_production_traj_interval-20",
+    ]
+    _, sections, swept = variants[-1]
+    assert sections["protocol"]["production_temp"] == "310"
+    assert swept == {
+        ("protocol", "production_temp"): "310",
+        ("protocol", "production_traj_interval"): "20",
+    }
+
+
+def test_no_sweep(write_config):
+    assert desmond_builder.sweep_variants(write_config()) == []
+
+
+def test_sweep_of_validated_integers(write_config, tmp_path):
+    config = write_config(
+        "production_replicas = 1|2",
+        "additional_stages = 0|2",
+        "additional_stage_times = 100",
+        "additional_stage_temps = 300",
+        "additional_stage_ensembles = NPT",
+        "additional_stage_methods = Berendsen",
+    )
+    desmond_builder.run_system(["-i", config, "--no-run"])
+    workdir = os.path.join(str(tmp_path), "md_run")
+    folders = sorted(os.listdir(workdir))
+    assert folders == [
+        "preparation",
+        "production_replicas-1_additional_stages-0",
+        "production_replicas-1_additional_stages-2",
+        "production_replicas-2_additional_stages-0",
+        "production_replicas-2_additional_stages-2",
+    ]
+    with open(
+        os.path.join(
+            workdir, "production_replicas-2_additional_stages-2", "5yok_md.msj"
+        ),
+        "r",
+        encoding="utf8",
+    ) as fd:
+        msj = fd.read()
+    assert msj.count("Additional stage = ") == 2
+    assert msj.count("$MASTERJOBNAME-replica") == 2
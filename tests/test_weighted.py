@@ -0,0 +1,88 @@
+"""
+Bin the residues of examples/5yok.mae into positional restraint classes by their
+B-factors, and write one restraint per class.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import desmond_builder  # noqa: E402
+
+MAE = os.path.join(ROOT, "examples", "5yok.mae")
+ATOMS = "protein and heavy_atom"
+
+
+@pytest.fixture(scope="module")
+def table():
+    return desmond_builder.MaeAtomTable(MAE)
+
+
+def residue_scores(table, classes: list) -> list:
+    """The mean B-factor of every residue of every class."""
+    residues = desmond_builder.AslEvaluator(table).residues()
+    values = table.column("r_m_pdb_tfactor")
+    return [
+        [
+            np.nanmean(values[atoms - 1][residues[atoms - 1] == residue])
+            for residue in np.unique(residues[atoms - 1])
+        ]
+        for atoms in classes
+    ]
+
+
+def test_classes_split_the_selection(table):
+    classes = desmond_builder.weighted_classes(
+        table, "bfactor", 3, "r_m_pdb_tfactor", ATOMS
+    )
+    assert len(classes) == 3
+    atoms = np.concatenate(classes)
+    selected = desmond_builder.AslEvaluator(table).evaluate(ATOMS)
+    assert np.array_equal(np.sort(atoms), np.flatnonzero(selected) + 1)
+    # Residues are not split between classes.
+    residues = desmond_builder.AslEvaluator(table).residues()
+    sets = [set(residues[numbers - 1].tolist()) for numbers in classes]
+    assert not (sets[0] & sets[1] or sets[1] & sets[2] or sets[0] & sets[2])
+    # From the most ordered (low B-factor) to the most flexible residues.
+    scores = residue_scores(table, classes)
+    assert max(scores[0]) <= min(scores[1]) and max(scores[1]) <= min(scores[2])
+
+
+def test_classes_with_edges(table):
+    classes = desmond_builder.weighted_classes(
+        table, "bfactor", 2, "r_m_pdb_tfactor", ATOMS, [20.0]
+    )
+    low, high = residue_scores(table, classes)
+    assert max(low) < 20.0 <= min(high)
+
+
+def test_plddt_reverses_the_classes(table):
+    bfactor = desmond_builder.weighted_classes(
+        table, "bfactor", 2, "r_m_pdb_tfactor", ATOMS, [20.0]
+    )
+    plddt = desmond_builder.weighted_classes(
+        table, "plddt", 2, "r_m_pdb_tfactor", ATOMS, [20.0]
+    )
+    assert np.array_equal(plddt[0], bfactor[1])
+    assert np.array_equal(plddt[1], bfactor[0])
+
+
+def test_one_restraint_per_class(write_config):
+    config = write_config(
+        "stage1_restraints_weighted = bfactor",
+        "stage1_restraints_weighted_forces = 50.0 10.0 1.0",
+    )
+    _, build_opts, file_path, protocol_opts = desmond_builder.parse_args(["-i", config])
+    protocol = desmond_builder.Protocol(file_path, build_opts, protocol_opts)
+    restraints = protocol.weighted_restraints("stage1")
+    assert [(r.kind, r.name, r.force) for r in restraints] == [
+        ("pos", "posre_harm", "50.0"),
+        ("pos", "posre_harm", "10.0"),
+        ("pos", "posre_harm", "1.0"),
+    ]
+    for restraint in restraints:
+        assert desmond_builder.ATOM_NUMBERS.fullmatch(restraint.atoms[0])